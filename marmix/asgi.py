@@ -0,0 +1,18 @@
+"""
+ASGI config for MarMix.
+
+This module exposes the channel layer used by the interface server (``daphne asgi:channel_layer``) and by the
+workers (``python manage.py runworker``) that run the consumers of :mod:`routing`.
+
+"""
+import os
+
+from configurations import importer
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.production")
+os.environ.setdefault("DJANGO_CONFIGURATION", "Production")
+importer.install()
+
+from channels.asgi import get_channel_layer
+
+channel_layer = get_channel_layer()
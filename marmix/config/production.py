@@ -78,8 +78,34 @@ class Production(Common):
     # Only do this here because thanks to django-pylibmc-sasl and pylibmc
     # memcacheify is painful to install on windows.
     CACHES = values.CacheURLValue(default="memcached://127.0.0.1:11211", environ_prefix='MARMIX')
+    SIMULATION_CACHES = {
+        'simulation': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ.get('MARMIX_SIMULATION_CACHE_URL', 'redis://127.0.0.1:6379/1'),
+            'KEY_PREFIX': 'marmix',
+            'TIMEOUT': 3600,
+        },
+    }
+
+    @classmethod
+    def post_setup(cls):
+        super(Production, cls).post_setup()
+        cls.CACHES.update(cls.SIMULATION_CACHES)
     # END CACHING
 
+    # CHANNELS
+    # The interface servers, the channel workers and the Celery workers share the Redis layer
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'asgi_redis.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.environ.get('MARMIX_REDIS_URL', 'redis://127.0.0.1:6379')],
+            },
+            'ROUTING': 'routing.channel_routing',
+        },
+    }
+    # END CHANNELS
+
     ACCOUNT_DEFAULT_HTTP_PROTOCOL = 'https'
     # Your production stuff: Below this line define 3rd party libary settings
     LOGGING = {
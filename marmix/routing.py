@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from simulations.consumers import ws_connect, ws_disconnect
+
+
+# WebSocket routes: the clients only listen, the market data is pushed by simulations.streams
+channel_routing = {
+    'websocket.connect': ws_connect,
+    'websocket.disconnect': ws_disconnect,
+}
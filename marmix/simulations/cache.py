@@ -0,0 +1,219 @@
+# -*- coding: UTF-8 -*-
+# cache.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared cache of the simulation state read on every request and every matching pass.
+
+Each entry is loaded from the database on a miss and written through by the ``save`` method of the model it mirrors
+(:class:`simulations.models.SimDay`, :class:`simulations.models.Team` and :class:`stocks.models.Stock`), once the
+database transaction is committed so that a rollback never leaves a value in the cache. The entries
+live in the cache named by the ``SIMULATION_CACHE`` setting (Redis in production, any Django backend such as locmem
+works in the tests) and their keys carry :data:`CACHE_VERSION`, increment it when the shape of a value changes.
+"""
+
+# Stdlib imports
+import time
+
+# Core Django imports
+from django.conf import settings
+from django.db import transaction
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.utils import timezone
+
+# Third-party app imports
+
+# MarMix imports
+
+
+CACHE_VERSION = 2
+
+# Minimal age of a ranking (in seconds) before it is computed again
+RANKING_INTERVAL = 1
+
+
+def backend():
+    return caches[getattr(settings, 'SIMULATION_CACHE', 'default')]
+
+
+class CachedValue(object):
+    """
+    A value of the simulation state, identified by the id of the object it belongs to.
+
+    :param name: The prefix of the keys.
+    :param loader: A function returning the value for an id (None if there is nothing to cache).
+    :param timeout: The cache timeout (the default timeout of the backend if not set).
+    """
+
+    def __init__(self, name, loader, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.loader = loader
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, identifier):
+        return '%s-%s' % (self.name, identifier)
+
+    def get(self, identifier):
+        value = backend().get(self.key(identifier), version=CACHE_VERSION)
+        if value is None:
+            self.misses += 1
+            value = self.loader(identifier)
+            if value is not None:
+                self.set(identifier, value)
+        else:
+            self.hits += 1
+        return value
+
+    def peek(self, identifier):
+        """
+        The cached value, None on a miss (the value is not loaded).
+        """
+        return backend().get(self.key(identifier), version=CACHE_VERSION)
+
+    def set(self, identifier, value):
+        if value is None:
+            self.delete(identifier)
+        else:
+            backend().set(self.key(identifier), value, self.timeout, version=CACHE_VERSION)
+
+    def delete(self, identifier):
+        backend().delete(self.key(identifier), version=CACHE_VERSION)
+
+    def set_on_commit(self, identifier, value):
+        """
+        Writes the value once the current transaction is committed (at once in autocommit mode).
+        """
+        transaction.on_commit(lambda: self.set(identifier, value))
+
+    def delete_on_commit(self, identifier):
+        transaction.on_commit(lambda: self.delete(identifier))
+
+
+def clock_from_day(day):
+    """
+    The clock of a simulation as returned by :func:`simulations.models.current_sim_day`.
+
+    :param day: A SimDay object.
+    """
+    return {'sim_round': day.sim_round, 'sim_day': day.sim_day, 'sim_date': day.sim_round * 100 + day.sim_day,
+            'timestamp': day.timestamp, 'state': day.get_state_display(), 'sim_state': day.state}
+
+
+def _load_clock(simulation_id):
+    from .models import Simulation, SimDay
+    current_day = SimDay.objects.filter(simulation_id=simulation_id).first()
+    if current_day:
+        return clock_from_day(current_day)
+    return {'sim_round': 0, 'sim_day': 0, 'sim_date': 0, 'timestamp': timezone.now(),
+            'state': Simulation.INITIALIZING, 'sim_state': Simulation.INITIALIZING}
+
+
+def _load_stock_price(stock_id):
+    from stocks.models import Stock
+    return Stock.objects.filter(pk=stock_id).values_list('price', flat=True).first()
+
+
+def _load_team_simulation(team_id):
+    from .models import Team
+    return Team.objects.filter(pk=team_id).values_list('current_simulation_id', flat=True).first()
+
+
+def _load_liquidity_manager(simulation_id):
+    from .models import Team
+    return Team.objects.filter(current_simulation_id=simulation_id,
+                               team_type=Team.LIQUIDITY_MANAGER).values_list('id', flat=True).first()
+
+
+def _load_ticks(stock_id):
+    from stocks.models import Stock, Quote
+    from stocks.quotes import TickStore
+    simulation_id = Stock.objects.filter(pk=stock_id).values_list('simulation_id', flat=True).first()
+    if simulation_id is None:
+        return None
+    current = clock.get(simulation_id)
+    store = TickStore(current['sim_date'])
+    quotes = Quote.objects.filter(stock_id=stock_id, sim_round=current['sim_round'], sim_day=current['sim_day'])
+    for timestamp, price in quotes.order_by('timestamp', 'id').values_list('timestamp', 'price'):
+        store.append(timestamp.timestamp(), price)
+    return store
+
+
+def _load_ranking(simulation_id):
+    from .models import compute_rank_list
+    return {'teams': compute_rank_list(simulation_id), 'computed_at': time.time()}
+
+
+def _load_user_team(user_id):
+    from .models import Simulation, Team
+    team = Team.objects.filter(simulations__state__gte=Simulation.READY,
+                               simulations__state__lte=Simulation.FINISHED).filter(users__id=user_id).first()
+    # False is cached as well, users without a team are looked up as often as the others
+    return team or False
+
+
+clock = CachedValue('sim-day', _load_clock)
+stock_price = CachedValue('stock-price', _load_stock_price)
+team_simulation = CachedValue('team-simulation', _load_team_simulation)
+liquidity_manager = CachedValue('liquidity-manager', _load_liquidity_manager)
+user_team = CachedValue('user-team', _load_user_team, timeout=60)
+ticks = CachedValue('ticks', _load_ticks)
+ranking = CachedValue('ranking', _load_ranking, timeout=60)
+ranking_changed = CachedValue('ranking-changed', lambda simulation_id: None)
+
+ENTRIES = (clock, stock_price, team_simulation, liquidity_manager, user_team, ticks, ranking)
+
+
+def invalidate_user_teams(user_ids):
+    """
+    Drops the cached team of users once the current transaction is committed.
+    """
+    for user_id in list(user_ids):
+        user_team.delete_on_commit(user_id)
+
+
+def mark_ranking(simulation_id):
+    """
+    Flags the ranking of a simulation as changed once the current transaction is committed (fills, prices, dividends).
+    """
+    transaction.on_commit(lambda: ranking_changed.set(simulation_id, True))
+
+
+def get_ranking(simulation_id):
+    """
+    The ranking of a simulation. A changed ranking is computed again at most once per :data:`RANKING_INTERVAL`, the
+    clients in between get the previous one.
+    """
+    value = ranking.get(simulation_id)
+    if ranking_changed.peek(simulation_id) and time.time() - value['computed_at'] >= RANKING_INTERVAL:
+        ranking_changed.delete(simulation_id)
+        value = _load_ranking(simulation_id)
+        ranking.set(simulation_id, value)
+    return value['teams']
+
+
+def cache_stats():
+    """
+    Hits and misses of each entry since the process started.
+    """
+    return dict((entry.name, {'hits': entry.hits, 'misses': entry.misses}) for entry in ENTRIES)
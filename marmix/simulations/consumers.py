@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+# consumers.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+# Stdlib imports
+
+# Core Django imports
+
+# Third-party app imports
+from channels import Group
+from channels.sessions import channel_session
+from channels.auth import channel_session_user_from_http
+
+# MarMix imports
+from .streams import simulation_group, team_group
+
+
+@channel_session_user_from_http
+def ws_connect(message):
+    """
+    Subscribes the connection to the simulation and the team of the logged in user. A team that does not play a
+    simulation only receives its own events.
+    """
+    groups = []
+    if message.user.is_authenticated():
+        team = message.user.get_team
+        if team is not None:
+            groups = [team_group(team.id)]
+            if team.current_simulation_id is not None:
+                groups.append(simulation_group(team.current_simulation_id))
+    for group in groups:
+        Group(group).add(message.reply_channel)
+    message.channel_session['groups'] = groups
+
+
+@channel_session
+def ws_disconnect(message):
+    for group in message.channel_session.get('groups', []):
+        Group(group).discard(message.reply_channel)
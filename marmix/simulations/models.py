@@ -28,10 +28,10 @@ import decimal
 # Core Django imports
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
-from django.core.cache import cache
 from django.db.models import Sum
-from django.db import connection
-from django.utils import timezone
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 
 
 # Third-party app imports
@@ -41,6 +41,8 @@ from shorturls import baseconv
 # MarMix imports
 from customers.models import Customer
 from users.models import User
+from .streams import publish_clock
+from . import cache as simulation_cache
 
 
 def dictfetchall(cursor):
@@ -68,32 +70,16 @@ def generate_uuid(length):
 
 
 def current_sim_day(simulation_id):
-    cached = cache.get('sim-day-%s' % simulation_id)
-    if not cached:
-        try:
-            current_day = SimDay.objects.filter(simulation_id=simulation_id)[0]
-        except IndexError:
-            current_day = None
-        if current_day:
-            cached = {'sim_round': current_day.sim_round, 'sim_day': current_day.sim_day,
-                      'sim_date': current_day.sim_round*100+current_day.sim_day,
-                      'timestamp': current_day.timestamp, 'state': current_day.get_state_display(),
-                      'sim_state': current_day.state}
-        else:
-            cached = {'sim_round': 0, 'sim_day': 0, 'sim_date': 0, 'timestamp': timezone.now(),
-                      'state': Simulation.INITIALIZING, 'sim_state': Simulation.INITIALIZING}
-        cache.set('sim-day-%s' % simulation_id, cached)
-    return cached
+    return simulation_cache.clock.get(simulation_id)
 
 
 def current_balance(team_id, simulation_id):
     from stocks.models import TransactionLine
     cursor = connection.cursor()
-    cursor.execute('SELECT SUM(CASE WHEN tl.asset_type=%s THEN s.price*tl.quantity ELSE tl.amount END) as balance '
-                   'FROM stocks_transactionline tl '
-                   'LEFT JOIN stocks_stock s ON tl.stock_id=s.id '
-                   'LEFT JOIN stocks_transaction st ON tl.transaction_id=st.id '
-                   'WHERE tl.team_id=%s AND st.simulation_id=%s', [TransactionLine.STOCKS, team_id, simulation_id])
+    cursor.execute('SELECT SUM(CASE WHEN p.asset_type=%s THEN s.price*p.quantity ELSE p.amount END) as balance '
+                   'FROM stocks_position p '
+                   'LEFT JOIN stocks_stock s ON p.stock_id=s.id '
+                   'WHERE p.team_id=%s AND p.simulation_id=%s', [TransactionLine.STOCKS, team_id, simulation_id])
     row = cursor.fetchone()
     try:
         return row[0]
@@ -102,8 +88,8 @@ def current_balance(team_id, simulation_id):
 
 
 def current_cash(team_id, simulation_id):
-    from stocks.models import TransactionLine
-    tl = TransactionLine.objects.filter(transaction__simulation_id=simulation_id).filter(team_id=team_id).exclude(
+    from stocks.models import TransactionLine, Position
+    tl = Position.objects.filter(simulation_id=simulation_id).filter(team_id=team_id).exclude(
         asset_type=TransactionLine.STOCKS).values('team_id').annotate(cash_amount=Sum('amount')).order_by('team_id')
     try:
         cash = tl[0]['cash_amount']
@@ -113,8 +99,8 @@ def current_cash(team_id, simulation_id):
 
 
 def current_stock_value(team_id, simulation_id):
-    from stocks.models import TransactionLine
-    tl = TransactionLine.objects.filter(transaction__simulation_id=simulation_id).filter(team_id=team_id).filter(
+    from stocks.models import TransactionLine, Position
+    tl = Position.objects.filter(simulation_id=simulation_id).filter(team_id=team_id).filter(
         asset_type=TransactionLine.STOCKS).values('team_id').annotate(cash_amount=Sum('amount')).order_by('team_id')
     try:
         cash = tl[0]['cash_amount']
@@ -124,8 +110,8 @@ def current_stock_value(team_id, simulation_id):
 
 
 def current_shares(team_id, stock_id):
-    from stocks.models import TransactionLine
-    tl = TransactionLine.objects.filter(team_id=team_id).filter(asset_type=TransactionLine.STOCKS).filter(
+    from stocks.models import TransactionLine, Position
+    tl = Position.objects.filter(team_id=team_id).filter(asset_type=TransactionLine.STOCKS).filter(
         stock_id=stock_id).values('team_id').annotate(shares=Sum('quantity')).order_by('team_id')
     try:
         shares = tl[0]['shares']
@@ -135,9 +121,9 @@ def current_shares(team_id, stock_id):
 
 
 def current_holdings(team_id, simulation_id):
-    from stocks.models import TransactionLine
+    from stocks.models import TransactionLine, Position
     stocks_list = {'stocks': [], 'cash': {}, 'balance': {'market_value': 0, 'purchase_value': 0, 'gain': 0, 'gain_p': 0}, 'clock': current_sim_day(simulation_id)}
-    tl = TransactionLine.objects.filter(transaction__simulation_id=simulation_id).filter(team_id=team_id).values('stock__symbol', 'stock__price', 'asset_type', 'stock__id', 'stock__quantity').annotate(
+    tl = Position.objects.filter(simulation_id=simulation_id).filter(team_id=team_id).values('stock__symbol', 'stock__price', 'asset_type', 'stock__id', 'stock__quantity').annotate(
         quantity=Sum('quantity'), amount=Sum('amount')).order_by('stock__symbol')
 
     dividends = 0
@@ -195,62 +181,66 @@ def current_holdings(team_id, simulation_id):
 
 
 def rank_list(simulation_id):
+    """
+    The ranking of the teams of a simulation, served from the cache (see :func:`simulations.cache.get_ranking`).
+    """
+    return simulation_cache.get_ranking(simulation_id)
+
+
+def compute_rank_list(simulation_id):
+    """
+    Ranks the players of a simulation by the value of their positions: the shares at the last price of the stocks
+    and the cash, dividends and costs at their amount.
+    """
     from stocks.models import TransactionLine
     cursor = connection.cursor()
-    cursor.execute('SELECT tm.name, tm.id, SUM(CASE WHEN tl.asset_type=%s THEN s.price*tl.quantity ELSE tl.amount END) '
+    cursor.execute('SELECT tm.name, tm.id, SUM(CASE WHEN p.asset_type=%s THEN s.price*p.quantity ELSE p.amount END) '
                    'as balance, '
-                   'SUM(CASE WHEN tl.asset_type=%s THEN tl.quantity ELSE 0 END) as size '
-                   'FROM stocks_transactionline tl '
-                   'LEFT JOIN stocks_stock s ON tl.stock_id=s.id '
-                   'LEFT JOIN stocks_transaction st ON tl.transaction_id=st.id '
-                   'LEFT JOIN simulations_team tm ON tl.team_id = tm.id '
-                   'WHERE tl.team_id IN (SELECT team_id FROM simulations_team_simulations WHERE simulation_id=%s) '
-                   'AND st.simulation_id=%s AND tm.team_type=%s GROUP BY tm.name, tm.id ORDER BY balance DESC',
-                   [TransactionLine.STOCKS, TransactionLine.STOCKS, simulation_id, simulation_id, Team.PLAYERS])
+                   'SUM(CASE WHEN p.asset_type=%s THEN p.quantity ELSE 0 END) as size '
+                   'FROM stocks_position p '
+                   'INNER JOIN simulations_team tm ON p.team_id = tm.id '
+                   'LEFT JOIN stocks_stock s ON p.stock_id=s.id '
+                   'WHERE p.simulation_id=%s AND tm.team_type=%s GROUP BY tm.name, tm.id ORDER BY balance DESC',
+                   [TransactionLine.STOCKS, TransactionLine.STOCKS, simulation_id, Team.PLAYERS])
     rank_list = dictfetchall(cursor)
     return rank_list
 
 
 def stocks_list(simulation_id):
-    # TODO: Set right timestamp for intra-day values
+    """
+    The last price of the stocks of a simulation with their lows and highs of the current day and since the start of
+    the simulation, kept up to date by :func:`stocks.quotes.flush_quotes`.
+    """
+    clock = current_sim_day(simulation_id)
     cursor = connection.cursor()
-    cursor.execute('SELECT s.symbol, s.price, s1.min AS min_day, s1.max AS max_day, s2.min AS min_life, s2.max AS max_life FROM stocks_stock s '
-                   'LEFT JOIN (SELECT stock_id, MIN(price) AS min, MAX(price) AS max FROM stocks_quote '
-                   'WHERE timestamp>%s AND timestamp<%s GROUP BY stock_id) s1 '
-                   'ON s.id=s1.stock_id '
-                   'LEFT JOIN (SELECT stock_id, MIN(price) AS min, MAX(price) AS max FROM stocks_quote '
-                   'GROUP BY stock_id) s2 '
-                   'ON s.id=s2.stock_id '
-                   'WHERE s.simulation_id=%s ORDER BY s.symbol', ['2015-01-31', '2015-02-01', simulation_id])
+    cursor.execute('SELECT s.symbol, s.price, '
+                   'CASE WHEN s.stats_date=%s THEN s.day_low END AS min_day, '
+                   'CASE WHEN s.stats_date=%s THEN s.day_high END AS max_day, '
+                   's.life_low AS min_life, s.life_high AS max_life FROM stocks_stock s '
+                   'WHERE s.simulation_id=%s ORDER BY s.symbol', [clock['sim_date'], clock['sim_date'], simulation_id])
     q_stocks_list = dictfetchall(cursor)
     return q_stocks_list
 
 
 def historical_prices(simulation_id):
     cursor = connection.cursor()
-    cursor.execute('SELECT DISTINCT tl.stock_id, s.symbol, t.sim_round, t.sim_day, min(tl.price) OVER w AS low, '
-                   'max(tl.price) OVER w AS high, first_value(tl.price) OVER w AS open, '
-                   'last_value(tl.price) OVER w AS close, '
-                   'sum(CASE WHEN tl.quantity > 0 THEN tl.quantity ELSE 0 END) OVER w AS volume '
-                   'FROM stocks_transactionline tl, stocks_transaction t, stocks_stock s '
-                   'WHERE tl.transaction_id = t.id AND tl.stock_id = s.id AND t.sim_round > 0 AND t.simulation_id = %s '
-                   'WINDOW w AS (PARTITION BY t.sim_round, t.sim_day) '
+    cursor.execute('SELECT h.stock_id, s.symbol, h.sim_round, h.sim_day, h.price_low AS low, h.price_high AS high, '
+                   'h.price_open AS open, h.price_close AS close, h.volume '
+                   'FROM stocks_historicalprice h, stocks_stock s '
+                   'WHERE h.stock_id = s.id AND h.sim_round > 0 AND s.simulation_id = %s '
                    'ORDER BY 1,3,4', [simulation_id])
     q_stocks_historical = dictfetchall(cursor)
     return q_stocks_historical
 
 
 def stock_historical_prices(stock_id):
-    # TODO: We should not have transactions during day 0...
+    # The bars are maintained by stocks.models.update_historical_price
     cursor = connection.cursor()
-    cursor.execute('SELECT DISTINCT tl.stock_id, s.symbol, t.sim_round, t.sim_day, min(tl.price) OVER w AS price_low, '
-                   'max(tl.price) OVER w AS price_high, first_value(tl.price) OVER w AS price_open, '
-                   'last_value(tl.price) OVER w AS price_close, '
-                   'sum(CASE WHEN tl.quantity > 0 THEN tl.quantity ELSE 0 END) OVER w AS volume '
-                   'FROM stocks_transactionline tl, stocks_transaction t, stocks_stock s '
-                   'WHERE tl.transaction_id = t.id AND tl.stock_id = s.id AND t.sim_round > 0 AND t.sim_day > 0 AND tl.stock_id = %s '
-                   'WINDOW w AS (PARTITION BY t.sim_round, t.sim_day) '
-                   'ORDER BY 1,3,4', [stock_id])
+    cursor.execute('SELECT h.id, h.stock_id, s.symbol, h.sim_round, h.sim_day, h.price_low, h.price_high, h.price_open, '
+                   'h.price_close, h.volume '
+                   'FROM stocks_historicalprice h, stocks_stock s '
+                   'WHERE h.stock_id = s.id AND h.sim_round > 0 AND h.sim_day > 0 AND h.stock_id = %s '
+                   'ORDER BY 2,4,5', [stock_id])
     q_stocks_historical = dictfetchall(cursor)
     return q_stocks_historical
 
@@ -317,6 +307,19 @@ class Simulation(TimeStampedModel):
                                            default='10.0000', help_text=_("Transaction costs per order"))
     variable_transaction_cost = models.FloatField(verbose_name=_("variable transaction costs (%)"), default=1,
                                                   help_text=_("Variable transaction costs per order in %"))
+    liquidity_spread = models.FloatField(verbose_name=_("liquidity manager spread"), default=0.33,
+                                         help_text=_("Largest spread of the book, relative to its mid price, at which "
+                                                     "the liquidity manager trades"))
+    liquidity_band_low = models.FloatField(verbose_name=_("liquidity manager lower band"), default=0.5,
+                                           help_text=_("Lowest price of a fill, relative to the last price"))
+    liquidity_band_high = models.FloatField(verbose_name=_("liquidity manager upper band"), default=1.5,
+                                            help_text=_("Highest price of a fill, relative to the last price"))
+    liquidity_price_cap = models.DecimalField(verbose_name=_("liquidity manager price cap"), max_digits=14,
+                                              decimal_places=4, default='655.5000',
+                                              help_text=_("Highest price at which the liquidity manager trades"))
+    liquidity_min_depth = models.IntegerField(verbose_name=_("liquidity manager minimal depth"), default=3,
+                                              help_text=_("The liquidity manager trades when each side of the book "
+                                                          "holds more orders than this"))
     info = models.TextField(verbose_name=_("simulation information"), null="True", blank="True",
                             help_text=_("Information that is displayed in the participant's dashboard"))
     #expected_return = models.FloatField(verbose_name=_("variable transaction costs (%)"), default=1,
@@ -327,9 +330,11 @@ class Simulation(TimeStampedModel):
             self.code = 'MM-99999999'
             super(Simulation, self).save(*args, **kwargs)
             self.code = short_code_encode(self.id, self.customer.short_code)
-        if self.id:
-            cache.delete('simulation-%s' % self.id)
         super(Simulation, self).save(*args, **kwargs)
+        simulation_cache.clock.delete_on_commit(self.id)
+        simulation_cache.liquidity_manager.delete_on_commit(self.id)
+        # The state of the simulation decides which team the users get
+        simulation_cache.invalidate_user_teams(User.objects.filter(teams__simulations=self).values_list('id', flat=True))
 
     def _nb_teams(self):
         teams = self.teams.all().count()
@@ -424,6 +429,10 @@ class Team(TimeStampedModel):
         if self.uuid is None:
             self.uuid = generate_uuid(8)
         models.Model.save(self, force_insert, force_update, using, update_fields)
+        simulation_cache.team_simulation.set_on_commit(self.id, self.current_simulation_id)
+        simulation_cache.invalidate_user_teams(self.users.values_list('id', flat=True))
+        if self.team_type == self.LIQUIDITY_MANAGER and self.current_simulation_id:
+            simulation_cache.liquidity_manager.set_on_commit(self.current_simulation_id, self.id)
 
     class Meta:
         verbose_name = _('team')
@@ -456,8 +465,12 @@ class SimDay(models.Model):
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         models.Model.save(self, force_insert, force_update, using, update_fields)
-        cached = {'sim_round': self.sim_round, 'sim_day': self.sim_day, 'timestamp': self.timestamp, 'state': self.get_state_display()}
-        cache.set('sim-day-%s' % self.simulation_id, cached)
+        simulation_id, clock = self.simulation_id, simulation_cache.clock_from_day(self)
+
+        def announce():
+            simulation_cache.clock.set(simulation_id, clock)
+            publish_clock(simulation_id, clock)
+        transaction.on_commit(announce)
 
     def __str__(self):
         return "R%s/D%s" % (self.sim_round, self.sim_day)
@@ -476,3 +489,35 @@ def create_liquidity_manager(simulation_id):
     trader.save()
     trader.simulations.add(simulation)
     return trader
+
+
+@receiver(m2m_changed, sender=Team.users.through)
+def team_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drops the cached team of the users added to or removed from a team.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        user_ids = [instance.id]
+    elif pk_set is not None:
+        user_ids = pk_set
+    else:
+        user_ids = instance.users.values_list('id', flat=True)
+    simulation_cache.invalidate_user_teams(user_ids)
+
+
+@receiver(m2m_changed, sender=Team.simulations.through)
+def team_simulations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drops the cached team of the members of the teams added to or removed from a simulation.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        team_ids = [instance.id]
+    elif pk_set is not None:
+        team_ids = pk_set
+    else:
+        team_ids = instance.teams.values_list('id', flat=True)
+    simulation_cache.invalidate_user_teams(User.objects.filter(teams__in=team_ids).values_list('id', flat=True))
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+# streams.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Market data pushed to the WebSocket clients.
+
+Each connected client is added to the group of its simulation and to the group of its team (see
+:mod:`simulations.consumers`). Events are sent once, when the database transaction that produced them is committed,
+and every subscriber of the group receives the same message::
+
+    {"event": "quote", "data": {"stock": 12, "price": "10.5000", ...}}
+"""
+
+# Stdlib imports
+import json
+
+# Core Django imports
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+# Third-party app imports
+from channels import Group
+
+# MarMix imports
+
+
+def simulation_group(simulation_id):
+    return 'simulation-%s' % simulation_id
+
+
+def team_group(team_id):
+    return 'team-%s' % team_id
+
+
+def encode(event, data):
+    return json.dumps({'event': event, 'data': data}, cls=DjangoJSONEncoder)
+
+
+def publish(group, event, data):
+    """
+    Sends an event to a group once the current transaction is committed (immediately in autocommit mode).
+
+    :param group: The group name (see :func:`simulation_group` and :func:`team_group`).
+    :param event: The event type (clock, quote, trade, fill, book or expired).
+    :param data: A JSON serializable dict.
+    :return: Nothing.
+    """
+    message = {'text': encode(event, data)}
+    transaction.on_commit(lambda: Group(group).send(message))
+
+
+def publish_clock(simulation_id, clock):
+    publish(simulation_group(simulation_id), 'clock', clock)
+
+
+def publish_quote(simulation_id, stock_id, price, timestamp):
+    publish(simulation_group(simulation_id), 'quote', {'stock': stock_id, 'price': price, 'timestamp': timestamp})
+
+
+def publish_fills(simulation_id, stock_id, transaction_id, fills):
+    """
+    Publishes the fills of a settlement: the trades (price and quantity) to the whole simulation and the orders
+    filled to their team only.
+
+    :param fills: A list of (sell_order, buy_order, price, quantity) tuples.
+    """
+    trades = []
+    teams = {}
+    for sell_order, buy_order, price, quantity in fills:
+        trades.append({'price': price, 'quantity': quantity})
+        for order in (sell_order, buy_order):
+            teams.setdefault(order.team_id, []).append({'order': order.id, 'order_type': order.order_type,
+                                                        'price': price, 'quantity': quantity})
+    publish(simulation_group(simulation_id), 'trade', {'stock': stock_id, 'transaction': transaction_id,
+                                                       'trades': trades})
+    for team_id, team_fills in teams.items():
+        publish(team_group(team_id), 'fill', {'stock': stock_id, 'transaction': transaction_id, 'fills': team_fills})
+
+
+def publish_expired(simulation_id, stock_id, order_ids):
+    publish(simulation_group(simulation_id), 'expired', {'stock': stock_id, 'orders': order_ids})
+
+
+def publish_book(simulation_id, depth, deltas=None):
+    """
+    Publishes a change of the order book of a stock as aggregated price levels, the orders are never sent: the
+    quantity and the number of orders of each level changed, or all the levels of the book if the changes are not
+    known (the same data as the order book API, see :class:`stocks.views.OrderBookViewSet`).
+
+    :param depth: The :class:`stocks.engine.BookDepth` of the stock.
+    :param deltas: The (sequence, order_type, price, quantity, number of orders) tuples of the levels changed.
+    """
+    data = {'stock': depth.stock_id, 'sequence': depth.sequence}
+    if deltas is None:
+        data['snapshot'] = depth.depth()
+    else:
+        data['deltas'] = [{'sequence': sequence, 'order_type': order_type, 'price': price, 'quantity': quantity,
+                           'orders': orders} for sequence, order_type, price, quantity, orders in deltas]
+    publish(simulation_group(simulation_id), 'book', data)
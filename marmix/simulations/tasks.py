@@ -23,6 +23,7 @@
 # Stdlib imports
 
 # Core Django imports
+from django.db import transaction
 from django.utils.translation import ugettext as _
 
 # Third-party app imports
@@ -31,8 +32,8 @@ from async_messages import messages
 # MarMix imports
 from config.celery import app
 from simulations.models import Simulation, Team, create_liquidity_manager
-from tickers.tasks import create_company_simulation, create_company_live, clock_erpsim, create_mssql_simulation
-from stocks.models import create_generic_stocks, process_opening_transactions, Stock
+from tickers.tasks import create_companies_simulation, create_companies_live, clock_erpsim, create_mssql_simulation
+from stocks.models import create_generic_stocks, process_opening_transactions
 
 
 @app.task
@@ -45,71 +46,75 @@ def initialize_simulation(simulation_id):
     -Initialize the ticker
     -Creates opening transactions
 
+    Each step inserts its rows at once and the whole initialization runs in one database transaction, so a failed
+    initialization leaves nothing behind. The progress is reported to the owner of the simulation.
+
     :param simulation: Simulation object
     :return: None
     """
     simulation = Simulation.objects.get(pk=simulation_id)
-    msg_info = ""
-    msg_error = ""
     if simulation.teams.count() == 0:
         messages.error(simulation.user, _("You need to select at least one team for the simulation!"))
+    elif simulation.simulation_type not in (Simulation.INTRO, Simulation.ADVANCED, Simulation.LIVE,
+                                            Simulation.INDEXED):
+        messages.error(simulation.user, _("Initialization of simulation failed!"))
     else:
-        if simulation.simulation_type == Simulation.INTRO or simulation.simulation_type == Simulation.ADVANCED:
-            msg_info += _("Initialization of simulation running...") + "<br />"
-            # stocks creation
-            print("Initialization of simulation running...")
-            print("Create generic stocks")
-            stocks = create_generic_stocks(simulation.id)
-            if stocks > 0:
-                msg_info += _("%s stocks were created..." % stocks) + "<br />"
-                print("%s stocks created" % stocks)
-            else:
-                msg_error += _("No stocks were created!") + "<br />"
-
-        elif simulation.simulation_type == Simulation.LIVE or simulation.simulation_type == Simulation.INDEXED:
-            if simulation.simulation_type == Simulation.LIVE:
-                full_clock = clock_erpsim(simulation.id, full=True)
-                ticker = simulation.ticker
-                ticker.nb_companies = full_clock['nb_teams']
-                ticker.nb_rounds = full_clock['max_rounds']
-                ticker.nb_days = full_clock['max_days']
-                ticker.save()
-                create_generic_stocks(simulation.id)
-            else:
-                game = create_mssql_simulation(simulation.id)
-                ticker = simulation.ticker
-                ticker.nb_companies = game['nb_teams']
-                ticker.nb_rounds = game['max_rounds']
-                ticker.nb_days = game['max_days']
-                ticker.save()
-                create_generic_stocks(simulation_id, symbols=game['list_of_teams'])
-
-        if simulation.simulation_type in (Simulation.INTRO, Simulation.ADVANCED, Simulation.LIVE, Simulation.INDEXED):
-            liquidity_manager = create_liquidity_manager(simulation.id)
-            if liquidity_manager:
-                msg_info += _("%s was created..." % liquidity_manager.name) + "<br />"
-            else:
-                msg_error += _("No liquidity manager was created!") + "<br />"
-
-            # initialize ticker
-            if simulation.simulation_type == Simulation.INTRO or simulation.simulation_type == Simulation.ADVANCED:
-                for stock in simulation.stocks.all():
-                    create_company_simulation(simulation.id, stock.id)
-
-            elif simulation.simulation_type == Simulation.LIVE or simulation.simulation_type == Simulation.INDEXED:
-                for stock in simulation.stocks.all():
-                    create_company_live(simulation.id, stock.id)
-
-            # opening transactions (gives cash and stock to each team)
-            print("Process openings...............")
-            process_opening_transactions(simulation.id)
-
-            if msg_info != "":
-                msg_info += _("Initialization succeeded! You can start running the simulation.")
-                messages.info(simulation.user, msg_info)
-            if msg_error != "":
-                msg_error += _("There were errors during the initialization process!")
-                messages.error(simulation.user, msg_error)
-
-        else:
-            messages.error(simulation.user, _("Initialization of simulation failed!"))
+        messages.info(simulation.user, _("Initialization of simulation running..."))
+        print("Initialization of simulation running...")
+        try:
+            with transaction.atomic():
+                initialize_market(simulation)
+        except Exception:
+            messages.error(simulation.user, _("There were errors during the initialization process!"))
+            raise
+        messages.info(simulation.user, _("Initialization succeeded! You can start running the simulation."))
+
+
+def initialize_market(simulation):
+    """
+    Creates the stocks, the liquidity manager, the companies and the opening transactions of a simulation.
+
+    .. note:: Call this in a database transaction.
+
+    :param simulation: Simulation object
+    :return: Nothing.
+    """
+    # stocks creation
+    if simulation.simulation_type == Simulation.INTRO or simulation.simulation_type == Simulation.ADVANCED:
+        stocks = create_generic_stocks(simulation.id)
+    elif simulation.simulation_type == Simulation.LIVE:
+        full_clock = clock_erpsim(simulation.id, full=True)
+        ticker = simulation.ticker
+        ticker.nb_companies = full_clock['nb_teams']
+        ticker.nb_rounds = full_clock['max_rounds']
+        ticker.nb_days = full_clock['max_days']
+        ticker.save()
+        stocks = create_generic_stocks(simulation.id)
+    else:
+        game = create_mssql_simulation(simulation.id)
+        ticker = simulation.ticker
+        ticker.nb_companies = game['nb_teams']
+        ticker.nb_rounds = game['max_rounds']
+        ticker.nb_days = game['max_days']
+        ticker.save()
+        stocks = create_generic_stocks(simulation.id, symbols=game['list_of_teams'])
+    if stocks == 0:
+        messages.error(simulation.user, _("No stocks were created!"))
+        raise ValueError("No stocks were created for simulation %s" % simulation.id)
+    messages.info(simulation.user, _("%s stocks were created..." % stocks))
+    print("%s stocks created" % stocks)
+
+    liquidity_manager = create_liquidity_manager(simulation.id)
+    messages.info(simulation.user, _("%s was created..." % liquidity_manager.name))
+
+    # initialize ticker
+    if simulation.simulation_type == Simulation.INTRO or simulation.simulation_type == Simulation.ADVANCED:
+        create_companies_simulation(simulation.id)
+        messages.info(simulation.user, _("The financials of the companies were simulated..."))
+    else:
+        create_companies_live(simulation.id)
+
+    # opening transactions (gives cash and stock to each team)
+    print("Process openings...............")
+    process_opening_transactions(simulation.id)
+    messages.info(simulation.user, _("The opening transactions were processed..."))
@@ -167,7 +167,9 @@ class TeamsSelectionView(SuccessMessageMixin, FormView):
 
 class SimulationCreate(SuccessMessageMixin, CreateView):
     model = Simulation
-    fields = ['code', 'simulation_type', 'capital', 'nb_shares', 'currency', 'transaction_cost', 'variable_transaction_cost']
+    fields = ['code', 'simulation_type', 'capital', 'nb_shares', 'currency', 'transaction_cost', 'variable_transaction_cost',
+              'liquidity_spread', 'liquidity_band_low', 'liquidity_band_high', 'liquidity_price_cap',
+              'liquidity_min_depth']
     success_message = _("The simulation <b>%(code)s</b> was successfully created. You can start using it right now!")
 
     def get_context_data(self, **kwargs):
@@ -191,7 +193,9 @@ class SimulationCreate(SuccessMessageMixin, CreateView):
 
 class SimulationUpdate(SuccessMessageMixin, UpdateView):
     model = Simulation
-    fields = ['code', 'simulation_type', 'capital', 'nb_shares', 'currency', 'transaction_cost', 'variable_transaction_cost']
+    fields = ['code', 'simulation_type', 'capital', 'nb_shares', 'currency', 'transaction_cost', 'variable_transaction_cost',
+              'liquidity_spread', 'liquidity_band_low', 'liquidity_band_high', 'liquidity_price_cap',
+              'liquidity_min_depth']
     success_message = _("The simulation was successfully updated!")
 
     def get_success_url(self):
@@ -436,9 +440,9 @@ class SimulationInitializeView(SuccessMessageMixin, UpdateView):
     def get_form_class(self):
         fields = ['nb_rounds', 'nb_days', 'day_duration']
         if self.simulation.simulation_type == Simulation.INTRO:
-            fields += ['nb_companies', 'initial_value', 'fixed_interest_rate']
+            fields += ['nb_companies', 'initial_value', 'fixed_interest_rate', 'seed']
         elif self.simulation.simulation_type == Simulation.ADVANCED:
-            fields += ['nb_companies', 'initial_value', 'dividend_payoff_rate', 'transaction_costs', 'interest_rate', 'fixed_interest_rate']
+            fields += ['nb_companies', 'initial_value', 'dividend_payoff_rate', 'transaction_costs', 'interest_rate', 'fixed_interest_rate', 'seed']
         elif self.simulation.simulation_type == Simulation.LIVE:
             fields += ['nb_companies', 'dividend_payoff_rate', 'transaction_costs', 'interest_rate',
                        'fixed_interest_rate', 'host', 'port', 'application', 'system', 'client']
@@ -28,7 +28,7 @@ from django.contrib import admin
 # Third-party app imports
 
 # MarMix imports
-from .models import Stock, Quote, Order, Transaction, TransactionLine
+from .models import Stock, Quote, Order, Transaction, TransactionLine, Position
 
 
 class StockAdmin(admin.ModelAdmin):
@@ -51,8 +51,13 @@ class TransactionLineAdmin(admin.ModelAdmin):
     pass
 
 
+class PositionAdmin(admin.ModelAdmin):
+    list_display = ('simulation', 'team', 'asset_type', 'stock', 'quantity', 'amount')
+
+
 admin.site.register(Stock, StockAdmin)
 admin.site.register(Quote, QuoteAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Transaction, TransactionAdmin)
-admin.site.register(TransactionLine, TransactionLineAdmin)
\ No newline at end of file
+admin.site.register(TransactionLine, TransactionLineAdmin)
+admin.site.register(Position, PositionAdmin)
@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+# auction.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Call auction used by the market maker to cross the order book of a stock at a single price.
+"""
+
+# Stdlib imports
+from collections import defaultdict
+
+# Core Django imports
+
+# Third-party app imports
+
+# MarMix imports
+
+
+BID = 'BID'
+ASK = 'ASK'
+
+
+def order_priority(orders, order_type):
+    """
+    Sorts orders by price then time priority. Market orders (without price) come first.
+
+    :param orders: A list of orders of the same type.
+    :param order_type: BID or ASK.
+    :return: A new list of orders.
+    """
+    market = sorted([o for o in orders if o.price is None], key=lambda o: (o.created_at, o.id))
+    if order_type == BID:
+        limit = sorted([o for o in orders if o.price is not None], key=lambda o: (-o.price, o.created_at, o.id))
+    else:
+        limit = sorted([o for o in orders if o.price is not None], key=lambda o: (o.price, o.created_at, o.id))
+    return market + limit
+
+
+def aggregate(orders):
+    """
+    The quantities of orders of the same type: the total of the market orders and the total of each limit price.
+
+    :return: A (market quantity, dict of the quantities by price) tuple.
+    """
+    market = 0
+    quantities = defaultdict(int)
+    for order in orders:
+        if order.price is None:
+            market += order.quantity
+        else:
+            quantities[order.price] += order.quantity
+    return market, quantities
+
+
+def cumulate(prices, quantities, market, descending=False):
+    """
+    The aggregate curve of one side of the book at each price: the market orders plus the limit orders at this price
+    or better (at or below it for the supply, at or above it for the demand).
+
+    :param prices: The sorted limit prices of both sides.
+    :param descending: True to cumulate from the highest price (demand).
+    :return: A list of quantities, in the order of ``prices``.
+    """
+    curve = [0] * len(prices)
+    cumulated = market
+    indices = range(len(prices) - 1, -1, -1) if descending else range(len(prices))
+    for i in indices:
+        cumulated += quantities[prices[i]]
+        curve[i] = cumulated
+    return curve
+
+
+def clearing_price(bids, asks, reference=None):
+    """
+    Finds the price maximising the executable volume.
+
+    The aggregate demand (bids at or above the price) and supply (asks at or below the price) curves are computed in
+    one pass over the sorted limit prices. Ties are broken by the smallest imbalance between demand and supply, then
+    by the distance to the reference price.
+
+    :param bids: The bid orders.
+    :param asks: The ask orders.
+    :param reference: The current price of the stock (used when only market orders are crossing).
+    :return: A (price, volume) tuple, (None, 0) if the book does not cross.
+    """
+    market_demand, bid_qty = aggregate(bids)
+    market_supply, ask_qty = aggregate(asks)
+    prices = sorted(set(bid_qty) | set(ask_qty))
+    if not prices:
+        if reference and market_demand and market_supply:
+            return reference, min(market_demand, market_supply)
+        return None, 0
+
+    supply = cumulate(prices, ask_qty, market_supply)
+    demand = cumulate(prices, bid_qty, market_demand, descending=True)
+
+    best_price = None
+    best_key = None
+    for i, price in enumerate(prices):
+        volume = min(demand[i], supply[i])
+        distance = abs(price - reference) if reference else 0
+        key = (volume, -abs(demand[i] - supply[i]), -distance)
+        if best_key is None or key > best_key:
+            best_key = key
+            best_price = price
+    if best_key[0] == 0:
+        return None, 0
+    return best_price, best_key[0]
+
+
+def allocate(bids, asks, price, volume):
+    """
+    Allocates the cleared volume to the orders by price then time priority.
+
+    Orders of the same team are never crossed together.
+
+    :param bids: The bid orders, sorted with :func:`order_priority`.
+    :param asks: The ask orders, sorted with :func:`order_priority`.
+    :param price: The clearing price.
+    :param volume: The volume to allocate.
+    :return: A list of (sell_order, buy_order, quantity) tuples.
+    """
+    bids = [o for o in bids if o.price is None or o.price >= price]
+    asks = [o for o in asks if o.price is None or o.price <= price]
+    remaining = dict((o.id, o.quantity) for o in bids + asks)
+    fills = []
+    start = 0
+    for ask in asks:
+        while start < len(bids) and remaining[bids[start].id] == 0:
+            start += 1
+        for bid in bids[start:]:
+            if volume == 0 or remaining[ask.id] == 0:
+                break
+            if remaining[bid.id] == 0 or bid.team_id == ask.team_id:
+                continue
+            quantity = min(remaining[ask.id], remaining[bid.id], volume)
+            fills.append((ask, bid, quantity))
+            remaining[ask.id] -= quantity
+            remaining[bid.id] -= quantity
+            volume -= quantity
+        if volume == 0:
+            break
+    return fills
@@ -0,0 +1,493 @@
+# -*- coding: UTF-8 -*-
+# engine.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory order books used by the matching engine.
+
+The book of a stock is held by the matching worker of the stock (see :func:`stocks.tasks.matching_queue`). It is
+loaded from the submitted orders the first time the stock is matched and is then kept up to date by the tasks of the
+worker. The database stays the reference: the matching task always re-reads the resting order before filling it, so
+a stale entry is simply dropped from the book.
+
+The matching worker is also the only writer of the depth of the stock served to the clients: after each change, the
+aggregated price levels of its book (a :class:`BookDepth`) are written to the cache and the levels changed are sent
+to the WebSocket clients, see :func:`publish_depth`.
+"""
+
+# Stdlib imports
+import bisect
+from collections import deque
+
+# Core Django imports
+
+# Third-party app imports
+
+# MarMix imports
+
+
+BID = 'BID'
+ASK = 'ASK'
+
+
+class BookEntry(object):
+    """
+    The part of an order the matching engine needs to rank it.
+    """
+    __slots__ = ('order_id', 'team_id', 'order_type', 'quantity', 'price', 'created_at')
+
+    def __init__(self, order_id, team_id, order_type, quantity, price, created_at):
+        self.order_id = order_id
+        self.team_id = team_id
+        self.order_type = order_type
+        self.quantity = quantity
+        self.price = price
+        self.created_at = created_at
+
+    @classmethod
+    def from_order(cls, order):
+        return cls(order.id, order.team_id, order.order_type, order.quantity, order.price, order.created_at)
+
+    def _key(self):
+        return self.created_at, self.order_id
+    key = property(_key)
+
+    def __repr__(self):
+        return "<BookEntry %s %s %s@%s>" % (self.order_id, self.order_type, self.quantity, self.price)
+
+
+class PriceLevel(object):
+    """
+    All the orders resting at the same price, in time priority.
+    """
+
+    def __init__(self, price):
+        self.price = price
+        self.keys = []
+        self.entries = []
+        self.quantity = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        position = bisect.bisect_right(self.keys, entry.key)
+        self.keys.insert(position, entry.key)
+        self.entries.insert(position, entry)
+        self.quantity += entry.quantity
+
+    def remove(self, entry):
+        position = bisect.bisect_left(self.keys, entry.key)
+        del self.keys[position]
+        del self.entries[position]
+        self.quantity -= entry.quantity
+
+
+class BookSide(object):
+    """
+    One side (bids or asks) of an order book.
+
+    Limit orders are grouped in :class:`PriceLevel` objects whose prices are kept sorted, market orders (without
+    price) wait in their own queue.
+    """
+
+    def __init__(self, order_type):
+        self.order_type = order_type
+        self.levels = {}
+        self.prices = []
+        self.market = PriceLevel(None)
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, order_id):
+        return order_id in self.index
+
+    def add(self, entry):
+        self.remove(entry.order_id)
+        self.index[entry.order_id] = entry
+        if entry.price is None:
+            self.market.add(entry)
+        else:
+            level = self.levels.get(entry.price)
+            if level is None:
+                level = PriceLevel(entry.price)
+                self.levels[entry.price] = level
+                bisect.insort(self.prices, entry.price)
+            level.add(entry)
+        return entry
+
+    def remove(self, order_id):
+        entry = self.index.pop(order_id, None)
+        if entry is None:
+            return None
+        if entry.price is None:
+            self.market.remove(entry)
+        else:
+            level = self.levels[entry.price]
+            level.remove(entry)
+            if not level:
+                del self.levels[entry.price]
+                del self.prices[bisect.bisect_left(self.prices, entry.price)]
+        return entry
+
+    def ordered_prices(self):
+        """
+        Prices from the best to the worst one (highest bid or lowest ask first).
+        """
+        if self.order_type == BID:
+            return reversed(self.prices)
+        return iter(self.prices)
+
+    def _best_price(self):
+        if not self.prices:
+            return None
+        if self.order_type == BID:
+            return self.prices[-1]
+        return self.prices[0]
+    best_price = property(_best_price)
+
+    def limit_orders(self):
+        for price in list(self.ordered_prices()):
+            level = self.levels.get(price)
+            if level:
+                for entry in list(level.entries):
+                    yield entry
+
+    def market_orders(self):
+        for entry in list(self.market.entries):
+            yield entry
+
+    def depth(self, levels=None):
+        """
+        Aggregated limit orders, best price first.
+
+        :param levels: The maximum number of price levels.
+        :return: A list of (price, quantity, number of orders) tuples.
+        """
+        depth = []
+        for price in self.ordered_prices():
+            if levels is not None and len(depth) >= levels:
+                break
+            level = self.levels[price]
+            depth.append((price, level.quantity, len(level)))
+        return depth
+
+
+class OrderBook(object):
+    """
+    Price-time priority order book of a stock.
+    """
+
+    def __init__(self, stock_id):
+        self.stock_id = stock_id
+        self.bids = BookSide(BID)
+        self.asks = BookSide(ASK)
+        self.sequence = 0
+        self.deltas = deque(maxlen=DEPTH_LOG)
+
+    def __len__(self):
+        return len(self.bids) + len(self.asks)
+
+    def side(self, order_type):
+        if order_type == BID:
+            return self.bids
+        return self.asks
+
+    def opposite_side(self, order_type):
+        if order_type == BID:
+            return self.asks
+        return self.bids
+
+    def add(self, order):
+        return self.side(order.order_type).add(BookEntry.from_order(order))
+
+    def remove(self, order_id):
+        entry = self.bids.remove(order_id)
+        if entry is None:
+            entry = self.asks.remove(order_id)
+        return entry
+
+    def update(self, order, submitted=True):
+        """
+        Adds, moves or removes an order depending on its current state. Each change of a price level increments the
+        sequence number of the book and is recorded in its delta log.
+
+        :param order: An order object.
+        :param submitted: False if the order left the book (processed, failed or deleted).
+        """
+        previous = self.remove(order.id)
+        entry = None
+        if submitted and order.quantity > 0:
+            entry = self.add(order)
+        self._record_changes([previous, entry])
+        return entry or previous
+
+    def remove_orders(self, order_ids):
+        """
+        Removes several orders at once (expired orders), recording one change per price level.
+        """
+        removed = [self.remove(order_id) for order_id in order_ids]
+        self._record_changes(removed)
+        return [entry for entry in removed if entry is not None]
+
+    def _record_changes(self, entries):
+        changed = set()
+        for entry in entries:
+            if entry is not None and entry.price is not None:
+                changed.add((entry.order_type, entry.price))
+        for order_type, price in sorted(changed):
+            level = self.side(order_type).levels.get(price)
+            self.sequence += 1
+            if level is None:
+                self.deltas.append((self.sequence, order_type, price, 0, 0))
+            else:
+                self.deltas.append((self.sequence, order_type, price, level.quantity, len(level)))
+
+    def depth(self, levels=None):
+        return {'sequence': self.sequence, 'bids': self.bids.depth(levels), 'asks': self.asks.depth(levels)}
+
+    def deltas_since(self, sequence):
+        return deltas_since(self.deltas, self.sequence, sequence)
+
+    def snapshot(self):
+        """
+        The aggregated price levels of the book, without the orders.
+        """
+        return BookDepth(self.stock_id, self.sequence, self.bids.depth(), self.asks.depth(), len(self.bids),
+                         len(self.asks), list(self.deltas))
+
+    def candidates(self, order):
+        """
+        Resting orders that can trade with an incoming order, best one first.
+
+        A market order takes the limit orders of the other side by price. A limit order first takes the waiting
+        market orders and then the limit orders whose price crosses its own. Orders of the same team never match.
+
+        :param order: The incoming order.
+        :return: A generator of :class:`BookEntry`.
+        """
+        book = self.opposite_side(order.order_type)
+        if order.price is not None:
+            for entry in book.market_orders():
+                if entry.team_id != order.team_id:
+                    yield entry
+        for entry in book.limit_orders():
+            if order.price is not None:
+                if order.order_type == BID and entry.price > order.price:
+                    break
+                if order.order_type == ASK and entry.price < order.price:
+                    break
+            if entry.team_id != order.team_id:
+                yield entry
+
+    def crossing_orders(self):
+        """
+        The bids that can trade with the asks of the book, in time priority: the market bids if there are limit asks,
+        the limit bids if there are market asks or if their price reaches the best ask.
+        """
+        best_ask = self.asks.best_price
+        crossing = []
+        if best_ask is not None:
+            crossing += list(self.bids.market_orders())
+        for entry in self.bids.limit_orders():
+            if len(self.asks.market) or (best_ask is not None and entry.price >= best_ask):
+                crossing.append(entry)
+        return sorted(crossing, key=lambda entry: entry.key)
+
+    def top_of_book(self):
+        return {'best_bid': self.bids.best_price, 'best_ask': self.asks.best_price,
+                'nb_bids': len(self.bids), 'nb_asks': len(self.asks)}
+
+
+def deltas_since(deltas, current, sequence):
+    """
+    The price level changes made after a sequence number.
+
+    :param deltas: The log of the changes.
+    :param current: The sequence number of the book.
+    :param sequence: The last sequence number known by the client.
+    :return: A list of (sequence, order_type, price, quantity, number of orders) tuples, None if the changes are no
+             longer in the log (the client needs a new snapshot).
+    """
+    if sequence > current:
+        return None
+    if sequence == current:
+        return []
+    if not deltas or deltas[0][0] > sequence + 1:
+        return None
+    return [delta for delta in deltas if delta[0] > sequence]
+
+
+class BookDepth(object):
+    """
+    The price levels of an order book, as stored in the cache: (price, quantity, number of orders) by side, best
+    price first, the number of orders of each side and the log of the last changes.
+    """
+
+    def __init__(self, stock_id, sequence, bids, asks, nb_bids, nb_asks, deltas):
+        self.stock_id = stock_id
+        self.sequence = sequence
+        self.bids = bids
+        self.asks = asks
+        self.nb_bids = nb_bids
+        self.nb_asks = nb_asks
+        self.deltas = deltas
+
+    def depth(self, levels=None):
+        return {'sequence': self.sequence, 'bids': self.bids[:levels], 'asks': self.asks[:levels]}
+
+    def deltas_since(self, sequence):
+        return deltas_since(self.deltas, self.sequence, sequence)
+
+    def top_of_book(self):
+        return {'best_bid': self.bids[0][0] if self.bids else None, 'best_ask': self.asks[0][0] if self.asks else None,
+                'nb_bids': self.nb_bids, 'nb_asks': self.nb_asks}
+
+
+DEPTH_LOG = 200
+DEPTH_KEY = 'book-%s'
+# A depth loaded from the database outside of the matching worker is only kept for a while
+DEPTH_TIMEOUT = 60
+
+_books = {}
+_published = {}
+_simulations = {}
+
+
+def load_book(stock_id):
+    """
+    Builds the order book of a stock from its submitted orders.
+    """
+    from .models import Order
+    book = OrderBook(stock_id)
+    for order in Order.objects.filter(stock_id=stock_id, state=Order.SUBMITTED).order_by('created_at', 'id'):
+        book.add(order)
+    return book
+
+
+def get_book(stock_id):
+    """
+    Returns the order book of a stock, loading it on first use.
+
+    .. note:: Only the matching worker of the stock holds its book.
+    """
+    book = _books.get(stock_id)
+    if book is None:
+        book = reload_book(stock_id)
+    return book
+
+
+def update_book(order, submitted=True):
+    """
+    Keeps an already loaded book in line with a saved or deleted order. Books that are not loaded in this process
+    are left alone, they will be built from the database when needed.
+
+    :return: True if the book of the stock is held by this process.
+    """
+    book = _books.get(order.stock_id)
+    if book is None:
+        return False
+    book.update(order, submitted=submitted)
+    return True
+
+
+def reload_book(stock_id):
+    """
+    Builds the order book of a stock again from the database, dropping the one of this process, and publishes its
+    depth. The sequence numbers go on from the depth already published.
+    """
+    from django.core.cache import cache
+    book = load_book(stock_id)
+    published = cache.get(DEPTH_KEY % stock_id)
+    if published is not None:
+        book.sequence = published.sequence + 1
+    _books[stock_id] = book
+    publish_depth(stock_id)
+    return book
+
+
+def reset_books():
+    _books.clear()
+    _published.clear()
+    _simulations.clear()
+
+
+def publish_depth(stock_id):
+    """
+    Writes the depth of the book held by this process to the cache. The depth is written as a whole, with the
+    absolute quantities of its price levels, so the last write is always right. Nothing is written if this process
+    does not hold the book or if the book did not change since its last write.
+
+    The price levels changed since the last write are then published to the simulation of the stock (all the levels
+    if these changes are no longer in the log), see :func:`simulations.streams.publish_book`.
+    """
+    from django.core.cache import cache
+    from simulations.streams import publish_book
+    book = _books.get(stock_id)
+    if book is None or _published.get(stock_id) == book.sequence:
+        return None
+    depth = book.snapshot()
+    cache.set(DEPTH_KEY % stock_id, depth, None)
+    deltas = None
+    if stock_id in _published:
+        deltas = depth.deltas_since(_published[stock_id])
+    _published[stock_id] = book.sequence
+    publish_book(stock_simulation(stock_id), depth, deltas)
+    return depth
+
+
+def stock_simulation(stock_id):
+    """
+    The simulation of a stock, looked up once by process.
+    """
+    from .models import Stock
+    if stock_id not in _simulations:
+        _simulations[stock_id] = Stock.objects.filter(pk=stock_id).values_list('simulation_id', flat=True).first()
+    return _simulations[stock_id]
+
+
+def get_depth(stock_id):
+    """
+    Returns the depth of a stock, used to serve the order book to the clients (see :func:`publish_depth`).
+
+    If the depth is not in the cache, it is loaded from the database and cached for :data:`DEPTH_TIMEOUT` seconds,
+    unless the matching worker writes it first.
+    """
+    from django.core.cache import cache
+    depth = cache.get(DEPTH_KEY % stock_id)
+    if depth is None:
+        depth = load_book(stock_id).snapshot()
+        if not cache.add(DEPTH_KEY % stock_id, depth, DEPTH_TIMEOUT):
+            depth = cache.get(DEPTH_KEY % stock_id) or depth
+    return depth
+
+
+def remove_orders(stock_id, order_ids):
+    """
+    Drops orders that left the book outside of the matching worker (expired or deleted orders) and publishes the
+    depth.
+    """
+    book = get_book(stock_id)
+    removed = book.remove_orders(order_ids)
+    publish_depth(stock_id)
+    return removed
@@ -0,0 +1,105 @@
+# -*- coding: UTF-8 -*-
+# liquidity.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Trading rules of the liquidity manager.
+
+The liquidity manager only trades in a deep enough book, at a price close to the last price of the stock. When the
+spread of the book is too wide, its order is repriced inside the spread instead of being filled. The decision is taken
+from the top of the order book of the matching worker (see :meth:`stocks.engine.OrderBook.top_of_book`), without any
+database query.
+"""
+
+# Stdlib imports
+from collections import namedtuple
+from decimal import Decimal
+
+# Core Django imports
+
+# Third-party app imports
+
+# MarMix imports
+
+
+# Repricing of the orders of the liquidity manager when the spread is too wide
+BID_REPRICING = Decimal('1.1')
+ASK_REPRICING = Decimal('0.9')
+
+Decision = namedtuple('Decision', ['accept', 'sell_price', 'buy_price'])
+
+ACCEPT = Decision(True, None, None)
+REJECT = Decision(False, None, None)
+
+
+def _decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(repr(value))
+
+
+class LiquidityPolicy(object):
+    """
+    The rules applied to the fills of the liquidity manager.
+
+    :param spread: The largest spread, relative to the mid price of the book.
+    :param band_low: The lowest price of a fill, relative to the last price.
+    :param band_high: The highest price of a fill, relative to the last price.
+    :param price_cap: The highest price of a fill.
+    :param min_depth: Each side of the book must hold more orders than this.
+    """
+
+    def __init__(self, spread=0.33, band_low=0.5, band_high=1.5, price_cap=Decimal('655.50'), min_depth=3):
+        self.spread = _decimal(spread)
+        self.band_low = _decimal(band_low)
+        self.band_high = _decimal(band_high)
+        self.price_cap = _decimal(price_cap)
+        self.min_depth = min_depth
+
+    @classmethod
+    def for_simulation(cls, simulation):
+        return cls(simulation.liquidity_spread, simulation.liquidity_band_low, simulation.liquidity_band_high,
+                   simulation.liquidity_price_cap, simulation.liquidity_min_depth)
+
+    def decide(self, top, last_price, price, sell_manager=False, buy_manager=False):
+        """
+        Decides whether a fill of the liquidity manager goes through.
+
+        :param top: The top of the order book (best_bid, best_ask, nb_bids and nb_asks).
+        :param last_price: The last price of the stock.
+        :param price: The price of the fill.
+        :param sell_manager: True if the liquidity manager sells.
+        :param buy_manager: True if the liquidity manager buys.
+        :return: A Decision, with the new price of the orders of the liquidity manager to reprice (None otherwise).
+        """
+        if top['nb_bids'] <= self.min_depth or top['nb_asks'] <= self.min_depth:
+            return REJECT
+        if price > self.price_cap:
+            return REJECT
+        if price > self.band_high * last_price or price < self.band_low * last_price:
+            return REJECT
+        best_bid, best_ask = top['best_bid'], top['best_ask']
+        if not best_bid or not best_ask:
+            return REJECT
+        spread = best_ask - best_bid
+        if spread and spread > (best_ask + best_bid) / 2 * self.spread:
+            # It's too dangerous for the liquidity manager
+            return Decision(False, best_ask * ASK_REPRICING if sell_manager else None,
+                            best_bid * BID_REPRICING if buy_manager else None)
+        return ACCEPT
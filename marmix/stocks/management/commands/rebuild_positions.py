@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+# rebuild_positions.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+# Stdlib imports
+
+# Core Django imports
+from django.core.management.base import BaseCommand, CommandError
+
+# Third-party app imports
+
+# MarMix imports
+from simulations.models import Simulation
+from stocks.models import rebuild_positions
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the positions of the teams from the transaction lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('simulation_id', nargs='*', type=int,
+                            help="Simulation(s) to rebuild (default: all the simulations)")
+
+    def handle(self, *args, **options):
+        simulations = Simulation.objects.all()
+        if options['simulation_id']:
+            simulations = simulations.filter(pk__in=options['simulation_id'])
+            if len(simulations) != len(set(options['simulation_id'])):
+                raise CommandError("Unknown simulation in %s" % options['simulation_id'])
+        for simulation in simulations:
+            positions = rebuild_positions(simulation.id)
+            self.stdout.write("%s: %s positions rebuilt" % (simulation, positions))
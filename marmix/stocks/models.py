@@ -21,20 +21,33 @@
 # along with MarMix. If not, see <http://www.gnu.org/licenses/>.
 
 # Stdlib imports
-from decimal import Decimal, getcontext
+import copy
+from decimal import Decimal, Context
+from collections import OrderedDict
 
 # Core Django imports
-from django.db import models, transaction
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, When, Value, F, Sum
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from django.db import connection
+from django.db import connection, connections
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
 
 # Third-party app imports
 from django_extensions.db.models import TimeStampedModel
 import django_filters
 
 # MarMix imports
-from simulations.models import Simulation, Team, current_sim_day, stock_historical_prices, current_cash, current_shares
-from .tasks import check_matching_orders, set_stock_quote, set_opening_price
+from simulations.models import Simulation, Team, current_sim_day, stock_historical_prices
+from .tasks import check_matching_orders, check_activated_orders, set_opening_price, matching_queue, \
+    remove_book_orders
+from .engine import get_depth, update_book, publish_depth
+from .liquidity import LiquidityPolicy
+from .quotes import buffer_quotes
+from simulations.streams import publish_fills, publish_expired
+from simulations import cache as simulation_cache
 
 
 def dictfetchall(cursor):
@@ -73,6 +86,16 @@ class Stock(TimeStampedModel):
                                 default='0.0000', help_text=_("Current stock price"))
     opening_price = models.DecimalField(verbose_name=_("opening price"), max_digits=24, decimal_places=4,
                                         null=True, blank=True, help_text=_("Opening price"))
+    day_low = models.DecimalField(verbose_name=_("day low"), max_digits=24, decimal_places=4, null=True, blank=True,
+                                  help_text=_("Lowest price of the day of the statistics"))
+    day_high = models.DecimalField(verbose_name=_("day high"), max_digits=24, decimal_places=4, null=True, blank=True,
+                                   help_text=_("Highest price of the day of the statistics"))
+    life_low = models.DecimalField(verbose_name=_("lifetime low"), max_digits=24, decimal_places=4, null=True,
+                                   blank=True, help_text=_("Lowest price since the start of the simulation"))
+    life_high = models.DecimalField(verbose_name=_("lifetime high"), max_digits=24, decimal_places=4, null=True,
+                                    blank=True, help_text=_("Highest price since the start of the simulation"))
+    stats_date = models.IntegerField(verbose_name=_("date of the statistics"), default=0,
+                                     help_text=_("Simulation date (round*100+day) of the day low and high"))
 
     class Meta:
         verbose_name = _('stock')
@@ -97,9 +120,12 @@ class Stock(TimeStampedModel):
             # It's an update and we have the first quotation for this stock
             self.opening_price = self.price
             models.Model.save(self, force_insert, force_update, using, update_fields)
-            set_opening_price.apply_async([self.id, self.price])
+            opening_price = self.price
+            transaction.on_commit(lambda: set_opening_price.apply_async([self.id, opening_price]))
         else:
             models.Model.save(self, force_insert, force_update, using, update_fields)
+        simulation_cache.stock_price.set_on_commit(self.id, self.price)
+        simulation_cache.mark_ranking(self.simulation_id)
 
     def __str__(self):
         return self.symbol
@@ -131,6 +157,50 @@ class Quote(models.Model):
         models.Model.save(self, force_insert, force_update, using, update_fields)
 
 
+class QuoteBar(models.Model):
+    """
+    The quotes of a stock summarized by period (5 seconds, 1 minute or simulation day), updated when the quotes are
+    written (see :func:`stocks.quotes.flush_quotes`).
+    """
+    SECONDS_5 = '5s'
+    MINUTE = '1m'
+    DAY = 'day'
+    PERIOD_CHOICES = (
+        (SECONDS_5, _('5 seconds')),
+        (MINUTE, _('1 minute')),
+        (DAY, _('simulation day')),
+    )
+
+    stock = models.ForeignKey('Stock', verbose_name=_("stock"), related_name="bars", help_text=_("Related stock"))
+    period = models.CharField(verbose_name=_("period"), max_length=3, choices=PERIOD_CHOICES, default=MINUTE,
+                              help_text=_("Period of the bar"))
+    bucket = models.BigIntegerField(verbose_name=_("bucket"),
+                                    help_text=_("Start of the period in seconds since the epoch (date of the "
+                                                "simulation day for a day)"))
+    start = models.DateTimeField(verbose_name=_("start"), help_text=_("Timestamp of the first quote of the bar"))
+    price_open = models.DecimalField(verbose_name=_("open"), max_digits=24, decimal_places=4, default='0.0000',
+                                     help_text=_("First price of the period"))
+    price_high = models.DecimalField(verbose_name=_("high"), max_digits=24, decimal_places=4, default='0.0000',
+                                     help_text=_("Highest price of the period"))
+    price_low = models.DecimalField(verbose_name=_("low"), max_digits=24, decimal_places=4, default='0.0000',
+                                    help_text=_("Lowest price of the period"))
+    price_close = models.DecimalField(verbose_name=_("close"), max_digits=24, decimal_places=4, default='0.0000',
+                                      help_text=_("Last price of the period"))
+    nb_quotes = models.IntegerField(verbose_name=_("quotes"), default=0, help_text=_("Number of quotes"))
+    sim_round = models.IntegerField(verbose_name=_("round"), default=0, help_text=_("Current round"))
+    sim_day = models.IntegerField(verbose_name=_("day"), default=0, help_text=_("Current day"))
+
+    class Meta:
+        verbose_name = _('quote bar')
+        verbose_name_plural = _('quote bars')
+        ordering = ['stock', 'period', 'bucket']
+        unique_together = ('stock', 'period', 'bucket')
+
+    def __str__(self):
+        return "%s %s %s O:%s | H:%s | L:%s | C:%s" % (self.stock_id, self.period, self.bucket, self.price_open,
+                                                       self.price_high, self.price_low, self.price_close)
+
+
 class HistoricalPrice(models.Model):
     """
     A summary of the quotes, updated each sim_day.
@@ -153,6 +223,7 @@ class HistoricalPrice(models.Model):
         verbose_name = _('historical price')
         verbose_name_plural = _('historical prices')
         ordering = ['-sim_round', '-sim_day']
+        unique_together = ('stock', 'sim_round', 'sim_day')
 
     def __str__(self):
         return "%s R%sD%s O:%s | H:%s | L:%s | C:%s | V:%s" % (self.stock, self.sim_round, self.sim_day, self.price_open, self.price_high, self.price_low, self.price_close, self.volume)
@@ -163,6 +234,57 @@ class HistoricalPrice(models.Model):
         models.Model.save(self, force_insert, force_update, using, update_fields)
 
 
+def update_historical_price(stock_id, clock, fills):
+    """
+    Adds fills to the bar of the current day (created with the first fill of the day).
+
+    :param stock_id: The stock id.
+    :param clock: The simulation clock (see :func:`simulations.models.current_sim_day`).
+    :param fills: A list of (price, quantity) tuples, in the order they were settled.
+    :return: Nothing.
+    """
+    prices = [price for price, quantity in fills]
+    volume = sum([quantity for price, quantity in fills])
+    high = Value(max(prices), output_field=models.DecimalField())
+    low = Value(min(prices), output_field=models.DecimalField())
+    bar = HistoricalPrice.objects.filter(stock_id=stock_id, sim_round=clock['sim_round'], sim_day=clock['sim_day'])
+    updates = {'price_high': Greatest('price_high', high), 'price_low': Least('price_low', low),
+               'price_close': prices[-1], 'volume': F('volume') + volume}
+    if not bar.update(**updates):
+        try:
+            with transaction.atomic():
+                models.Model.save(HistoricalPrice(stock_id=stock_id, price_open=prices[0], price_high=max(prices),
+                                                  price_low=min(prices), price_close=prices[-1], volume=volume,
+                                                  sim_round=clock['sim_round'], sim_day=clock['sim_day']))
+        except IntegrityError:
+            # The bar was opened by a concurrent settlement
+            bar.update(**updates)
+
+
+def finalize_historical_prices(simulation_id, sim_round, sim_day):
+    """
+    Closes the bars of a simulation day. The bars are recomputed from the fills of that day only, so that the stored
+    history matches the ledger whatever happened to the incremental updates.
+
+    .. note:: This is called by :func:`tickers.tasks.tick_simulation` on day rollover.
+
+    :return: The number of bars written.
+    """
+    lines = TransactionLine.objects.filter(transaction__simulation_id=simulation_id, transaction__sim_round=sim_round,
+                                           transaction__sim_day=sim_day,
+                                           transaction__transaction_type=Transaction.ORDER,
+                                           asset_type=TransactionLine.STOCKS, quantity__gt=0).order_by(
+        'transaction_id', 'id').values_list('stock_id', 'price', 'quantity')
+    fills = OrderedDict()
+    for stock_id, price, quantity in lines:
+        fills.setdefault(stock_id, []).append((price, quantity))
+    clock = {'sim_round': sim_round, 'sim_day': sim_day}
+    for stock_id, stock_fills in fills.items():
+        HistoricalPrice.objects.filter(stock_id=stock_id, sim_round=sim_round, sim_day=sim_day).delete()
+        update_historical_price(stock_id, clock, stock_fills)
+    return len(fills)
+
+
 class Order(models.Model):
     """
     Orders are made by teams and posted in the order book. They are then processed by the order manager.
@@ -176,13 +298,28 @@ class Order(models.Model):
         (ASK, _('ask')),
     )
 
+    SCHEDULED = 'SCHEDULED'
     SUBMITTED = 'SUBMITTED'
     PROCESSED = 'PROCESSED'
     FAILED = 'FAILED'
+    EXPIRED = 'EXPIRED'
     ORDER_STATE_CHOICES = (
+        (SCHEDULED, _('scheduled')),
         (SUBMITTED, _('submitted')),
         (PROCESSED, _('processed')),
         (FAILED, _('failed')),
+        (EXPIRED, _('expired')),
+    )
+
+    DAY = 'DAY'
+    GTC = 'GTC'
+    IOC = 'IOC'
+    FOK = 'FOK'
+    TIME_IN_FORCE_CHOICES = (
+        (DAY, _('day')),
+        (GTC, _('good till cancelled')),
+        (IOC, _('immediate or cancel')),
+        (FOK, _('fill or kill')),
     )
 
     stock = models.ForeignKey('Stock', verbose_name=_("stock"), related_name="orders", help_text=_("Related stock"))
@@ -200,11 +337,21 @@ class Order(models.Model):
     sim_round = models.IntegerField(verbose_name=_("round"), default=0, help_text=_("Current round"))
     sim_day = models.IntegerField(verbose_name=_("day"), default=0, help_text=_("Current day"))
     timestamp = models.DateTimeField(verbose_name=_("updated"), auto_now=True, help_text=_("Last update of the order"))
+    activate_at = models.DateTimeField(verbose_name=_("activation"), null=True, blank=True,
+                                       help_text=_("Submission time of a scheduled order"))
+    time_in_force = models.CharField(verbose_name=_("time in force"), max_length=3, choices=TIME_IN_FORCE_CHOICES,
+                                     default=GTC, help_text=_("How long the order stays in the book (day, good till "
+                                                              "cancelled, immediate or cancel, fill or kill)"))
+    reserved_quantity = models.IntegerField(verbose_name=_("shares reserved"), default=0,
+                                            help_text=_("Shares reserved for an ask order while it is open"))
+    reserved_amount = models.DecimalField(verbose_name=_("cash reserved"), max_digits=14, decimal_places=4,
+                                          default='0.0000', help_text=_("Cash reserved for a bid order while it is open"))
 
     class Meta:
         verbose_name = _('order')
         verbose_name_plural = _('orders')
         ordering = ['price', 'created_at']
+        index_together = [['state', 'activate_at']]
 
     def __str__(self):
         if self.order_type == self.BID:
@@ -214,15 +361,111 @@ class Order(models.Model):
         return "%s: %s@%s" % (self.stock, quantity, self.price)
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        self.sim_round = current_sim_day(self.stock.simulation_id)['sim_round']
-        self.sim_day = current_sim_day(self.stock.simulation_id)['sim_day']
+        current = current_sim_day(self.stock.simulation_id)
+        self.sim_round = current['sim_round']
+        self.sim_day = current['sim_day']
         if self.pk is None:
-            self.state = self.SUBMITTED
-        if self.state == self.SUBMITTED:
+            if self.activate_at and self.activate_at > timezone.now():
+                self.state = self.SCHEDULED
+            else:
+                self.state = self.SUBMITTED
+        if self.state == self.SCHEDULED:
+            # Submitted by activate_scheduled_orders when its time comes
+            models.Model.save(self, force_insert, force_update, using, update_fields)
+        elif self.state == self.SUBMITTED:
             models.Model.save(self, force_insert, force_update, using, update_fields)
-            check_matching_orders.apply_async([self.id])
+            notify_book(self)
+            order_id, queue = self.id, matching_queue(self.stock_id)
+            transaction.on_commit(lambda: check_matching_orders.apply_async([order_id], queue=queue))
         else:
             models.Model.save(self, force_insert, force_update, using, update_fields)
+            notify_book(self, submitted=False)
+
+    def delete(self, using=None, keep_parents=False):
+        notify_book(self, submitted=False)
+        if self.state in (self.SUBMITTED, self.SCHEDULED):
+            release_reservations(self.stock.simulation_id, [self])
+        models.Model.delete(self, using, keep_parents)
+
+
+def notify_book(order, submitted=True):
+    """
+    Keeps the order book of the matching worker and the depth in line with an order, the depth pushes the change to
+    the clients (see :func:`stocks.engine.publish_depth`).
+
+    The book is only changed once the database transaction is committed, so that a settlement rolled back leaves it
+    as it is. In the matching worker of the stock, the book is updated and its depth is published. Elsewhere, an order
+    leaving the book is sent to the matching worker (an order entering the book is sent there by :meth:`Order.save`).
+
+    :param order: An order object.
+    :param submitted: False if the order left the book.
+    """
+    stock_id, state = order.stock_id, copy.copy(order)
+
+    def change_book():
+        if update_book(state, submitted=submitted):
+            publish_depth(stock_id)
+        elif not submitted:
+            remove_book_orders.apply_async([stock_id, [state.id]], queue=matching_queue(stock_id))
+    transaction.on_commit(change_book)
+
+
+def activate_scheduled_orders(now):
+    """
+    Submits the scheduled orders whose activation time is reached.
+
+    The due orders are locked and switched to SUBMITTED with a single UPDATE, they take their time priority when they
+    enter the book. They are then matched in activation order by one task per matching queue.
+
+    .. note:: This is called by :func:`tickers.tasks.main_ticker_task` on each tick.
+
+    :param now: The time of the tick.
+    :return: The number of orders submitted.
+    """
+    with transaction.atomic():
+        due = Order.objects.select_for_update().filter(state=Order.SCHEDULED, activate_at__lte=now)
+        order_ids = list(due.order_by('activate_at', 'id').values_list('id', flat=True))
+        if not order_ids:
+            return 0
+        Order.objects.filter(pk__in=order_ids).update(state=Order.SUBMITTED, created_at=now, timestamp=now)
+        orders = Order.objects.select_related('stock').filter(pk__in=order_ids).order_by('activate_at', 'id')
+        lanes = OrderedDict()
+        for order in orders:
+            notify_book(order)
+            lanes.setdefault(matching_queue(order.stock_id), []).append(order.id)
+        for queue, lane_order_ids in lanes.items():
+            transaction.on_commit(lambda queue=queue, lane_order_ids=lane_order_ids:
+                                  check_activated_orders.apply_async([lane_order_ids], queue=queue))
+    return len(order_ids)
+
+
+@transaction.atomic
+def expire_day_orders(simulation_id):
+    """
+    Expires the open DAY orders of all the teams of a simulation with a single UPDATE and releases their reservations
+    in the same database transaction. Once it is committed, the orders are dropped from the order books by the
+    matching worker of each stock (see :func:`stocks.tasks.remove_book_orders`).
+
+    .. note:: This is called by :func:`tickers.tasks.tick_simulation` on day rollover.
+
+    :return: The number of orders expired.
+    """
+    cursor = connection.cursor()
+    cursor.execute('UPDATE stocks_order o SET state=%s, timestamp=%s FROM stocks_stock s '
+                   'WHERE o.stock_id=s.id AND s.simulation_id=%s AND o.time_in_force=%s AND o.state IN (%s, %s) '
+                   'RETURNING o.id, o.stock_id, o.team_id, o.order_type, o.reserved_quantity, o.reserved_amount',
+                   [Order.EXPIRED, timezone.now(), simulation_id, Order.DAY, Order.SUBMITTED, Order.SCHEDULED])
+    expired = OrderedDict()
+    releases = []
+    for order_id, stock_id, team_id, order_type, reserved_quantity, reserved_amount in cursor.fetchall():
+        expired.setdefault(stock_id, []).append(order_id)
+        releases.append((team_id, order_type, stock_id, -reserved_quantity, -reserved_amount))
+    change_reservations(simulation_id, releases)
+    for stock_id, order_ids in expired.items():
+        transaction.on_commit(lambda stock_id=stock_id, order_ids=order_ids: remove_book_orders.apply_async(
+            [stock_id, order_ids], queue=matching_queue(stock_id)))
+        publish_expired(simulation_id, stock_id, order_ids)
+    return sum([len(order_ids) for order_ids in expired.values()])
 
 
 class Transaction(models.Model):
@@ -255,8 +498,9 @@ class Transaction(models.Model):
         ordering = ['-fulfilled_at']
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        self.sim_round = current_sim_day(self.simulation_id)['sim_round']
-        self.sim_day = current_sim_day(self.simulation_id)['sim_day']
+        current = current_sim_day(self.simulation_id)
+        self.sim_round = current['sim_round']
+        self.sim_day = current['sim_day']
         models.Model.save(self, force_insert, force_update, using, update_fields)
 
     def __str__(self):
@@ -297,87 +541,524 @@ class TransactionLine(models.Model):
     def __str__(self):
         return "%s-%s" % (self.transaction_id, self.id)
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        is_new = self.pk is None
+        models.Model.save(self, force_insert, force_update, using, update_fields)
+        if is_new:
+            update_positions([self])
+
+
+class Position(models.Model):
+    """
+    Running total of the transaction lines of a team for one asset (a stock or a cash bucket).
+
+    Positions are updated in the same database transaction as the lines they summarize, so balances and holdings can
+    be read without going through the whole ledger. They can be rebuilt from the ledger with :func:`rebuild_positions`
+    (``manage.py rebuild_positions``).
+
+    The open orders reserve what they need when they are placed (see :func:`reserve_order`): the ask orders reserve
+    shares on the position of the stock and the bid orders reserve cash on the CASH position of the team. The CASH
+    position also holds the balance of the team (all the assets but the stocks), so the cash available is read from a
+    single row.
+    """
+    simulation = models.ForeignKey(Simulation, verbose_name=_("simulation"), related_name="positions",
+                                   help_text=_("Related simulation"))
+    team = models.ForeignKey(Team, verbose_name=_("team"), related_name="positions", help_text=_("Team"))
+    stock = models.ForeignKey('Stock', verbose_name=_("stock"), related_name="positions", null=True, blank=True,
+                              help_text=_("Related stock"))
+    asset_type = models.CharField(verbose_name=_("type of asset"), max_length=20,
+                                  choices=TransactionLine.ASSET_TYPE_CHOICES, default=TransactionLine.STOCKS,
+                                  help_text=_("The type of asset"))
+    quantity = models.IntegerField(verbose_name=_("quantity"), default=0, help_text=_("Quantity held"))
+    amount = models.DecimalField(verbose_name=_("amount"), max_digits=14, decimal_places=4,
+                                 default='0.0000', help_text=_("Total amount (signed)"))
+    reserved_quantity = models.IntegerField(verbose_name=_("reserved quantity"), default=0,
+                                            help_text=_("Shares reserved by the open ask orders"))
+    reserved_amount = models.DecimalField(verbose_name=_("reserved amount"), max_digits=14, decimal_places=4,
+                                          default='0.0000', help_text=_("Cash reserved by the open bid orders"))
+    balance = models.DecimalField(verbose_name=_("balance"), max_digits=14, decimal_places=4, default='0.0000',
+                                  help_text=_("Cash balance of the team (CASH position only)"))
+
+    class Meta:
+        verbose_name = _('position')
+        verbose_name_plural = _('positions')
+        unique_together = ('simulation', 'team', 'asset_type', 'stock')
+        ordering = ['team', 'asset_type', 'stock']
+
+    def __str__(self):
+        return "%s %s %s: %s (%s)" % (self.team_id, self.asset_type, self.stock_id, self.quantity, self.amount)
+
+
+@receiver(post_migrate)
+def create_position_indexes(sender, using, **kwargs):
+    """
+    Creates the unique index of the positions without a stock (the cash buckets).
+
+    The unique_together of :class:`Position` doesn't apply to the rows where the stock is NULL, so two concurrent
+    transactions could both create the CASH position of a team.
+    """
+    if sender.label != 'stocks' or connections[using].vendor != 'postgresql':
+        return
+    cursor = connections[using].cursor()
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS stocks_position_null_stock_uniq '
+                   'ON stocks_position (simulation_id, team_id, asset_type) WHERE stock_id IS NULL')
+
+
+# getcontext().prec is lowered in some tasks, positions are always summed with a full precision context
+AMOUNT_CONTEXT = Context(prec=28)
+
+
+def round_amount(amount):
+    """
+    Rounds an amount the way it is stored in a transaction line.
+    """
+    return Decimal(amount or 0).quantize(Decimal('0.0001'), context=AMOUNT_CONTEXT)
+
+
+def lock_positions(simulation_id, exclusive=False):
+    """
+    Locks the positions of a simulation for the current database transaction, through the row of the simulation.
+
+    The settlements and the reservations take a shared lock (FOR KEY SHARE) and run side by side, a rebuild of the
+    positions takes an exclusive lock (FOR UPDATE) and waits for them: no fill and no reservation is written while
+    the positions are deleted and created again.
+
+    :param simulation_id: The simulation id.
+    :param exclusive: True to rebuild the positions.
+    :return: Nothing.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT id FROM simulations_simulation WHERE id=%s FOR ' + ('UPDATE' if exclusive else 'KEY SHARE'),
+                   [simulation_id])
+
+
+def update_positions(lines):
+    """
+    Applies transaction lines to the positions of the teams (one update per position touched). The lines of the
+    assets other than the stocks are also added to the balance of the CASH position of the team.
+
+    .. note:: Call this in the database transaction that saves the lines.
+
+    :param lines: A list of TransactionLine objects.
+    :return: Nothing.
+    """
+    deltas = OrderedDict()
+    for simulation_id in set([line.transaction.simulation_id for line in lines]):
+        lock_positions(simulation_id)
+    for line in lines:
+        key = (line.transaction.simulation_id, line.team_id, line.asset_type, line.stock_id)
+        quantity, amount, balance = deltas.get(key, (0, 0, 0))
+        deltas[key] = (quantity + line.quantity, AMOUNT_CONTEXT.add(amount, round_amount(line.amount)), balance)
+        if line.asset_type != TransactionLine.STOCKS:
+            key = (line.transaction.simulation_id, line.team_id, TransactionLine.CASH, None)
+            quantity, amount, balance = deltas.get(key, (0, 0, 0))
+            deltas[key] = (quantity, amount, AMOUNT_CONTEXT.add(balance, round_amount(line.amount)))
+    for (simulation_id, team_id, asset_type, stock_id), (quantity, amount, balance) in deltas.items():
+        updated = Position.objects.filter(simulation_id=simulation_id, team_id=team_id, asset_type=asset_type,
+                                          stock_id=stock_id).update(quantity=F('quantity') + quantity,
+                                                                    amount=F('amount') + amount,
+                                                                    balance=F('balance') + balance)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    Position.objects.create(simulation_id=simulation_id, team_id=team_id, asset_type=asset_type,
+                                            stock_id=stock_id, quantity=quantity, amount=amount, balance=balance)
+            except IntegrityError:
+                # Created by a concurrent transaction in the meantime
+                Position.objects.filter(simulation_id=simulation_id, team_id=team_id, asset_type=asset_type,
+                                        stock_id=stock_id).update(quantity=F('quantity') + quantity,
+                                                                  amount=F('amount') + amount,
+                                                                  balance=F('balance') + balance)
+    for simulation_id in set([key[0] for key in deltas]):
+        simulation_cache.mark_ranking(simulation_id)
+
+
+def record_lines(lines):
+    """
+    Inserts transaction lines at once and applies them to the positions.
+
+    :param lines: A list of TransactionLine objects.
+    :return: Nothing.
+    """
+    TransactionLine.objects.bulk_create(lines)
+    update_positions(lines)
+
+
+@transaction.atomic
+def rebuild_positions(simulation_id, stock_id=None):
+    """
+    Recomputes the positions of a simulation (or of one of its stocks) from the transaction lines.
+
+    :param simulation_id: The simulation id.
+    :param stock_id: Only rebuild the positions of this stock.
+    :return: The number of positions created.
+    """
+    lock_positions(simulation_id, exclusive=True)
+    positions = Position.objects.filter(simulation_id=simulation_id)
+    lines = TransactionLine.objects.filter(transaction__simulation_id=simulation_id)
+    if stock_id:
+        positions = positions.filter(stock_id=stock_id)
+        lines = lines.filter(stock_id=stock_id)
+    positions.delete()
+    totals = lines.values('team_id', 'asset_type', 'stock_id').annotate(
+        total_quantity=Sum('quantity'), total_amount=Sum('amount')).order_by('team_id')
+    Position.objects.bulk_create([Position(simulation_id=simulation_id, team_id=total['team_id'],
+                                           asset_type=total['asset_type'], stock_id=total['stock_id'],
+                                           quantity=total['total_quantity'] or 0,
+                                           amount=total['total_amount'] or 0) for total in totals])
+    update_balances(simulation_id)
+    restore_reservations(simulation_id, stock_id)
+    simulation_cache.mark_ranking(simulation_id)
+    return len(totals)
+
+
+def update_balances(simulation_id):
+    """
+    Recomputes the balance of the CASH positions of a simulation from the other positions of the teams.
+
+    :param simulation_id: The simulation id.
+    :return: Nothing.
+    """
+    cursor = connection.cursor()
+    cursor.execute('UPDATE stocks_position p SET balance=COALESCE((SELECT SUM(c.amount) FROM stocks_position c '
+                   'WHERE c.simulation_id=p.simulation_id AND c.team_id=p.team_id AND c.asset_type<>%s), 0) '
+                   'WHERE p.simulation_id=%s AND p.asset_type=%s AND p.stock_id IS NULL',
+                   [TransactionLine.STOCKS, simulation_id, TransactionLine.CASH])
+
+
+def restore_reservations(simulation_id, stock_id=None):
+    """
+    Recomputes the shares and the cash reserved on the positions of a simulation (or of one of its stocks) from the
+    open orders.
+
+    :param simulation_id: The simulation id.
+    :param stock_id: Only restore the shares reserved for this stock (the cash is left as it is).
+    :return: Nothing.
+    """
+    cursor = connection.cursor()
+    params = [Order.ASK, Order.SUBMITTED, Order.SCHEDULED, simulation_id]
+    stock_filter = ''
+    if stock_id:
+        stock_filter = 'AND o.stock_id=%s '
+        params.append(stock_id)
+    reserved = ('SELECT o.team_id, o.stock_id, SUM(o.reserved_quantity) AS quantity '
+                'FROM stocks_order o INNER JOIN stocks_stock s ON o.stock_id=s.id '
+                'WHERE o.order_type=%s AND o.state IN (%s, %s) AND s.simulation_id=%s ')
+    cursor.execute('UPDATE stocks_position p SET reserved_quantity=r.quantity '
+                   'FROM (' + reserved + stock_filter + 'GROUP BY o.team_id, o.stock_id) r '
+                   'WHERE p.simulation_id=%s AND p.asset_type=%s AND p.team_id=r.team_id AND p.stock_id=r.stock_id',
+                   params + [simulation_id, TransactionLine.STOCKS])
+    if stock_id:
+        return
+    Position.objects.filter(simulation_id=simulation_id, asset_type=TransactionLine.CASH).update(reserved_amount=0)
+    cursor.execute('UPDATE stocks_position p SET reserved_amount=r.amount '
+                   'FROM (SELECT o.team_id, SUM(o.reserved_amount) AS amount '
+                   'FROM stocks_order o INNER JOIN stocks_stock s ON o.stock_id=s.id '
+                   'WHERE o.order_type=%s AND o.state IN (%s, %s) AND s.simulation_id=%s GROUP BY o.team_id) r '
+                   'WHERE p.simulation_id=%s AND p.asset_type=%s AND p.stock_id IS NULL AND p.team_id=r.team_id',
+                   [Order.BID, Order.SUBMITTED, Order.SCHEDULED, simulation_id, simulation_id,
+                    TransactionLine.CASH])
+
+
+def transaction_costs(simulation, quantity, price):
+    """
+    The costs paid by a team for a fill: the fixed cost of an order plus the variable cost of the amount exchanged.
+    """
+    costs = Decimal(simulation.transaction_cost) if simulation.transaction_cost > 0 else Decimal(0)
+    if simulation.variable_transaction_cost > 0:
+        costs += Decimal(quantity * float(price) * simulation.variable_transaction_cost / 100)
+    return costs
+
+
+def bid_amount(simulation, quantity, price):
+    """
+    The cash needed by a bid order, transaction costs included.
+    """
+    return round_amount(AMOUNT_CONTEXT.multiply(quantity, price) + transaction_costs(simulation, quantity, price))
+
+
+def reserve_order(order):
+    """
+    Reserves the shares of a new ask order, or the cash of a new bid order (at its limit price, or at the last price
+    of the stock for a market order, transaction costs included), with a single conditional UPDATE of the position.
+    The reservation is recorded on the order, which still has to be saved in the same database transaction.
+
+    :param order: An unsaved order object.
+    :return: False if the team does not have enough shares or cash left (nothing is reserved).
+    """
+    simulation_id = order.stock.simulation_id
+    lock_positions(simulation_id)
+    if order.order_type == Order.ASK:
+        reserved = Position.objects.filter(simulation_id=simulation_id, team_id=order.team_id,
+                                           asset_type=TransactionLine.STOCKS, stock_id=order.stock_id,
+                                           quantity__gte=F('reserved_quantity') + order.quantity).update(
+            reserved_quantity=F('reserved_quantity') + order.quantity)
+        if reserved:
+            order.reserved_quantity = order.quantity
+        return reserved > 0
+    price = order.price or simulation_cache.stock_price.get(order.stock_id) or 0
+    amount = bid_amount(order.stock.simulation, order.quantity, price)
+    reserved = Position.objects.filter(simulation_id=simulation_id, team_id=order.team_id,
+                                       asset_type=TransactionLine.CASH, stock_id=None,
+                                       balance__gte=F('reserved_amount') + amount).update(
+        reserved_amount=F('reserved_amount') + amount)
+    if reserved:
+        order.reserved_amount = amount
+    return reserved > 0
+
+
+def change_reservations(simulation_id, changes):
+    """
+    Applies changes of the reservations to the positions (one update per position touched).
+
+    :param changes: A list of (team_id, order_type, stock_id, quantity, amount) tuples, negative to release.
+    :return: Nothing.
+    """
+    deltas = OrderedDict()
+    for team_id, order_type, stock_id, quantity, amount in changes:
+        if order_type == Order.ASK and quantity:
+            key = (team_id, TransactionLine.STOCKS, stock_id)
+            deltas[key] = (deltas.get(key, (0, 0))[0] + quantity, 0)
+        elif order_type == Order.BID and amount:
+            key = (team_id, TransactionLine.CASH, None)
+            deltas[key] = (0, AMOUNT_CONTEXT.add(deltas.get(key, (0, 0))[1], amount))
+    if deltas:
+        lock_positions(simulation_id)
+    for (team_id, asset_type, stock_id), (quantity, amount) in deltas.items():
+        Position.objects.filter(simulation_id=simulation_id, team_id=team_id, asset_type=asset_type,
+                                stock_id=stock_id).update(reserved_quantity=F('reserved_quantity') + quantity,
+                                                          reserved_amount=F('reserved_amount') + amount)
+
+
+def release_reservations(simulation_id, orders):
+    """
+    Releases the whole reservation of orders that leave the book without being filled (cancelled or expired).
+    """
+    change_reservations(simulation_id, [(order.team_id, order.order_type, order.stock_id, -order.reserved_quantity,
+                                         -Decimal(order.reserved_amount)) for order in orders])
+
+
+def pay_dividends(simulation_id, sim_round):
+    """
+    Pays the dividends of a round to the holders of all the stocks of a simulation.
+
+    The holdings at the end of the round are the current positions minus the stock lines of the later rounds. The
+    dividend lines of all the stocks are inserted by a single INSERT ... SELECT into one EOR transaction (booked on the
+    first day of the next round) and applied to the positions with one UPDATE and one INSERT, then to the balances of
+    the teams with one more UPDATE. The simulation row is locked while paying, a round already paid is not paid again.
+
+    :param simulation_id: The simulation id.
+    :param sim_round: The round of the dividends (see :class:`tickers.models.CompanyShare`).
+    :return: The number of dividend lines created, None if the round was already paid.
+    """
+    with transaction.atomic():
+        simulation = Simulation.objects.select_for_update().get(pk=simulation_id)
+        if Transaction.objects.filter(simulation_id=simulation_id, transaction_type=Transaction.EOR,
+                                      sim_round=sim_round + 1).exists():
+            return None
+        payment = Transaction(simulation=simulation, transaction_type=Transaction.EOR, sim_round=sim_round + 1,
+                              sim_day=0)
+        # Transaction.save() would book the payment on the current day
+        models.Model.save(payment)
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO stocks_transactionline (transaction_id, stock_id, team_id, quantity, price, amount, '
+                       'asset_type) '
+                       'SELECT %s, h.stock_id, h.team_id, h.quantity, cs.dividends, h.quantity*cs.dividends, %s '
+                       'FROM (SELECT p.stock_id, p.team_id, p.quantity - COALESCE('
+                       '(SELECT SUM(tl.quantity) FROM stocks_transactionline tl '
+                       'INNER JOIN stocks_transaction t ON tl.transaction_id=t.id '
+                       'WHERE tl.team_id=p.team_id AND tl.stock_id=p.stock_id AND tl.asset_type=%s '
+                       'AND t.simulation_id=p.simulation_id AND t.sim_round>%s), 0) AS quantity '
+                       'FROM stocks_position p WHERE p.simulation_id=%s AND p.asset_type=%s) h '
+                       'INNER JOIN tickers_tickercompany c ON c.stock_id=h.stock_id '
+                       'INNER JOIN tickers_companyshare cs ON cs.company_id=c.id AND cs.sim_round=%s '
+                       'WHERE h.quantity>0',
+                       [payment.id, TransactionLine.DIVIDENDS, TransactionLine.STOCKS, sim_round, simulation_id,
+                        TransactionLine.STOCKS, sim_round])
+        nb_lines = cursor.rowcount
+        totals = ('SELECT team_id, stock_id, SUM(quantity) AS quantity, SUM(amount) AS amount '
+                  'FROM stocks_transactionline WHERE transaction_id=%s GROUP BY team_id, stock_id')
+        cursor.execute('UPDATE stocks_position p SET quantity=p.quantity+d.quantity, amount=p.amount+d.amount '
+                       'FROM (' + totals + ') d '
+                       'WHERE p.simulation_id=%s AND p.asset_type=%s AND p.team_id=d.team_id '
+                       'AND p.stock_id=d.stock_id',
+                       [payment.id, simulation_id, TransactionLine.DIVIDENDS])
+        cursor.execute('INSERT INTO stocks_position (simulation_id, team_id, stock_id, asset_type, quantity, amount, '
+                       'reserved_quantity, reserved_amount, balance) '
+                       'SELECT %s, d.team_id, d.stock_id, %s, d.quantity, d.amount, 0, 0, 0 FROM (' + totals + ') d '
+                       'WHERE NOT EXISTS (SELECT 1 FROM stocks_position p WHERE p.simulation_id=%s '
+                       'AND p.asset_type=%s AND p.team_id=d.team_id AND p.stock_id=d.stock_id)',
+                       [simulation_id, TransactionLine.DIVIDENDS, payment.id, simulation_id,
+                        TransactionLine.DIVIDENDS])
+        cursor.execute('UPDATE stocks_position p SET balance=p.balance+d.amount '
+                       'FROM (SELECT team_id, SUM(amount) AS amount FROM stocks_transactionline '
+                       'WHERE transaction_id=%s GROUP BY team_id) d '
+                       'WHERE p.simulation_id=%s AND p.asset_type=%s AND p.stock_id IS NULL AND p.team_id=d.team_id',
+                       [payment.id, simulation_id, TransactionLine.CASH])
+        simulation_cache.mark_ranking(simulation_id)
+    return nb_lines
+
+
+@transaction.atomic
+def reprice_opening_transactions(simulation_id, prices=None):
+    """
+    Values the initial stock deposits of a simulation at the opening prices.
+
+    All the stocks of the simulation are repriced at once at the opening price stored on the stocks (the lines already
+    at this price are left untouched) and the positions are rebuilt. The opening price of a single stock only changes
+    the amount of its STOCKS positions (the CASH balances leave the stocks out): each stock of ``prices`` is repriced
+    with one statement that updates its INITIAL lines and adds the difference to the positions, under the shared lock
+    of the positions.
+
+    :param simulation_id: The simulation id.
+    :param prices: A dict of opening prices by stock id (all the stocks with an opening price if not set).
+    :return: The number of lines repriced.
+    """
+    cursor = connection.cursor()
+    if prices is None:
+        lock_positions(simulation_id, exclusive=True)
+        cursor.execute('UPDATE stocks_transactionline tl SET price=s.opening_price, amount=tl.quantity*s.opening_price '
+                       'FROM stocks_transaction t, stocks_stock s '
+                       'WHERE tl.transaction_id=t.id AND t.transaction_type=%s AND tl.stock_id=s.id '
+                       'AND s.simulation_id=%s AND s.opening_price IS NOT NULL '
+                       'AND tl.price IS DISTINCT FROM s.opening_price',
+                       [Transaction.INITIAL, simulation_id])
+        repriced = cursor.rowcount
+        if repriced:
+            rebuild_positions(simulation_id)
+        return repriced
+    lock_positions(simulation_id)
+    repriced = 0
+    for stock_id, price in prices.items():
+        # The old amount of a line is read from its own row joined as it was before the update
+        cursor.execute('WITH lines AS (UPDATE stocks_transactionline tl SET price=%s, amount=tl.quantity*%s '
+                       'FROM stocks_transaction t, stocks_transactionline old '
+                       'WHERE tl.transaction_id=t.id AND t.transaction_type=%s AND tl.stock_id=%s AND old.id=tl.id '
+                       'AND tl.price IS DISTINCT FROM %s '
+                       'RETURNING tl.team_id, tl.amount - COALESCE(old.amount, 0) AS delta), '
+                       'positions AS (UPDATE stocks_position p SET amount=p.amount + d.delta '
+                       'FROM (SELECT team_id, SUM(delta) AS delta FROM lines GROUP BY team_id) d '
+                       'WHERE p.simulation_id=%s AND p.team_id=d.team_id AND p.asset_type=%s AND p.stock_id=%s) '
+                       'SELECT COUNT(*) FROM lines',
+                       [price, price, Transaction.INITIAL, stock_id, price, simulation_id, TransactionLine.STOCKS,
+                        stock_id])
+        repriced += cursor.fetchone()[0]
+    if repriced:
+        simulation_cache.mark_ranking(simulation_id)
+    return repriced
+
 
 def create_generic_stocks(simulation_id, symbols=None):
+    """
+    Creates the stocks of a simulation with a single insert.
+
+    :param simulation_id: The simulation id.
+    :param symbols: The symbols of the stocks (A, B, C... for each company of the ticker if not set).
+    :return: The number of stocks created.
+    """
     simulation = Simulation.objects.get(pk=simulation_id)
     char_shift = 65
-    stocks_created = 0
-    if symbols:
-        for symbol in symbols:
-            stock = Stock(simulation=simulation, symbol=symbol, name='Company %s' % symbol, quantity=simulation.nb_shares)
-            stock.save()
-            stocks_created += 1
-    else:
-        for i in range(0, simulation.ticker.nb_companies):
-            symbol = chr(i+char_shift)
-            stock = Stock(simulation=simulation, symbol=symbol, name='Company %s' % symbol, quantity=simulation.nb_shares)
-            stock.save()
-            stocks_created += 1
-    return stocks_created
+    if not symbols:
+        symbols = [chr(i + char_shift) for i in range(0, simulation.ticker.nb_companies)]
+    Stock.objects.bulk_create([Stock(simulation=simulation, symbol=symbol, name='Company %s' % symbol,
+                                     quantity=simulation.nb_shares) for symbol in symbols])
+    return len(symbols)
+
+
+def set_initial_prices(prices):
+    """
+    Sets the price and the opening price of new stocks with a single UPDATE (the opening transactions are then
+    created at this price, see :func:`process_opening_transactions`).
+
+    :param prices: A dict of prices by stock id.
+    :return: Nothing.
+    """
+    if not prices:
+        return
+    price = Case(*[When(pk=stock_id, then=Value(stock_price)) for stock_id, stock_price in prices.items()],
+                 output_field=models.DecimalField(max_digits=24, decimal_places=4))
+    Stock.objects.filter(pk__in=list(prices)).update(price=price, opening_price=price)
+    for stock_id, stock_price in prices.items():
+        simulation_cache.stock_price.set_on_commit(stock_id, round_amount(stock_price))
+    for simulation_id in set(Stock.objects.filter(pk__in=list(prices)).values_list('simulation_id', flat=True)):
+        simulation_cache.mark_ranking(simulation_id)
+
+
+@transaction.atomic
+def set_stock_price(stock_id, price):
+    """
+    Sets the price of a stock outside of a quote (call auction). Only the price, and the opening price of a stock
+    priced for the first time, are written: the lows and highs kept by :func:`stocks.quotes.flush_quotes` are left
+    as they are.
+
+    :return: The stock object.
+    """
+    stock = Stock.objects.select_for_update().get(pk=stock_id)
+    stock.price = price
+    stock.save(update_fields=['price', 'opening_price'])
+    return stock
 
 
 def process_opening_transactions(simulation_id):
-    getcontext().prec = 4
+    """
+    Deposits the initial cash and stocks of the teams of a simulation: the players get the capital and 10% of each
+    stock shared equally, the liquidity manager gets the rest.
+
+    The lines are inserted at once in two INITIAL transactions (one for the cash, one for the stocks) and the
+    positions are then built from the ledger.
+
+    :param simulation_id: The simulation id.
+    :return: True
+    """
     simulation = Simulation.objects.get(pk=simulation_id)
-    # deposit cash
+    teams = list(simulation.teams.all())
+    stocks = list(simulation.stocks.all())
+    nb_players = len(teams) - 1
+    Team.objects.filter(pk__in=[team.id for team in teams]).update(current_simulation=simulation)
+    for team in teams:
+        simulation_cache.team_simulation.set_on_commit(team.id, simulation.id)
+        if team.team_type == Team.LIQUIDITY_MANAGER:
+            simulation_cache.liquidity_manager.set_on_commit(simulation.id, team.id)
+
     print("starting cash deposit....")
     cash_deposit = Transaction(simulation=simulation, transaction_type=Transaction.INITIAL)
     cash_deposit.save()
-    for team in simulation.teams.all():
+    lines = []
+    for team in teams:
         if team.team_type == Team.PLAYERS:
             amount = simulation.capital
         elif team.team_type == Team.LIQUIDITY_MANAGER:
             amount = simulation.capital * simulation.nb_teams * 9
         else:
             amount = 0
-        team.current_simulation = simulation
-        team.save()
-        deposit = TransactionLine(transaction=cash_deposit, team=team, quantity=1, price=amount,
-                                  amount=amount, asset_type=TransactionLine.CASH)
-        deposit.save()
-    print("End cash deposit...")
-    # deposit stocks
+        lines.append(TransactionLine(transaction=cash_deposit, team=team, quantity=1, price=amount, amount=amount,
+                                     asset_type=TransactionLine.CASH))
+
     print("starting stocks deposit....")
-    for stock in simulation.stocks.all():
-        print("Stock deposit %s" % stock.symbol)
-        stocks_deposit = Transaction(simulation=simulation, transaction_type=Transaction.INITIAL)
-        stocks_deposit.save()
-        stock_quantity = stock.quantity
-        allocation = int(stock_quantity*.1/(simulation.teams.count()-1))
-        for team in simulation.teams.all():
+    stocks_deposit = Transaction(simulation=simulation, transaction_type=Transaction.INITIAL)
+    stocks_deposit.save()
+    for stock in stocks:
+        allocation = int(stock.quantity * .1 / nb_players)
+        for team in teams:
             if team.team_type == Team.PLAYERS:
                 quantity = allocation
             elif team.team_type == Team.LIQUIDITY_MANAGER:
-                quantity = stock_quantity - ((simulation.teams.count()-1) * allocation)
+                quantity = stock.quantity - (nb_players * allocation)
             else:
                 quantity = 0
-            print("Stock deposit %s -> %s" % (stock.symbol, team.name))
-            deposit = TransactionLine(transaction=stocks_deposit, team=team, quantity=quantity, price=Decimal(stock.price), stock=stock,
-                                      amount=Decimal(quantity*stock.price), asset_type=TransactionLine.STOCKS)
-            deposit.save()
+            lines.append(TransactionLine(transaction=stocks_deposit, team=team, quantity=quantity, price=stock.price,
+                                         stock=stock, amount=round_amount(AMOUNT_CONTEXT.multiply(quantity, stock.price)),
+                                         asset_type=TransactionLine.STOCKS))
+    TransactionLine.objects.bulk_create(lines, batch_size=1000)
+    rebuild_positions(simulation.id)
+    print("End of the deposits: %s lines" % len(lines))
     return True
 
 
-@transaction.atomic
-def process_order(simulation, sell_order, buy_order, quantity, force=False):
+def fill_price(sell_order, buy_order):
     """
-    Fulfill two matching orders.
-
-    .. note:: This is called by :func:`check_matching_orders`
-
-    :param simulation: A simulation object.
-    :param sell_order: An order object (sell).
-    :param buy_order: An order object (buy).
-    :param quantity: The quantity to exchange (could be a partial fulfillment).
-    :return: Nothing.
+    The price of a fill between two orders: the limit price of the order that has one, or the mean of both prices.
     """
-    stock = Stock.objects.get(pk=sell_order.stock_id)
-    ready_to_process = True
-    new_transaction = Transaction(simulation=simulation, transaction_type=Transaction.ORDER)
-    new_transaction.save()
-    price = 0
-    new_sell_order = None
-    new_buy_order = None
     if sell_order.price and not buy_order.price:
         price = sell_order.price
     elif buy_order.price and not sell_order.price:
@@ -386,132 +1067,299 @@ def process_order(simulation, sell_order, buy_order, quantity, force=False):
         price = sell_order.price
     else:
         #  Due to rounding differences
-        price = (buy_order.price + sell_order.price)/2
-
-    print("PRICE: %s" % price)
-    if stock.price == 0 and stock.opening_price == 0:
-        # TODO: Check if we need to do something here
-        # We open the market
-        pass
-    elif force:
-        ready_to_process = True
-
-    if current_shares(sell_order.team_id, sell_order.stock_id) < quantity:
-        ready_to_process = False
-        sell_order.state = Order.FAILED
-        sell_order.save()
-
-    if current_cash(buy_order.team_id, simulation.id) < quantity * price:
-        ready_to_process = False
-        buy_order.state = Order.FAILED
-        buy_order.save()
-
-    if buy_order.team.team_type == Team.LIQUIDITY_MANAGER or sell_order.team.team_type == Team.LIQUIDITY_MANAGER:
-        # TODO tester qu'il y a au moins x teams avant de passer la transaction
-        bids = Order.objects.filter(state=Order.SUBMITTED, stock=stock, order_type=Order.BID).count()
-        asks = Order.objects.filter(state=Order.SUBMITTED, stock=stock, order_type=Order.ASK).count()
-        if bids > 3 and asks > 3:
-            try:
-                max_bid = Order.objects.filter(state=Order.SUBMITTED, stock=stock, order_type=Order.BID).order_by('-price')[0]
-                max_bid_price = max_bid.price
-            except IndexError:
-                max_bid_price = False
-            try:
-                min_ask = Order.objects.filter(state=Order.SUBMITTED, stock=stock, order_type=Order.ASK).order_by('price')[0]
-                min_ask_price = min_ask.price
-            except IndexError:
-                min_ask_price = False
-
-            # TODO Implement better test!
-            if price > Decimal(655.50):
-                ready_to_process = False
-
-            elif price > Decimal(1.5) * stock.price or price < Decimal(0.5) * stock.price:
-                ready_to_process = False
-
-            elif max_bid_price and min_ask_price:
-                try:
-                    spread = min_ask_price - max_bid_price
-                    mean = (min_ask_price + max_bid_price)/2
-                except:
-                    spread = None
-                    mean = 0
-                # It's too dangerous for the liquidity manager
-                if spread:
-                    if spread > mean*Decimal(0.33):
-                        # It's too dangerous for the liquidity manager
-                        if buy_order.team.team_type == Team.LIQUIDITY_MANAGER:
-                            buy_order.price = max_bid_price * Decimal(1.1)
-                            buy_order.save()
-                            ready_to_process = False
-                        if sell_order.team.team_type == Team.LIQUIDITY_MANAGER:
-                            sell_order.price = min_ask_price * Decimal(0.9)
-                            sell_order.save()
-                            ready_to_process = False
-            else:
-                ready_to_process = False
-        else:
-            ready_to_process = False
-
-    if price > 0 and ready_to_process:
-        sell = TransactionLine(transaction=new_transaction, stock=stock, team=sell_order.team,
-                               quantity=-1*quantity, price=price, amount=-1*quantity*price,
-                               asset_type=TransactionLine.STOCKS)
-        sell_revenue = TransactionLine(transaction=new_transaction, team=sell_order.team,
-                                       quantity=1, price=quantity*price, amount=quantity*price,
-                                       asset_type=TransactionLine.CASH)
-        buy = TransactionLine(transaction=new_transaction, stock=stock, team=buy_order.team,
-                              quantity=quantity, price=price, amount=quantity*price,
-                              asset_type=TransactionLine.STOCKS)
-        buy_cost = TransactionLine(transaction=new_transaction, team=buy_order.team,
-                                   quantity=quantity, price=-1*quantity*price, amount=-1*quantity*price,
-                                   asset_type=TransactionLine.CASH)
-        if sell_order.quantity != quantity:
-            new_sell_order = Order(stock=stock, team=sell_order.team, order_type=sell_order.order_type,
-                                   quantity=sell_order.quantity-quantity, price=sell_order.price,
-                                   created_at=sell_order.created_at)
-            sell_order.quantity = quantity
-        if buy_order.quantity != quantity:
-            new_buy_order = Order(stock=stock, team=buy_order.team, order_type=buy_order.order_type,
-                                  quantity=buy_order.quantity-quantity, price=buy_order.price,
-                                  created_at=buy_order.created_at)
-            buy_order.quantity = quantity
-        sell.save()
-        sell_revenue.save()
-        buy.save()
-        buy_cost.save()
-        sell_order.transaction = new_transaction
-        sell_order.state = Order.PROCESSED
-        sell_order.save()
-        buy_order.transaction = new_transaction
-        buy_order.state = Order.PROCESSED
-        buy_order.save()
-        set_stock_quote.apply_async([stock.id, price])
-        if new_sell_order:
-            new_sell_order.save()
-        if new_buy_order:
-            new_buy_order.save()
+        price = (buy_order.price + sell_order.price) / 2
+    return price
+
+
+class Settlement(object):
+    """
+    Collects the fills of a matching pass and writes them as a single transaction.
+
+    Each call to :meth:`fill` checks and records one fill between a seller and a buyer. The whole settlement is built
+    in memory and :meth:`commit` writes it with a fixed number of statements, whatever the number of fills and the
+    transaction costs enabled: the transaction, one bulk insert of the lines, one update of the orders and one insert
+    per partially filled order. The clock of the simulation is looked up once.
+
+    A fill covered by what is left of the reservations of its orders (see :func:`reserve_order`) is not checked
+    against the positions. Otherwise the shares and the cash the team has not reserved for its other orders are read.
+
+    The fills of the liquidity manager follow the :class:`stocks.liquidity.LiquidityPolicy` of the simulation, applied
+    to the top of the order book of the matching worker (``book``) or of the shared order book.
+
+    .. note:: This should run inside a database transaction (see :func:`stocks.tasks.check_matching_orders` and
+              :func:`tickers.tasks.call_auction`).
+    """
+
+    def __init__(self, simulation, stock, book=None):
+        self.simulation = simulation
+        self.stock = stock
+        self.book = book
+        lock_positions(simulation.id)
+        self.clock = current_sim_day(simulation.id)
+        self.transaction = None
+        self.lines = []
+        self.orders = {}
+        self.filled = {}
+        self.failed = {}
+        self.fills = []
+        self.cash = {}
+        self.shares = {}
+        self.remainders = []
+        self.released_shares = {}
+        self.released_cash = {}
+        self.policy = LiquidityPolicy.for_simulation(simulation)
+
+    def _reserved_shares(self, order, quantity):
+        """The shares of the reservation of an ask order released by a fill."""
+        return min(quantity, max(order.reserved_quantity - self.filled.get(order.id, 0), 0))
+
+    def _reserved_cash(self, order, quantity):
+        """The cash of the reservation of a bid order released by a fill, in proportion of the quantity."""
+        if not order.quantity:
+            return 0
+        return round_amount(AMOUNT_CONTEXT.divide(AMOUNT_CONTEXT.multiply(Decimal(order.reserved_amount), quantity),
+                                                  order.quantity))
+
+    def _has_shares(self, order, quantity):
+        reserved = self._reserved_shares(order, quantity)
+        if reserved >= quantity:
+            return True
+        team_id = order.team_id
+        held = Position.objects.filter(simulation_id=self.simulation.id, team_id=team_id,
+                                       asset_type=TransactionLine.STOCKS, stock_id=self.stock.id).values_list(
+            'quantity', 'reserved_quantity').first() or (0, 0)
+        available = held[0] + self.shares.get(team_id, 0) - held[1] + self.released_shares.get(team_id, 0)
+        return available + reserved >= quantity
+
+    def _has_cash(self, order, amount, quantity):
+        reserved = self._reserved_cash(order, quantity)
+        if reserved >= amount:
+            return True
+        team_id = order.team_id
+        held = Position.objects.filter(simulation_id=self.simulation.id, team_id=team_id,
+                                       asset_type=TransactionLine.CASH, stock_id=None).values_list(
+            'balance', 'reserved_amount').first() or (0, 0)
+        available = held[0] + self.cash.get(team_id, 0) - held[1] + self.released_cash.get(team_id, 0)
+        return available + reserved >= amount
+
+    def _reprice(self, order, price):
+        """
+        Moves an order of the liquidity manager inside the spread. The order is not matched again: its new price
+        does not cross the other side of the book. The cash reserved by a bid order follows its new price.
+        """
+        order.price = round_amount(price)
+        if order.order_type == Order.BID:
+            amount = bid_amount(self.simulation, order.quantity, order.price)
+            change_reservations(self.simulation.id, [(order.team_id, order.order_type, order.stock_id, 0,
+                                                      amount - Decimal(order.reserved_amount))])
+            order.reserved_amount = amount
+        Order.objects.filter(pk=order.id).update(price=order.price, reserved_amount=order.reserved_amount)
+        notify_book(order)
+
+    def _check_funds(self, sell_order, buy_order, quantity, price):
+        """
+        Checks the shares of the seller and the cash of the buyer, transaction costs included. An order that is not
+        covered fails.
+        """
+        amount = quantity * price + transaction_costs(self.simulation, quantity, price)
+        covered = True
+        for order, funded in ((sell_order, self._has_shares(sell_order, quantity)),
+                              (buy_order, self._has_cash(buy_order, amount, quantity))):
+            if not funded:
+                covered = False
+                order.state = Order.FAILED
+                self.failed[order.id] = order
+        return covered
+
+    def _follow_policy(self, sell_order, buy_order, price):
+        """
+        Applies the liquidity policy to a fill of the liquidity manager. The orders of a refused fill are repriced.
+
+        :return: True if the fill can be recorded.
+        """
+        manager_id = simulation_cache.liquidity_manager.get(self.simulation.id)
+        if manager_id is None or manager_id not in (sell_order.team_id, buy_order.team_id):
+            return True
+        book = get_depth(self.stock.id) if self.book is None else self.book
+        decision = self.policy.decide(book.top_of_book(), self.stock.price, price,
+                                      sell_manager=sell_order.team_id == manager_id,
+                                      buy_manager=buy_order.team_id == manager_id)
+        if not decision.accept:
+            for order, new_price in ((sell_order, decision.sell_price), (buy_order, decision.buy_price)):
+                if new_price is not None:
+                    self._reprice(order, new_price)
+        return decision.accept
+
+    def fill(self, sell_order, buy_order, quantity, price=None):
+        """
+        Fulfill two matching orders.
+
+        :param sell_order: An order object (sell).
+        :param buy_order: An order object (buy).
+        :param quantity: The quantity to exchange (could be a partial fulfillment).
+        :param price: Force the price of the fill (call auction), otherwise it is derived from the orders.
+        :return: True if the fill was recorded.
+        """
+        if price is None:
+            price = fill_price(sell_order, buy_order)
+        covered = self._check_funds(sell_order, buy_order, quantity, price)
+        if self._follow_policy(sell_order, buy_order, price) and covered and price > 0:
+            self._record(sell_order, buy_order, quantity, price)
+            return True
+        return False
+
+    def _record(self, sell_order, buy_order, quantity, price):
+        """
+        Adds the transaction lines of a fill to the settlement and keeps track of the positions it changes.
+        """
+        simulation = self.simulation
+        stock = self.stock
+        if self.transaction is None:
+            self.transaction = Transaction(simulation=simulation, transaction_type=Transaction.ORDER,
+                                           sim_round=self.clock['sim_round'], sim_day=self.clock['sim_day'])
+            models.Model.save(self.transaction)
+        new_transaction = self.transaction
+        self.lines += [
+            TransactionLine(transaction=new_transaction, stock=stock, team_id=sell_order.team_id,
+                            quantity=-1 * quantity, price=price, amount=-1 * quantity * price,
+                            asset_type=TransactionLine.STOCKS),
+            TransactionLine(transaction=new_transaction, team_id=sell_order.team_id,
+                            quantity=1, price=quantity * price, amount=quantity * price,
+                            asset_type=TransactionLine.CASH),
+            TransactionLine(transaction=new_transaction, stock=stock, team_id=buy_order.team_id,
+                            quantity=quantity, price=price, amount=quantity * price,
+                            asset_type=TransactionLine.STOCKS),
+            TransactionLine(transaction=new_transaction, team_id=buy_order.team_id,
+                            quantity=quantity, price=-1 * quantity * price, amount=-1 * quantity * price,
+                            asset_type=TransactionLine.CASH),
+        ]
+        costs = 0
         if simulation.transaction_cost > 0:
-            tc_sell = TransactionLine(transaction=new_transaction, team=sell_order.team,
-                                      quantity=-1, price=simulation.transaction_cost,
-                                      amount=-1*simulation.transaction_cost, asset_type=TransactionLine.TRANSACTIONS)
-            tc_buy = TransactionLine(transaction=new_transaction, team=buy_order.team,
-                                     quantity=-1, price=simulation.transaction_cost,
-                                     amount=-1*simulation.transaction_cost, asset_type=TransactionLine.TRANSACTIONS)
-            tc_sell.save()
-            tc_buy.save()
+            costs += simulation.transaction_cost
+            for order in (sell_order, buy_order):
+                self.lines.append(TransactionLine(transaction=new_transaction, team_id=order.team_id,
+                                                  quantity=-1, price=simulation.transaction_cost,
+                                                  amount=-1 * simulation.transaction_cost,
+                                                  asset_type=TransactionLine.TRANSACTIONS))
         if simulation.variable_transaction_cost > 0:
             transaction_price = float(price) * simulation.variable_transaction_cost / 100
-            tc_sell = TransactionLine(transaction=new_transaction, team=sell_order.team,
-                                      quantity=-1*quantity, price=Decimal(transaction_price),
-                                      amount=Decimal(-1*quantity*transaction_price),
-                                      asset_type=TransactionLine.TRANSACTIONS)
-            tc_buy = TransactionLine(transaction=new_transaction, team=buy_order.team,
-                                     quantity=-1*quantity, price=Decimal(transaction_price),
-                                     amount=Decimal(-1*quantity*transaction_price),
-                                     asset_type=TransactionLine.TRANSACTIONS)
-            tc_sell.save()
-            tc_buy.save()
+            costs += Decimal(quantity * transaction_price)
+            for order in (sell_order, buy_order):
+                self.lines.append(TransactionLine(transaction=new_transaction, team_id=order.team_id,
+                                                  quantity=-1 * quantity, price=Decimal(transaction_price),
+                                                  amount=Decimal(-1 * quantity * transaction_price),
+                                                  asset_type=TransactionLine.TRANSACTIONS))
+        self.shares[sell_order.team_id] = self.shares.get(sell_order.team_id, 0) - quantity
+        self.shares[buy_order.team_id] = self.shares.get(buy_order.team_id, 0) + quantity
+        self.cash[sell_order.team_id] = self.cash.get(sell_order.team_id, 0) + quantity * price - costs
+        self.cash[buy_order.team_id] = self.cash.get(buy_order.team_id, 0) - quantity * price - costs
+        self.released_shares[sell_order.team_id] = self.released_shares.get(sell_order.team_id, 0) + \
+            self._reserved_shares(sell_order, quantity)
+        self.released_cash[buy_order.team_id] = self.released_cash.get(buy_order.team_id, 0) + \
+            self._reserved_cash(buy_order, quantity)
+        for order in (sell_order, buy_order):
+            self.orders[order.id] = order
+            self.filled[order.id] = self.filled.get(order.id, 0) + quantity
+        self.fills.append((sell_order, buy_order, price, quantity))
+
+    def _close_failed(self, now):
+        """
+        Closes the orders that failed without any fill (the others are processed with their fills).
+
+        :return: The releases of their reservations (see :func:`change_reservations`).
+        """
+        clock = self.clock
+        releases = []
+        failed = [order for order_id, order in self.failed.items() if order_id not in self.orders]
+        if failed:
+            updated = Order.objects.filter(pk__in=[order.id for order in failed], state=Order.SUBMITTED).update(
+                state=Order.FAILED, timestamp=now, sim_round=clock['sim_round'], sim_day=clock['sim_day'])
+            if updated != len(failed):
+                raise IntegrityError("Orders of the settlement were closed by another transaction")
+            for order in failed:
+                notify_book(order, submitted=False)
+                releases.append((order.team_id, order.order_type, order.stock_id, -order.reserved_quantity,
+                                 -Decimal(order.reserved_amount)))
+        return releases
+
+    def _split(self, order, filled):
+        """
+        Creates the balance of a partially filled order. The balance of an immediate order does not rest in the book,
+        the balance of the other orders keeps what is left of the reservation.
+
+        :return: The shares and the cash kept by the balance.
+        """
+        kept_quantity, kept_amount = 0, 0
+        if order.time_in_force in (Order.IOC, Order.FOK):
+            state = Order.EXPIRED
+        else:
+            state = Order.SUBMITTED
+            kept_quantity = max(order.reserved_quantity - filled, 0)
+            kept_amount = Decimal(order.reserved_amount) - self._reserved_cash(order, filled)
+        self.remainders.append(Order(stock=self.stock, team_id=order.team_id, order_type=order.order_type,
+                                     quantity=order.quantity - filled, price=order.price,
+                                     time_in_force=order.time_in_force, state=state,
+                                     reserved_quantity=kept_quantity, reserved_amount=kept_amount,
+                                     sim_round=self.clock['sim_round'], sim_day=self.clock['sim_day']))
+        return kept_quantity, kept_amount
+
+    def _submit_remainders(self):
+        for remainder in self.remainders:
+            # The balance rests in the book, the matching pass is over for it
+            models.Model.save(remainder)
+            if remainder.state == Order.SUBMITTED:
+                notify_book(remainder)
+                if self.book is None:
+                    # Settled outside of the matching worker of the stock, the balance is sent to its book
+                    remainder_id, queue = remainder.id, matching_queue(remainder.stock_id)
+                    transaction.on_commit(lambda remainder_id=remainder_id, queue=queue:
+                                          check_matching_orders.apply_async([remainder_id], queue=queue))
+
+    def commit(self):
+        """
+        Writes the transaction lines and closes the orders of the settlement. Partially filled orders are split: the
+        filled part is processed and a new order is submitted with the balance, which keeps what is left of the
+        reservation. The rest of the reservations is released. The quotes are buffered once the database transaction
+        is committed (see :mod:`stocks.quotes`).
+        """
+        clock = self.clock
+        now = timezone.now()
+        releases = self._close_failed(now)
+        if self.transaction is None:
+            change_reservations(self.simulation.id, releases)
+            return None
+        record_lines(self.lines)
+        quantities = []
+        for order_id, order in self.orders.items():
+            filled = self.filled[order_id]
+            kept_quantity, kept_amount = 0, 0
+            if order.quantity != filled:
+                if order.state != Order.FAILED:
+                    kept_quantity, kept_amount = self._split(order, filled)
+                order.quantity = filled
+                quantities.append(When(pk=order_id, then=Value(filled)))
+            order.transaction = self.transaction
+            order.state = Order.PROCESSED
+            notify_book(order, submitted=False)
+            releases.append((order.team_id, order.order_type, order.stock_id, kept_quantity - order.reserved_quantity,
+                             kept_amount - Decimal(order.reserved_amount)))
+        # The orders are still open unless another transaction settled them first (the whole settlement is then
+        # rolled back)
+        updated = Order.objects.filter(pk__in=list(self.orders), state=Order.SUBMITTED).update(
+            state=Order.PROCESSED, transaction=self.transaction, timestamp=now,
+            sim_round=clock['sim_round'], sim_day=clock['sim_day'],
+            quantity=Case(*quantities, default=F('quantity'), output_field=models.IntegerField()))
+        if updated != len(self.orders):
+            raise IntegrityError("Orders of the settlement were closed by another transaction")
+        change_reservations(self.simulation.id, releases)
+        self._submit_remainders()
+        stock_id = self.stock.id
+        update_historical_price(stock_id, clock, [(price, quantity) for sell, buy, price, quantity in self.fills])
+        publish_fills(self.simulation.id, stock_id, self.transaction.id, self.fills)
+        prices = [price for sell, buy, price, quantity in self.fills]
+        simulation_id = self.simulation.id
+        transaction.on_commit(lambda: buffer_quotes(simulation_id, stock_id, prices, clock))
+        return self.transaction
 
 
 def dividends_list(team_id):
@@ -519,18 +1367,19 @@ def dividends_list(team_id):
     sim_round = None
     dividends = {}
     round_list = []
-    transaction_lines = TransactionLine.objects.select_related('stock', 'transaction').filter(transaction__simulation_id=team.current_simulation_id).filter(
-                        team_id=team.id).filter(asset_type=TransactionLine.DIVIDENDS).order_by('transaction__sim_round', 'stock__symbol')
+    transaction_lines = TransactionLine.objects.select_related('stock', 'transaction').filter(
+        transaction__simulation_id=team.current_simulation_id, team_id=team.id,
+        asset_type=TransactionLine.DIVIDENDS).order_by('transaction__sim_round', 'stock__symbol')
     for tl in transaction_lines:
         if sim_round != tl.transaction.sim_round:
             if sim_round:
-                dividends[sim_round-1] = round_list
+                dividends[sim_round - 1] = round_list
                 round_list = []
             sim_round = tl.transaction.sim_round
         dividend = {'id': tl.id, 'price': tl.price, 'quantity': tl.quantity, 'amount': tl.amount, 'stock': tl.stock.symbol, 'stock_id': tl.stock.id}
         round_list.append(dividend)
     if sim_round:
-        dividends[sim_round-1] = round_list
+        dividends[sim_round - 1] = round_list
     else:
         dividends[0] = round_list
     return dividends
@@ -0,0 +1,355 @@
+# -*- coding: UTF-8 -*-
+# quotes.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Quotes written in batches.
+
+The prices of the fills settled by a worker are kept in a :class:`QuoteBuffer` and written every
+``QUOTE_BUFFER_INTERVAL`` milliseconds or ``QUOTE_BUFFER_SIZE`` quotes, and at the end of each Celery task (see
+:func:`stocks.tasks.flush_quote_buffer`): the quotes are inserted at once and the price of each stock is updated once.
+The quotes of the day are also appended to a :class:`TickStore` per stock, kept in the simulation cache for the
+intraday charts, and summarized in bars of 5 seconds, 1 minute and one simulation day (:class:`stocks.models.QuoteBar`).
+"""
+
+# Stdlib imports
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Core Django imports
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
+
+# Third-party app imports
+
+# MarMix imports
+from simulations import cache as simulation_cache
+from simulations.streams import publish_quote
+
+
+QUOTE_BUFFER_SIZE = 100
+QUOTE_BUFFER_INTERVAL = 250
+
+# Length of the bars in seconds, None for a simulation day
+BAR_PERIODS = (('5s', 5), ('1m', 60), ('day', None))
+
+
+class TickStore(object):
+    """
+    The ticks of a stock during a simulation day, in two arrays of doubles: the timestamps (seconds since the epoch)
+    and the prices. Ticks are only appended, in time order.
+    """
+
+    def __init__(self, sim_date):
+        self.sim_date = sim_date
+        self.timestamps = array('d')
+        self.prices = array('d')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp, price):
+        self.timestamps.append(timestamp)
+        self.prices.append(float(price))
+
+    def since(self, timestamp=None):
+        """
+        The ticks after a time, as parallel lists.
+
+        :param timestamp: Seconds since the epoch (all the ticks of the day if not set).
+        """
+        start = 0 if timestamp is None else bisect_right(self.timestamps, timestamp)
+        return {'sim_date': self.sim_date, 'timestamps': self.timestamps[start:].tolist(),
+                'prices': self.prices[start:].tolist()}
+
+
+class QuoteBuffer(object):
+    """
+    Quotes waiting to be written, in the order of the fills.
+
+    :param size: The number of quotes that triggers a flush.
+    :param interval: The age of the oldest quote (in milliseconds) that triggers a flush.
+    """
+
+    def __init__(self, size=QUOTE_BUFFER_SIZE, interval=QUOTE_BUFFER_INTERVAL):
+        self.size = size
+        self.interval = interval
+        self.quotes = []
+        self.since = None
+
+    def __len__(self):
+        return len(self.quotes)
+
+    def add(self, simulation_id, stock_id, price, timestamp, clock):
+        if not self.quotes:
+            self.since = time.time()
+        self.quotes.append((simulation_id, stock_id, price, timestamp, clock['sim_round'], clock['sim_day']))
+
+    def due(self, now=None):
+        if not self.quotes:
+            return False
+        return len(self.quotes) >= self.size or ((now or time.time()) - self.since) * 1000 >= self.interval
+
+    def take(self):
+        quotes = self.quotes
+        self.quotes = []
+        self.since = None
+        return quotes
+
+
+def last_prices(quotes):
+    """
+    The last price of each stock of a batch of quotes.
+
+    :return: An ordered dict of (simulation_id, price) by stock id.
+    """
+    prices = OrderedDict()
+    for simulation_id, stock_id, price, timestamp, sim_round, sim_day in quotes:
+        prices[stock_id] = (simulation_id, price)
+    return prices
+
+
+def price_ranges(quotes):
+    """
+    The lowest and highest prices of each stock of a batch of quotes, over the last day of the batch and over the
+    whole batch.
+
+    :return: An ordered dict of [sim_date, day_low, day_high, low, high] by stock id.
+    """
+    ranges = OrderedDict()
+    for simulation_id, stock_id, price, timestamp, sim_round, sim_day in quotes:
+        sim_date = sim_round * 100 + sim_day
+        stats = ranges.get(stock_id)
+        if stats is None:
+            ranges[stock_id] = [sim_date, price, price, price, price]
+            continue
+        if sim_date > stats[0]:
+            stats[0:3] = [sim_date, price, price]
+        elif sim_date == stats[0]:
+            stats[1] = min(stats[1], price)
+            stats[2] = max(stats[2], price)
+        stats[3] = min(stats[3], price)
+        stats[4] = max(stats[4], price)
+    return ranges
+
+
+def append_ticks(store, quotes):
+    """
+    Appends the quotes of a stock made during the day of its tick store.
+
+    :param store: A TickStore object.
+    :param quotes: The quotes of the stock, in time order.
+    :return: The number of ticks appended.
+    """
+    appended = 0
+    for simulation_id, stock_id, price, timestamp, sim_round, sim_day in quotes:
+        if sim_round * 100 + sim_day == store.sim_date:
+            store.append(timestamp.timestamp(), price)
+            appended += 1
+    return appended
+
+
+def rollup(quotes):
+    """
+    Summarizes quotes in bars of each period (see :data:`BAR_PERIODS`).
+
+    :param quotes: Quotes in time order.
+    :return: An ordered dict of [start, open, high, low, close, quotes, sim_round, sim_day] by (stock id, period,
+             bucket).
+    """
+    bars = OrderedDict()
+    for simulation_id, stock_id, price, timestamp, sim_round, sim_day in quotes:
+        seconds = timestamp.timestamp()
+        for period, length in BAR_PERIODS:
+            bucket = sim_round * 100 + sim_day if length is None else int(seconds // length * length)
+            bar = bars.get((stock_id, period, bucket))
+            if bar is None:
+                bars[(stock_id, period, bucket)] = [timestamp, price, price, price, price, 1, sim_round, sim_day]
+            else:
+                bar[2] = max(bar[2], price)
+                bar[3] = min(bar[3], price)
+                bar[4] = price
+                bar[5] += 1
+    return bars
+
+
+def update_bars(bars):
+    """
+    Adds the bars of a batch of quotes to the stored bars: one UPDATE for the bars already stored and one INSERT for
+    the new ones.
+
+    .. note:: Call this in a database transaction.
+
+    :param bars: The bars returned by :func:`rollup`.
+    :return: Nothing.
+    """
+    cursor = connection.cursor()
+
+    def update(keys):
+        params = []
+        for key in keys:
+            start, price_open, high, low, close, nb_quotes, sim_round, sim_day = bars[key]
+            params += list(key) + [high, low, close, nb_quotes]
+        cursor.execute('UPDATE stocks_quotebar b SET price_high=GREATEST(b.price_high, v.high), '
+                       'price_low=LEAST(b.price_low, v.low), price_close=v.close, nb_quotes=b.nb_quotes+v.nb_quotes '
+                       'FROM (VALUES ' + ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(keys)) + ') '
+                       'AS v(stock_id, period, bucket, high, low, close, nb_quotes) '
+                       'WHERE b.stock_id=v.stock_id AND b.period=v.period AND b.bucket=v.bucket '
+                       'RETURNING b.stock_id, b.period, b.bucket', params)
+        return set(tuple(row) for row in cursor.fetchall())
+
+    def insert(keys):
+        params = []
+        for key in keys:
+            params += list(key) + bars[key]
+        values = ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(keys))
+        cursor.execute('INSERT INTO stocks_quotebar (stock_id, period, bucket, start, price_open, price_high, '
+                       'price_low, price_close, nb_quotes, sim_round, sim_day) VALUES ' + values, params)
+
+    updated = update(list(bars))
+    missing = [key for key in bars if key not in updated]
+    if not missing:
+        return
+    try:
+        with transaction.atomic():
+            insert(missing)
+    except IntegrityError:
+        # Some bars were opened by a concurrent flush
+        updated = update(missing)
+        missing = [key for key in missing if key not in updated]
+        if missing:
+            insert(missing)
+
+
+_buffer = None
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        _buffer = QuoteBuffer(getattr(settings, 'QUOTE_BUFFER_SIZE', QUOTE_BUFFER_SIZE),
+                              getattr(settings, 'QUOTE_BUFFER_INTERVAL', QUOTE_BUFFER_INTERVAL))
+    return _buffer
+
+
+def buffer_quotes(simulation_id, stock_id, prices, clock):
+    """
+    Quotes a stock at the prices of its last fills. The quotes are written when the buffer is due.
+
+    :param prices: The prices, in the order of the fills.
+    :param clock: The simulation clock (see :func:`simulations.models.current_sim_day`).
+    :return: Nothing.
+    """
+    quote_buffer = get_buffer()
+    now = timezone.now()
+    for price in prices:
+        quote_buffer.add(simulation_id, stock_id, price, now, clock)
+    if quote_buffer.due():
+        flush_quotes()
+
+
+def insert_quotes(cursor, quotes):
+    params = []
+    for simulation_id, stock_id, price, timestamp, sim_round, sim_day in quotes:
+        params += [stock_id, price, timestamp, sim_round, sim_day]
+    values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(quotes))
+    cursor.execute('INSERT INTO stocks_quote (stock_id, price, timestamp, sim_round, sim_day) VALUES ' + values,
+                   params)
+
+
+def update_stock_prices(cursor, prices, ranges):
+    """
+    Sets the last price and the day and lifetime lows and highs of the stocks quoted with a single UPDATE. The stocks
+    quoted for the first time take their opening price.
+
+    :param prices: The (simulation id, last price) tuples by stock id (see :func:`last_prices`).
+    :param ranges: The price ranges by stock id (see :func:`price_ranges`).
+    :return: Nothing.
+    """
+    from .tasks import set_opening_price
+    params = []
+    for stock_id, (simulation_id, price) in prices.items():
+        params += [stock_id, price] + ranges[stock_id]
+    # The day low and high start again with the first quote of a new day, late quotes of a past day are ignored
+    cursor.execute('UPDATE stocks_stock s SET price=v.price, '
+                   'opening_price=CASE WHEN COALESCE(p.opening_price, 0)=0 AND v.price<>0 '
+                   'THEN v.price ELSE p.opening_price END, '
+                   'day_low=CASE WHEN p.stats_date=v.sim_date THEN LEAST(p.day_low, v.day_low) '
+                   'WHEN p.stats_date>v.sim_date THEN p.day_low ELSE v.day_low END, '
+                   'day_high=CASE WHEN p.stats_date=v.sim_date THEN GREATEST(p.day_high, v.day_high) '
+                   'WHEN p.stats_date>v.sim_date THEN p.day_high ELSE v.day_high END, '
+                   'life_low=LEAST(p.life_low, v.low), life_high=GREATEST(p.life_high, v.high), '
+                   'stats_date=GREATEST(p.stats_date, v.sim_date) '
+                   'FROM (VALUES ' + ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(prices)) + ') '
+                   'AS v(id, price, sim_date, day_low, day_high, low, high), stocks_stock p '
+                   'WHERE s.id=v.id AND p.id=s.id RETURNING s.id, p.opening_price', params)
+    for stock_id, opening_price in cursor.fetchall():
+        simulation_id, price = prices[stock_id]
+        if not opening_price and price != 0:
+            transaction.on_commit(lambda stock_id=stock_id, price=price:
+                                  set_opening_price.apply_async([stock_id, price]))
+    for stock_id, (simulation_id, price) in prices.items():
+        simulation_cache.stock_price.set_on_commit(stock_id, price)
+    for simulation_id in set([simulation_id for simulation_id, price in prices.values()]):
+        simulation_cache.mark_ranking(simulation_id)
+
+
+def update_ticks(stock_id, quotes):
+    """
+    Appends the quotes of a stock to its cached tick store, or loads the store if it is not cached.
+    """
+    store = simulation_cache.ticks.peek(stock_id)
+    if store is None:
+        # Loaded from the quotes of the day, the ones just written included
+        simulation_cache.ticks.get(stock_id)
+        return
+    sim_date = quotes[-1][4] * 100 + quotes[-1][5]
+    if store.sim_date != sim_date:
+        store = TickStore(sim_date)
+    if append_ticks(store, quotes):
+        simulation_cache.ticks.set(stock_id, store)
+
+
+def flush_quotes():
+    """
+    Writes the buffered quotes with a single INSERT, updates the prices of the stocks quoted (see
+    :func:`update_stock_prices`) and adds the quotes to the bars and to the tick stores.
+
+    :return: The number of quotes written.
+    """
+    quotes = get_buffer().take()
+    if not quotes:
+        return 0
+    prices = last_prices(quotes)
+    ranges = price_ranges(quotes)
+    with transaction.atomic():
+        cursor = connection.cursor()
+        insert_quotes(cursor, quotes)
+        update_stock_prices(cursor, prices, ranges)
+        update_bars(rollup(quotes))
+        for simulation_id, stock_id, price, timestamp, sim_round, sim_day in quotes:
+            publish_quote(simulation_id, stock_id, price, timestamp)
+    for stock_id in prices:
+        update_ticks(stock_id, [quote for quote in quotes if quote[1] == stock_id])
+    return len(quotes)
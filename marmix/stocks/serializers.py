@@ -25,13 +25,14 @@ import datetime
 
 # Core Django imports
 from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
 
 # Third-party app imports
 from rest_framework import serializers
 
 # MarMix imports
 from .models import Stock, Quote, Order, HistoricalPrice, TransactionLine
-from simulations.models import stock_historical_prices
+from simulations.models import Simulation, Team, stock_historical_prices
 
 
 class DateTimeTzAwareField(serializers.DateTimeField):
@@ -92,8 +93,8 @@ class OrderSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Order
-        fields = ('id', 'stock', 'team', 'order_type', 'quantity', 'price', 'created_at', 'sim_round', 'sim_day', 'transaction', 'state')
-        read_only_fields = ['created_at', 'sim_round', 'sim_day', 'transaction', 'team']
+        fields = ('id', 'stock', 'team', 'order_type', 'quantity', 'price', 'created_at', 'sim_round', 'sim_day', 'transaction', 'state', 'activate_at', 'time_in_force')
+        read_only_fields = ['created_at', 'sim_round', 'sim_day', 'transaction', 'team', 'activate_at']
         #depth = 1
 
 
@@ -103,9 +104,33 @@ class CreateOrderSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Order
-        fields = ('id', 'stock', 'team', 'order_type', 'quantity', 'price', 'created_at', 'sim_round', 'sim_day', 'transaction')
+        fields = ('id', 'stock', 'team', 'order_type', 'quantity', 'price', 'created_at', 'sim_round', 'sim_day', 'transaction', 'activate_at', 'time_in_force')
         read_only_fields = ['created_at', 'sim_round', 'sim_day', 'transaction', 'team']
 
+    def validate_activate_at(self, value):
+        """
+        A scheduled order takes its time priority when it is activated, only the staff and the liquidity manager can
+        schedule orders.
+        """
+        user = self.context['request'].user
+        if value and not (user.is_staff or user.get_team.team_type == Team.LIQUIDITY_MANAGER):
+            raise serializers.ValidationError(_("You can not schedule an order."))
+        return value
+
+    def validate(self, attrs):
+        """
+        An immediate order (IOC or FOK) is matched when it is placed: it can not be scheduled and it is only accepted
+        while the market is open.
+        """
+        time_in_force = attrs.get('time_in_force', getattr(self.instance, 'time_in_force', Order.GTC))
+        if time_in_force in (Order.IOC, Order.FOK):
+            stock = attrs.get('stock', getattr(self.instance, 'stock', None))
+            if attrs.get('activate_at', getattr(self.instance, 'activate_at', None)):
+                raise serializers.ValidationError(_("An immediate order can not be scheduled."))
+            if stock is not None and stock.simulation.state != Simulation.RUNNING:
+                raise serializers.ValidationError(_("An immediate order can only be placed while the market is open."))
+        return attrs
+
 
 class DividendSerializer(serializers.ModelSerializer):
 
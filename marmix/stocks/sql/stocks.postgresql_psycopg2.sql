@@ -1,16 +1,13 @@
 --
--- Update the price of the stock after a new quote is inserted.
+-- The price of the stocks is set when the quotes are written (see stocks.quotes.flush_quotes),
+-- drop the trigger that updated it after each quote.
 --
-CREATE OR REPLACE FUNCTION update_stock_quote() RETURNS TRIGGER AS $update_quote$
-    BEGIN
-        --
-        -- Update the price of the stock after a new quote is inserted.
-        --
-        UPDATE stocks_stock SET price=NEW.price WHERE id=NEW.stock_id;
-        RETURN NULL; -- result is ignored since this is an AFTER trigger
-    END;
-$update_quote$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS update_quote ON stocks_quote;
+DROP FUNCTION IF EXISTS update_stock_quote();
 
-CREATE TRIGGER update_quote
-AFTER INSERT ON stocks_quote
-    FOR EACH ROW EXECUTE PROCEDURE update_stock_quote();
\ No newline at end of file
+--
+-- The positions without a stock (the cash buckets) are unique per team and asset type,
+-- the unique_together of the positions doesn't apply to a NULL stock (created after each migrate).
+--
+CREATE UNIQUE INDEX IF NOT EXISTS stocks_position_null_stock_uniq
+    ON stocks_position (simulation_id, team_id, asset_type) WHERE stock_id IS NULL;
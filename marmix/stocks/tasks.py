@@ -22,188 +22,252 @@
 
 # Stdlib imports
 import logging
-from decimal import Decimal, getcontext
+from decimal import Decimal
 
 # Core Django imports
 from django.utils.translation import ugettext as _
+from django.db import transaction
+from django.conf import settings
 
 # Third-party app imports
 from async_messages import messages
 from celery.utils.log import get_task_logger
+from celery.signals import task_postrun
 
 # MarMix imports
 from config.celery import app
-from simulations.models import Simulation
+from simulations.models import Simulation, current_sim_day
+from .engine import get_book, reload_book, remove_orders, publish_depth
 
 
 # Get an instance of a logger
 logger = get_task_logger(__name__)
 
 
+def matching_queue(stock_id):
+    """
+    The Celery queue matching the orders of a stock. The stocks are spread over ``MATCHING_LANES`` queues, each of
+    them consumed by a single worker process, so that the orders of a stock are matched one at a time.
+    """
+    return 'matching-%s' % (stock_id % getattr(settings, 'MATCHING_LANES', 1))
+
+
 @app.task
 def check_matching_orders(order_id):
     """
-    Looks for matching orders in the order book.
+    Sweeps the in-memory order book of the stock for orders matching an incoming order.
 
-    :param order: An order object
+    The incoming order is filled against as many resting orders as needed, best price first. All the fills of the
+    sweep are settled in a single transaction (see :class:`stocks.models.Settlement`). An IOC order expires with its
+    unfilled balance, a FOK order is only settled if it can be filled completely and expires otherwise. Both expire at
+    once while the market is closed.
+
+    The incoming order is locked first, then each resting order with ``FOR UPDATE SKIP LOCKED``: a resting order
+    locked by another settlement is skipped, so that an order can never be filled twice, even if the task runs outside
+    of the matching queue of its stock (see :func:`matching_queue`). The changes of the book are applied once the
+    sweep is committed: a FOK order that can not be filled completely rolls the whole sweep back and leaves the book
+    as it was.
+
+    :param order_id: The id of the incoming order
     :return : None
     """
-    # TODO: Check if balance is sufficient!
-    from .models import Order, process_order
-    try:
-        order = Order.objects.get(pk=order_id)
-    except Order.DoesNotExist:
-        order = None
-
-    if order and order.stock.simulation.state == Simulation.RUNNING:
+    from .models import Order, Settlement
+    with transaction.atomic():
+        try:
+            order = Order.objects.select_for_update().get(pk=order_id)
+        except Order.DoesNotExist:
+            order = None
+        if not order or order.state != Order.SUBMITTED:
+            return
+        if order.time_in_force in (Order.IOC, Order.FOK) and order.stock.simulation.state != Simulation.RUNNING:
+            # An immediate order never rests in the book
+            expire_order(order)
+            return
+        book = get_book(order.stock_id)
+        book.update(order)
+        stock_id = order.stock_id
+        transaction.on_commit(lambda: publish_depth(stock_id))
+        if order.stock.simulation.state != Simulation.RUNNING:
+            # The order rests in the book, it is matched when the market opens again (see open_market_stock)
+            return
         logger.debug("Starting a new order matching cycle...")
-        if order.order_type == Order.ASK:
-            book_order_type = Order.BID
+        settlement = Settlement(order.stock.simulation, order.stock, book=book)
+        qty = sweep_book(order, book, settlement)
+        if order.time_in_force == Order.FOK and qty > 0:
+            # Some fills were refused, nothing is written
+            transaction.set_rollback(True)
         else:
-            book_order_type = Order.ASK
-        logger.debug("Order type: %s" % book_order_type)
-        if not order.price:
-            logger.debug("No price asked, market order.")
-            # This is a market order
-            if book_order_type == Order.BID:
-                order_book = Order.objects.filter(stock=order.stock).filter(state=Order.SUBMITTED).filter(order_type=book_order_type).filter(price__isnull=False).order_by('-price')
-            else:
-                order_book = Order.objects.filter(stock=order.stock).filter(state=Order.SUBMITTED).filter(order_type=book_order_type).filter(price__isnull=False).order_by('price')
-            if order_book:
-                logger.debug("We have limit orders in the book")
-                qty = order.quantity
-                for match_order in order_book:
-                    if match_order.team != order.team:
-                        if match_order.quantity >= qty:
-                            #  We can fulfill the whole order
-                            qty_traded = qty
-                            logger.debug("Full order can be fulfilled: %s" % qty_traded)
-                        else:
-                            #  We fulfill a partial order
-                            # TODO we should look for the next one
-                            qty_traded = match_order.quantity
-                            logger.debug("Partial order can be fulfilled: %s (order qty was: %s)" %
-                                         (qty_traded, match_order.quantity))
-                        if order.order_type == Order.ASK:
-                            sell_order = order
-                            buy_order = match_order
-                        else:
-                            sell_order = match_order
-                            buy_order = order
-                        logger.debug("Processing the order: SELL: %s / BUY: %s / QTY: %s" %
-                                     (sell_order, buy_order, qty_traded))
-                        process_order(order.stock.simulation, sell_order, buy_order, qty_traded)
-                        logger.info("New transaction: STOCK: %s QTY: %s SELLER: %s BUYER: %s" % (order.stock, qty_traded, sell_order.team, buy_order.team))
-                        break
+            settlement.commit()
+    if order.time_in_force == Order.IOC and order.state == Order.SUBMITTED or \
+            order.time_in_force == Order.FOK and qty > 0:
+        # Nothing was filled (the balance of a partial IOC fill expires in the settlement)
+        with transaction.atomic():
+            expire_order(order)
+
+
+def sweep_book(order, book, settlement):
+    """
+    Fills an incoming order against the resting orders of the book, best price first, until it is filled, fails or is
+    repriced. A FOK order is only swept if the book holds its whole quantity.
+
+    :return: The quantity of the incoming order left unfilled.
+    """
+    from .models import Order
+    price = order.price
+    qty = order.quantity
+    if order.time_in_force == Order.FOK and book_quantity(book, order) < qty:
+        return qty
+    stale = []
+    stock_id = order.stock_id
+    # The book is only changed once the sweep is committed (see stocks.models.notify_book)
+    transaction.on_commit(lambda: stale and remove_orders(stock_id, stale))
+    for entry in book.candidates(order):
+        match_order = lock_book_order(entry.order_id, stale)
+        if not match_order:
+            continue
+        #  The whole (remaining) order or a part of it, the next resting order takes the rest
+        qty_traded = min(qty, match_order.quantity)
+        if order.order_type == Order.ASK:
+            sell_order, buy_order = order, match_order
         else:
-            # This is a limit order
-            logger.debug("Price asked, limit order.")
-            order_book = Order.objects.filter(stock=order.stock).filter(state=Order.SUBMITTED).filter(order_type=book_order_type).filter(price__isnull=True).order_by('timestamp')
-            if order_book:
-                logger.debug("We have market orders in the book")
-                qty = order.quantity
-                for match_order in order_book:
-                    if match_order.team != order.team:
-                        if match_order.quantity >= qty:
-                            #  We can fulfill the whole order
-                            qty_traded = qty
-                            logger.debug("Full order can be fulfilled: %s" % qty_traded)
-                        else:
-                            #  We fulfill a partial order and look for the next one
-                            # TODO look for the next one
-                            qty_traded = match_order.quantity
-                            logger.debug("Partial order can be fulfilled: %s (order qty was: %s)" %
-                                         (qty_traded, match_order.quantity))
-                        if order.order_type == Order.ASK:
-                            sell_order = order
-                            buy_order = match_order
-                        else:
-                            sell_order = match_order
-                            buy_order = order
-                        logger.debug("Processing the order: SELL: %s / BUY: %s / QTY: %s" %
-                                     (sell_order, buy_order, qty_traded))
-                        process_order(order.stock.simulation, sell_order, buy_order, qty_traded)
-                        logger.info("New transaction: STOCK: %s QTY: %s SELLER: %s BUYER: %s" % (order.stock, qty_traded, sell_order.team, buy_order.team))
-                        break
-            else:
-                if book_order_type == Order.BID:
-                    order_book = Order.objects.filter(stock=order.stock).filter(state=Order.SUBMITTED).filter(order_type=book_order_type).filter(price__isnull=False).order_by('-price')
-                else:
-                    order_book = Order.objects.filter(stock=order.stock).filter(state=Order.SUBMITTED).filter(order_type=book_order_type).filter(price__isnull=False).order_by('price')
-                if order_book:
-                    logger.debug("We have limit orders in the book")
-                    qty = order.quantity
-                    for match_order in order_book:
-                        if order.order_type == Order.ASK:
-                            sell_order = order
-                            buy_order = match_order
-                        else:
-                            sell_order = match_order
-                            buy_order = order
-                        if match_order.team != order.team and sell_order.price <= buy_order.price:
-                            if match_order.quantity >= qty:
-                                #  We can fulfill the whole order
-                                qty_traded = qty
-                                logger.debug("Full order can be fulfilled: %s" % qty_traded)
-                            else:
-                                #  We fulfill a partial order and look for the next one
-                                qty_traded = match_order.quantity
-                                logger.debug("Partial order can be fulfilled: %s (order qty was: %s)" %
-                                             (qty_traded, match_order.quantity))
-                            logger.debug("Processing the order: SELL: %s / BUY: %s / QTY: %s" %
-                                         (sell_order, buy_order, qty_traded))
-                            process_order(order.stock.simulation, sell_order, buy_order, qty_traded)
-                            logger.info("New transaction: STOCK: %s QTY: %s SELLER: %s BUYER: %s" % (order.stock, qty_traded, sell_order.team, buy_order.team))
-                            break
+            sell_order, buy_order = match_order, order
+        logger.debug("Processing the order: SELL: %s / BUY: %s / QTY: %s" % (sell_order, buy_order, qty_traded))
+        if settlement.fill(sell_order, buy_order, qty_traded):
+            logger.info("New transaction: STOCK: %s QTY: %s SELLER: %s BUYER: %s" %
+                        (order.stock, qty_traded, sell_order.team, buy_order.team))
+            qty -= qty_traded
+        elif order.state != Order.SUBMITTED or order.price != price:
+            # The incoming order failed or was repriced, the rest of the book is not relevant anymore
+            break
+        if qty == 0:
+            break
+    return qty
+
+
+def lock_book_order(order_id, stale):
+    """
+    Locks a resting order of the book for a sweep (see :func:`lock_resting_order`).
+
+    :param stale: The ids of the orders that left the book, the order is added if it is no longer submitted.
+    :return: The order, None if it can not be filled.
+    """
+    from .models import Order
+    match_order = lock_resting_order(order_id)
+    if match_order is None:
+        if not Order.objects.filter(pk=order_id, state=Order.SUBMITTED).exists():
+            # The order was processed, cancelled or deleted elsewhere
+            stale.append(order_id)
+        return None
+    if match_order.state != Order.SUBMITTED:
+        stale.append(order_id)
+        return None
+    return match_order
+
+
+def expire_order(order):
+    """
+    Expires an incoming order and releases its reservation.
+    """
+    from .models import Order, release_reservations
+    order.state = Order.EXPIRED
+    order.save()
+    release_reservations(order.stock.simulation_id, [order])
+
+
+def lock_resting_order(order_id):
+    """
+    Locks a resting order for the current transaction.
+
+    :return: The order, None if it does not exist or if it is locked by another transaction.
+    """
+    from .models import Order
+    orders = list(Order.objects.raw('SELECT * FROM stocks_order WHERE id=%s FOR UPDATE SKIP LOCKED', [order_id]))
+    return orders[0] if orders else None
+
+
+def book_quantity(book, order):
+    """
+    The quantity resting in the book that can trade with an order (up to the quantity of the order).
+    """
+    quantity = 0
+    for entry in book.candidates(order):
+        quantity += entry.quantity
+        if quantity >= order.quantity:
+            break
+    return quantity
+
+
+@app.task
+def check_activated_orders(order_ids):
+    """
+    Matches a batch of orders that were just activated, in their activation order (the orders of a batch are in the
+    same matching queue).
+
+    :param order_ids: The ids of the orders.
+    :return : None
+    """
+    for order_id in order_ids:
+        check_matching_orders(order_id)
+
+
+@app.task
+def remove_book_orders(stock_id, order_ids):
+    """
+    Drops orders that left the book outside of the matching worker of their stock (expired or deleted orders) from
+    its order book (see :func:`matching_queue`).
+    """
+    remove_orders(stock_id, order_ids)
 
 
 @app.task
 def set_stock_quote(stock_id, price):
     """
-    Creates a new stock quote.
+    Quotes a stock outside of a settlement. The quote is written at the latest at the end of the task.
 
     :param stock: The stock
     :param price: The price of the last transaction
-    :return: Quote object
+    :return: Nothing
     """
-    from .models import Quote, Stock
+    from .models import Stock
+    from .quotes import buffer_quotes
     stock = Stock.objects.get(pk=stock_id)
-    price = Decimal(price)
-    new_quote = Quote(stock=stock, price=price)
-    new_quote.save()
-    stock.price = price
-    stock.save()
-    return new_quote
+    buffer_quotes(stock.simulation_id, stock.id, [Decimal(price)], current_sim_day(stock.simulation_id))
+
+
+@task_postrun.connect
+def flush_quote_buffer(**kwargs):
+    """
+    Writes the quotes buffered by a task when it is over.
+    """
+    from .quotes import flush_quotes
+    flush_quotes()
 
 
 @app.task
 def set_opening_price(stock_id, price):
-    getcontext().prec = 4
-    from .models import Stock, Transaction, TransactionLine
+    from .models import Stock, reprice_opening_transactions
     stock = Stock.objects.get(pk=stock_id)
-    transactions = TransactionLine.objects.filter(stock=stock, transaction__transaction_type=Transaction.INITIAL)
     price = Decimal(price)
-    print("Setting the opening price: %s @ %s" % (stock.symbol, price))
-    for transaction_line in transactions:
-        amount = price * transaction_line.quantity
-        transaction_line.amount = Decimal(amount)
-        transaction_line.price = Decimal(price)
-        transaction_line.save()
+    repriced = reprice_opening_transactions(stock.simulation_id, {stock.id: price})
+    logger.info("Opening price of %s: %s (%s opening lines repriced)" % (stock.symbol, price, repriced))
 
 
 @app.task
 def open_market(simulation_id):
+    from .models import reprice_opening_transactions
     simulation = Simulation.objects.get(pk=simulation_id)
+    repriced = reprice_opening_transactions(simulation.id)
+    logger.info("Market open for simulation %s: %s opening lines repriced" % (simulation.id, repriced))
     for stock in simulation.stocks.all():
-        open_market_stock.apply_async([stock.id])
+        open_market_stock.apply_async([stock.id], queue=matching_queue(stock.id))
 
 
 @app.task
 def open_market_stock(stock_id):
-    from .models import Stock, Order
-    stock = Stock.objects.get(pk=stock_id)
-    market_orders = Order.objects.filter(stock_id=stock.id).filter(state=Order.SUBMITTED).filter(price__isnull=True).order_by('created_at')
-    if market_orders:
-        for order in market_orders:
-            check_matching_orders(order.id)
-
+    """
+    Reloads the order book of a stock in its matching worker when the market opens (or opens again after a pause) and
+    matches the orders that cross the book.
+    """
+    book = reload_book(stock_id)
+    for entry in book.crossing_orders():
+        check_matching_orders(entry.order_id)
@@ -22,18 +22,34 @@
 
 # Stdlib imports
 from datetime import datetime, timedelta
-import random, decimal
+from unittest import mock
+import random
+import decimal
+import json
+import time
 
 # Core Django imports
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.utils import timezone
 from django.core.urlresolvers import resolve
 from django.http import HttpRequest
 from django.template.loader import render_to_string
+from django.db import models
 
 # Third-party app imports
 
 # MarMix imports
-from .models import Stock, Quote
+from .models import Stock, Quote, Order, Settlement, Position, Transaction, TransactionLine, record_lines, pay_dividends
+from .engine import OrderBook
+from .auction import order_priority, clearing_price, allocate
+from .liquidity import LiquidityPolicy
+from .quotes import QuoteBuffer, TickStore, last_prices, append_ticks, rollup, price_ranges
+from simulations.streams import encode, publish_fills, publish_book
+from simulations.cache import CachedValue, CACHE_VERSION, backend, ranking, ranking_changed, get_ranking
+from simulations.models import Simulation, Team, Currency
+from customers.models import Customer
+from users.models import User
+from tickers.models import Ticker, TickerCompany, CompanyShare
 
 
 class StocksViewsTest(TestCase):
@@ -74,4 +90,360 @@ class StocksViewsTest(TestCase):
 
     def test_uses_detail_template(self):
         response = self.client.get('/stocks/%d/' % (self.first_stock.id,))
-        self.assertTemplateUsed(response, 'stocks/stock_detail.html')
\ No newline at end of file
+        self.assertTemplateUsed(response, 'stocks/stock_detail.html')
+
+
+class BookOrder(object):
+    """
+    Minimal stand-in for an order, as seen by the order book.
+    """
+    def __init__(self, id, team_id, order_type, quantity, price, minute):
+        self.id = id
+        self.stock_id = 1
+        self.team_id = team_id
+        self.order_type = order_type
+        self.quantity = quantity
+        self.price = price if price is None else decimal.Decimal(price)
+        self.created_at = datetime(2015, 1, 1) + timedelta(minutes=minute)
+
+
+class OrderBookTest(SimpleTestCase):
+
+    def setUp(self):
+        self.book = OrderBook(1)
+        self.book.add(BookOrder(1, 10, 'ASK', 100, '10.00', 0))
+        self.book.add(BookOrder(2, 11, 'ASK', 50, '9.50', 1))
+        self.book.add(BookOrder(3, 12, 'ASK', 70, '10.00', 2))
+        self.book.add(BookOrder(4, 13, 'BID', 20, '9.00', 3))
+
+    def test_market_order_takes_best_price_then_time(self):
+        market_bid = BookOrder(5, 20, 'BID', 200, None, 4)
+        self.assertEqual([entry.order_id for entry in self.book.candidates(market_bid)], [2, 1, 3])
+
+    def test_limit_order_stops_at_its_price(self):
+        limit_bid = BookOrder(5, 20, 'BID', 200, '9.75', 4)
+        self.assertEqual([entry.order_id for entry in self.book.candidates(limit_bid)], [2])
+
+    def test_same_team_never_matches(self):
+        limit_bid = BookOrder(5, 11, 'BID', 200, '10.00', 4)
+        self.assertEqual([entry.order_id for entry in self.book.candidates(limit_bid)], [1, 3])
+
+    def test_limit_order_takes_market_orders_first(self):
+        self.book.add(BookOrder(6, 14, 'BID', 30, None, 5))
+        limit_ask = BookOrder(7, 20, 'ASK', 10, '8.00', 6)
+        self.assertEqual([entry.order_id for entry in self.book.candidates(limit_ask)], [6, 4])
+
+    def test_remove_and_top_of_book(self):
+        self.book.remove(2)
+        self.book.update(BookOrder(4, 13, 'BID', 20, '9.00', 3), submitted=False)
+        top = self.book.top_of_book()
+        self.assertEqual(top['best_ask'], decimal.Decimal('10.00'))
+        self.assertEqual(top['best_bid'], None)
+        self.assertEqual(top['nb_asks'], 2)
+        self.assertEqual(self.book.asks.levels[decimal.Decimal('10.00')].quantity, 170)
+
+    def test_depth_levels(self):
+        depth = self.book.depth(levels=1)
+        self.assertEqual(depth['asks'], [(decimal.Decimal('9.50'), 50, 1)])
+        self.assertEqual(self.book.depth()['asks'][1], (decimal.Decimal('10.00'), 170, 2))
+
+    def test_deltas_since_sequence(self):
+        sequence = self.book.sequence
+        self.book.update(BookOrder(3, 12, 'ASK', 30, '9.50', 2))
+        deltas = self.book.deltas_since(sequence)
+        self.assertEqual([delta[2:] for delta in deltas], [(decimal.Decimal('9.50'), 80, 2),
+                                                           (decimal.Decimal('10.00'), 100, 1)])
+        self.assertEqual(self.book.deltas_since(self.book.sequence), [])
+        self.assertEqual(self.book.deltas_since(-1), None)
+
+    def test_remove_expired_orders(self):
+        removed = self.book.remove_orders([1, 3, 99])
+        self.assertEqual(sorted(entry.order_id for entry in removed), [1, 3])
+        self.assertEqual(self.book.deltas_since(0), [(1, 'ASK', decimal.Decimal('10.00'), 0, 0)])
+        self.assertEqual(len(self.book), 2)
+
+    def test_snapshot_keeps_price_levels_only(self):
+        self.book.update(BookOrder(3, 12, 'ASK', 30, '9.50', 2))
+        depth = self.book.snapshot()
+        self.assertFalse(hasattr(depth, 'index'))
+        self.assertEqual(depth.depth(levels=1)['asks'], [(decimal.Decimal('9.50'), 80, 2)])
+        self.assertEqual(depth.top_of_book(), self.book.top_of_book())
+        self.assertEqual(depth.deltas_since(depth.sequence - 1), self.book.deltas_since(depth.sequence - 1))
+
+    def test_crossing_orders(self):
+        self.assertEqual(self.book.crossing_orders(), [])
+        self.book.add(BookOrder(5, 20, 'BID', 10, '9.60', 4))
+        self.book.add(BookOrder(6, 21, 'BID', 10, None, 5))
+        self.assertEqual([entry.order_id for entry in self.book.crossing_orders()], [5, 6])
+
+
+class CallAuctionTest(SimpleTestCase):
+
+    def setUp(self):
+        self.bids = order_priority([BookOrder(1, 10, 'BID', 100, '10.00', 0),
+                                    BookOrder(2, 11, 'BID', 100, '9.00', 1),
+                                    BookOrder(3, 12, 'BID', 50, None, 2)], 'BID')
+        self.asks = order_priority([BookOrder(4, 13, 'ASK', 80, '8.50', 0),
+                                    BookOrder(5, 14, 'ASK', 120, '9.00', 1),
+                                    BookOrder(6, 15, 'ASK', 100, '11.00', 2)], 'ASK')
+
+    def test_priority(self):
+        self.assertEqual([o.id for o in self.bids], [3, 1, 2])
+        self.assertEqual([o.id for o in self.asks], [4, 5, 6])
+
+    def test_clearing_price_maximises_volume(self):
+        price, volume = clearing_price(self.bids, self.asks)
+        self.assertEqual(price, decimal.Decimal('9.00'))
+        self.assertEqual(volume, 200)
+
+    def test_no_cross(self):
+        bids = [BookOrder(1, 10, 'BID', 100, '8.00', 0)]
+        asks = [BookOrder(2, 11, 'ASK', 100, '9.00', 0)]
+        self.assertEqual(clearing_price(bids, asks), (None, 0))
+
+    def test_allocation_by_priority(self):
+        price, volume = clearing_price(self.bids, self.asks)
+        fills = [(sell.id, buy.id, quantity) for sell, buy, quantity in allocate(self.bids, self.asks, price, volume)]
+        self.assertEqual(fills, [(4, 3, 50), (4, 1, 30), (5, 1, 70), (5, 2, 50)])
+        self.assertEqual(sum(fill[2] for fill in fills), volume)
+
+
+class MarketStreamTest(SimpleTestCase):
+
+    @mock.patch('simulations.streams.publish')
+    def test_fills_are_sent_to_the_simulation_and_the_teams(self, publish):
+        sell = BookOrder(1, 10, 'ASK', 100, '10.00', 0)
+        buy = BookOrder(2, 11, 'BID', 60, '10.00', 1)
+        publish_fills(5, 1, 99, [(sell, buy, decimal.Decimal('10.00'), 60)])
+        groups = [call[0][0] for call in publish.call_args_list]
+        self.assertEqual(groups[0], 'simulation-5')
+        self.assertEqual(sorted(groups[1:]), ['team-10', 'team-11'])
+        self.assertEqual(publish.call_args_list[0][0][2]['trades'], [{'price': decimal.Decimal('10.00'),
+                                                                      'quantity': 60}])
+
+    @mock.patch('simulations.streams.publish')
+    def test_book_changes_are_sent_as_price_levels(self, publish):
+        book = OrderBook(1)
+        book.add(BookOrder(1, 10, 'ASK', 100, '10.00', 0))
+        book.update(BookOrder(2, 11, 'ASK', 50, '10.00', 1))
+        publish_book(5, book.snapshot(), book.deltas_since(0))
+        group, event, data = publish.call_args[0]
+        self.assertEqual((group, event), ('simulation-5', 'book'))
+        self.assertEqual(data['deltas'], [{'sequence': 1, 'order_type': 'ASK', 'price': decimal.Decimal('10.00'),
+                                           'quantity': 150, 'orders': 2}])
+
+    def test_message_format(self):
+        self.assertEqual(json.loads(encode('quote', {'stock': 1, 'price': decimal.Decimal('10.50')})),
+                         {'event': 'quote', 'data': {'stock': 1, 'price': '10.50'}})
+
+
+class QuoteBufferTest(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = {'sim_round': 1, 'sim_day': 2}
+        self.buffer = QuoteBuffer(size=3, interval=250)
+        self.timestamp = datetime(2015, 1, 1, 10, 0, 0)
+
+    def test_due_after_size_or_interval(self):
+        self.assertFalse(self.buffer.due())
+        self.buffer.add(5, 1, decimal.Decimal('10.00'), self.timestamp, self.clock)
+        self.assertFalse(self.buffer.due(now=self.buffer.since + 0.1))
+        self.assertTrue(self.buffer.due(now=self.buffer.since + 0.25))
+        self.buffer.add(5, 2, decimal.Decimal('20.00'), self.timestamp, self.clock)
+        self.buffer.add(5, 1, decimal.Decimal('10.50'), self.timestamp, self.clock)
+        self.assertTrue(self.buffer.due(now=self.buffer.since))
+        self.assertEqual(len(self.buffer.take()), 3)
+        self.assertEqual((len(self.buffer), self.buffer.since), (0, None))
+
+    def test_one_price_per_stock(self):
+        for stock_id, price in ((1, '10.00'), (2, '20.00'), (1, '10.50')):
+            self.buffer.add(5, stock_id, decimal.Decimal(price), self.timestamp, self.clock)
+        self.assertEqual(list(last_prices(self.buffer.take()).items()), [(1, (5, decimal.Decimal('10.50'))),
+                                                                         (2, (5, decimal.Decimal('20.00')))])
+
+    def test_tick_store(self):
+        store = TickStore(102)
+        quotes = [(5, 1, decimal.Decimal('10.00'), self.timestamp, 1, 1),
+                  (5, 1, decimal.Decimal('10.50'), self.timestamp + timedelta(seconds=1), 1, 2),
+                  (5, 1, decimal.Decimal('11.00'), self.timestamp + timedelta(seconds=2), 1, 2)]
+        self.assertEqual(append_ticks(store, quotes), 2)
+        ticks = store.since(store.timestamps[0])
+        self.assertEqual((ticks['sim_date'], ticks['prices']), (102, [11.0]))
+        self.assertEqual(store.since()['prices'], [10.5, 11.0])
+
+    def test_rollup_by_period(self):
+        timestamp = datetime(2015, 1, 1, 10, 0, 3, tzinfo=timezone.utc)
+        quotes = [(5, 1, decimal.Decimal(price), timestamp + timedelta(seconds=seconds), 1, 2)
+                  for price, seconds in (('10.00', 0), ('9.00', 1), ('11.00', 2), ('10.50', 60))]
+        bars = rollup(quotes)
+        bucket = int(timestamp.timestamp()) // 5 * 5
+        self.assertEqual(bars[(1, '5s', bucket)][1:6], [decimal.Decimal('10.00'), decimal.Decimal('10.00'),
+                                                        decimal.Decimal('9.00'), decimal.Decimal('9.00'), 2])
+        self.assertEqual(bars[(1, '1m', bucket)][1:6], [decimal.Decimal('10.00'), decimal.Decimal('11.00'),
+                                                        decimal.Decimal('9.00'), decimal.Decimal('11.00'), 3])
+        self.assertEqual(bars[(1, 'day', 102)][1:6], [decimal.Decimal('10.00'), decimal.Decimal('11.00'),
+                                                      decimal.Decimal('9.00'), decimal.Decimal('10.50'), 4])
+        self.assertEqual(len(bars), 6)
+
+    def test_price_ranges_of_the_last_day(self):
+        quotes = [(5, 1, decimal.Decimal(price), self.timestamp, 1, sim_day)
+                  for price, sim_day in (('12.00', 1), ('8.00', 1), ('10.00', 2), ('10.50', 2), ('9.50', 2))]
+        self.assertEqual(price_ranges(quotes)[1], [102, decimal.Decimal('9.50'), decimal.Decimal('10.50'),
+                                                   decimal.Decimal('8.00'), decimal.Decimal('12.00')])
+
+
+class LiquidityPolicyTest(SimpleTestCase):
+
+    def setUp(self):
+        self.policy = LiquidityPolicy()
+        self.top = {'best_bid': decimal.Decimal('9.80'), 'best_ask': decimal.Decimal('10.20'), 'nb_bids': 4,
+                    'nb_asks': 4}
+
+    def test_accept(self):
+        self.assertTrue(self.policy.decide(self.top, decimal.Decimal('10'), decimal.Decimal('10.20')).accept)
+
+    def test_shallow_book_or_price_out_of_band(self):
+        self.top['nb_asks'] = 3
+        self.assertFalse(self.policy.decide(self.top, decimal.Decimal('10'), decimal.Decimal('10.20')).accept)
+        self.top['nb_asks'] = 4
+        self.assertFalse(self.policy.decide(self.top, decimal.Decimal('10'), decimal.Decimal('15.50')).accept)
+        self.assertFalse(LiquidityPolicy(price_cap=10).decide(self.top, decimal.Decimal('10'),
+                                                              decimal.Decimal('10.20')).accept)
+
+    def test_reprice_in_wide_spread(self):
+        self.top['best_ask'] = decimal.Decimal('20')
+        decision = self.policy.decide(self.top, decimal.Decimal('10'), decimal.Decimal('10.20'), buy_manager=True)
+        self.assertFalse(decision.accept)
+        self.assertEqual(decision.buy_price, decimal.Decimal('10.780'))
+        self.assertEqual(decision.sell_price, None)
+
+
+class ReservationTest(SimpleTestCase):
+
+    def setUp(self):
+        self.settlement = Settlement.__new__(Settlement)
+        self.settlement.filled = {}
+
+    def test_shares_released_by_fills(self):
+        order = Order(id=1, order_type=Order.ASK, quantity=10, reserved_quantity=10)
+        self.assertEqual(self.settlement._reserved_shares(order, 4), 4)
+        self.settlement.filled[1] = 8
+        self.assertEqual(self.settlement._reserved_shares(order, 4), 2)
+
+    def test_cash_released_in_proportion(self):
+        order = Order(id=2, order_type=Order.BID, quantity=3, reserved_amount=decimal.Decimal('100.0000'))
+        self.assertEqual(self.settlement._reserved_cash(order, 1), decimal.Decimal('33.3333'))
+        self.assertEqual(self.settlement._reserved_cash(Order(id=3, quantity=5), 5), 0)
+
+
+LOCAL_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'simulation': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'simulation-tests'}}
+
+
+def deposit(simulation, team, stock, quantity, cash):
+    """
+    Books an initial deposit of shares and cash for a team.
+    """
+    initial = Transaction(simulation=simulation, transaction_type=Transaction.INITIAL, sim_round=0, sim_day=0)
+    models.Model.save(initial)
+    record_lines([
+        TransactionLine(transaction=initial, stock=stock, team=team, quantity=quantity, price=stock.price,
+                        amount=quantity * stock.price, asset_type=TransactionLine.STOCKS),
+        TransactionLine(transaction=initial, team=team, quantity=1, price=cash, amount=cash,
+                        asset_type=TransactionLine.CASH)])
+
+
+@override_settings(SIMULATION_CACHE='simulation', CACHES=LOCAL_CACHES)
+@mock.patch('simulations.streams.publish')
+@mock.patch('stocks.models.current_sim_day', return_value={'sim_round': 1, 'sim_day': 1})
+class PositionsTest(TestCase):
+
+    def setUp(self):
+        customer = Customer.objects.create(name='HEG Arc', short_code='HEG')
+        user = User.objects.create_user('trader', 'trader@example.com', 'secret')
+        currency = Currency.objects.create(code='CHF')
+        self.simulation = Simulation.objects.create(customer=customer, user=user, currency=currency,
+                                                    transaction_cost=0, variable_transaction_cost=0)
+        self.stock = Stock.objects.create(simulation=self.simulation, symbol='AAAA', name='Stock A', quantity=1000,
+                                          price=decimal.Decimal('20.0000'))
+        self.seller = Team.objects.create(customer=customer, name='Sellers', current_simulation=self.simulation)
+        self.buyer = Team.objects.create(customer=customer, name='Buyers', current_simulation=self.simulation)
+        company = TickerCompany.objects.create(ticker=Ticker.objects.create(simulation=self.simulation),
+                                               symbol='AAAA', name='Company A', stock=self.stock)
+        CompanyShare.objects.create(company=company, dividends=decimal.Decimal('2.0000'), sim_round=1)
+        deposit(self.simulation, self.seller, self.stock, 10, decimal.Decimal('1000.0000'))
+        deposit(self.simulation, self.buyer, self.stock, 0, decimal.Decimal('1000.0000'))
+
+    def position(self, team, asset_type, stock=None):
+        return Position.objects.get(simulation=self.simulation, team=team, asset_type=asset_type, stock=stock)
+
+    def order(self, team, order_type, quantity, **kwargs):
+        order = Order(stock=self.stock, team=team, order_type=order_type, quantity=quantity, price=self.stock.price,
+                      state=Order.SUBMITTED, **kwargs)
+        # Order.save() would send the order to the matching
+        models.Model.save(order)
+        return Order.objects.get(pk=order.pk)
+
+    def test_dividends_paid_once_per_round(self, *mocks):
+        self.assertEqual(pay_dividends(self.simulation.id, 1), 1)
+        self.assertEqual(pay_dividends(self.simulation.id, 1), None)
+        self.assertEqual(self.position(self.seller, TransactionLine.DIVIDENDS, self.stock).amount,
+                         decimal.Decimal('20.0000'))
+        self.assertEqual(self.position(self.seller, TransactionLine.CASH).balance, decimal.Decimal('1020.0000'))
+        self.assertEqual(TransactionLine.objects.filter(asset_type=TransactionLine.DIVIDENDS).count(), 1)
+
+    def test_positions_after_partial_fill(self, *mocks):
+        ask = self.order(self.seller, Order.ASK, 10, reserved_quantity=10)
+        bid = self.order(self.buyer, Order.BID, 4, reserved_amount=decimal.Decimal('80.0000'))
+        Position.objects.filter(team=self.seller, asset_type=TransactionLine.STOCKS).update(reserved_quantity=10)
+        Position.objects.filter(team=self.buyer, asset_type=TransactionLine.CASH).update(
+            reserved_amount=decimal.Decimal('80.0000'))
+        settlement = Settlement(self.simulation, self.stock)
+        self.assertTrue(settlement.fill(ask, bid, 4))
+        settlement.commit()
+
+        shares = self.position(self.seller, TransactionLine.STOCKS, self.stock)
+        self.assertEqual((shares.quantity, shares.reserved_quantity), (6, 6))
+        self.assertEqual(self.position(self.buyer, TransactionLine.STOCKS, self.stock).quantity, 4)
+        self.assertEqual(self.position(self.seller, TransactionLine.CASH).balance, decimal.Decimal('1080.0000'))
+        cash = self.position(self.buyer, TransactionLine.CASH)
+        self.assertEqual((cash.balance, cash.reserved_amount), (decimal.Decimal('920.0000'), 0))
+        self.assertEqual(Order.objects.get(pk=ask.pk).quantity, 4)
+        self.assertEqual(Order.objects.get(pk=bid.pk).state, Order.PROCESSED)
+        remainder = Order.objects.get(team=self.seller, state=Order.SUBMITTED)
+        self.assertEqual((remainder.quantity, remainder.price, remainder.reserved_quantity), (6, ask.price, 6))
+
+
+@override_settings(SIMULATION_CACHE='simulation', CACHES=LOCAL_CACHES)
+class SimulationCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.entry = CachedValue('test-price', lambda stock_id: self.loads.append(stock_id) or decimal.Decimal('9.50'))
+        self.entry.delete(1)
+
+    def test_miss_then_hit(self):
+        self.assertEqual(self.entry.get(1), decimal.Decimal('9.50'))
+        self.assertEqual(self.entry.get(1), decimal.Decimal('9.50'))
+        self.assertEqual(self.loads, [1])
+        self.assertEqual((self.entry.hits, self.entry.misses), (1, 1))
+
+    def test_write_through(self):
+        self.entry.set(1, decimal.Decimal('10.00'))
+        self.assertEqual(self.entry.get(1), decimal.Decimal('10.00'))
+        self.assertEqual(self.loads, [])
+
+    def test_versioned_keys(self):
+        self.entry.set(1, decimal.Decimal('10.00'))
+        self.assertEqual(backend().get(self.entry.key(1)), None)
+        self.assertEqual(backend().get(self.entry.key(1), version=CACHE_VERSION), decimal.Decimal('10.00'))
+
+    def test_changed_ranking_computed_at_most_once_per_interval(self):
+        ranking.set(1, {'teams': ['old'], 'computed_at': time.time()})
+        ranking_changed.set(1, True)
+        with mock.patch('simulations.cache._load_ranking', return_value={'teams': ['new'], 'computed_at': 0}):
+            self.assertEqual(get_ranking(1), ['old'])
+            ranking.set(1, {'teams': ['old'], 'computed_at': time.time() - 5})
+            self.assertEqual(get_ranking(1), ['new'])
+        self.assertEqual(ranking_changed.peek(1), None)
@@ -22,6 +22,7 @@
 
 # Stdlib imports
 from hashlib import sha256
+import datetime
 import json
 import logging
 import collections
@@ -41,24 +42,30 @@ from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.contrib import messages
 from django.utils.decorators import method_decorator
-from django.db.models import Sum, Count
+from django.utils import timezone
+from django.db import transaction
 
 
 # Third-party app imports
-from rest_framework import permissions, viewsets, status, filters
+from rest_framework import permissions, viewsets, status, filters, serializers
 from rest_framework.response import Response
+from rest_framework.decorators import list_route
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 
 
 # MarMix imports
-from .models import Stock, Quote, Order, TransactionLine, dividends_list
+from .models import Stock, Quote, QuoteBar, Order, TransactionLine, dividends_list, reserve_order, release_reservations
 from .serializers import StockSerializer, QuoteSerializer, OrderSerializer, CreateOrderSerializer, NestedStockSerializer
 from .filters import QuoteFilter
+from .engine import get_depth
 from simulations.models import current_sim_day, current_holdings
+from simulations import cache as simulation_cache
 
 logger = logging.getLogger(__name__)
 
+NOT_ENOUGH_FUNDS = _("You do not have enough cash or shares available for this order (your open orders included).")
+
 
 class StockListView(ListView):
 
@@ -146,6 +153,66 @@ class QuoteViewSet(viewsets.ModelViewSet):
     filter_class = QuoteFilter
     ordering_fields = ('-timestamp')
 
+    @list_route()
+    def ticks(self, request):
+        """
+        The ticks of the day of a stock, as parallel lists (see :class:`stocks.quotes.TickStore`).
+
+        ``?stock=ID`` is required, ``?since=T`` (seconds since the epoch) returns only the ticks after T.
+        """
+        try:
+            stock_id = int(request.query_params['stock'])
+        except (KeyError, ValueError):
+            return Response({'detail': 'The stock parameter is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            since = float(request.query_params['since'])
+        except (KeyError, ValueError):
+            since = None
+        store = simulation_cache.ticks.get(stock_id)
+        if store is None:
+            raise Http404
+        ticks = store.since(since)
+        ticks['stock'] = stock_id
+        return Response(ticks, status=status.HTTP_200_OK)
+
+    @list_route()
+    def bars(self, request):
+        """
+        The bars of a stock as parallel lists (see :class:`stocks.models.QuoteBar`).
+
+        ``?stock=ID`` is required, ``?interval=`` is 5s, 1m (default) or day and ``?since=T`` (seconds since the
+        epoch) returns only the bars from T on. The timestamps are the start of the periods (the first quote of the
+        day for the day bars).
+        """
+        try:
+            stock_id = int(request.query_params['stock'])
+        except (KeyError, ValueError):
+            return Response({'detail': 'The stock parameter is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        interval = request.query_params.get('interval', QuoteBar.MINUTE)
+        if interval not in dict(QuoteBar.PERIOD_CHOICES):
+            return Response({'detail': 'The interval must be 5s, 1m or day.'}, status=status.HTTP_400_BAD_REQUEST)
+        bars = QuoteBar.objects.filter(stock_id=stock_id, period=interval).order_by('bucket')
+        try:
+            since = float(request.query_params['since'])
+        except (KeyError, ValueError):
+            since = None
+        if since is not None:
+            if interval == QuoteBar.DAY:
+                bars = bars.filter(start__gte=datetime.datetime.fromtimestamp(since, timezone.utc))
+            else:
+                bars = bars.filter(bucket__gte=int(since))
+        columns = {'stock': stock_id, 'interval': interval, 'timestamps': [], 'open': [], 'high': [], 'low': [],
+                   'close': [], 'quotes': []}
+        for bucket, start, price_open, high, low, close, nb_quotes in bars.values_list(
+                'bucket', 'start', 'price_open', 'price_high', 'price_low', 'price_close', 'nb_quotes'):
+            columns['timestamps'].append(start.timestamp() if interval == QuoteBar.DAY else bucket)
+            columns['open'].append(float(price_open))
+            columns['high'].append(float(high))
+            columns['low'].append(float(low))
+            columns['close'].append(float(close))
+            columns['quotes'].append(nb_quotes)
+        return Response(columns, status=status.HTTP_200_OK)
+
 
 class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
@@ -176,7 +243,28 @@ class CreateOrderViewSet(viewsets.ModelViewSet):
         return Order.objects.filter(team=user.get_team)
 
     def perform_create(self, serializer):
-        serializer.save(team=self.request.user.get_team)
+        team = self.request.user.get_team
+        with transaction.atomic():
+            order = Order(team=team, **serializer.validated_data)
+            if not reserve_order(order):
+                raise serializers.ValidationError(NOT_ENOUGH_FUNDS)
+            serializer.save(team=team, reserved_quantity=order.reserved_quantity,
+                            reserved_amount=order.reserved_amount)
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            current = Order.objects.select_for_update().get(pk=serializer.instance.pk)
+            if current.state not in (Order.SUBMITTED, Order.SCHEDULED):
+                raise serializers.ValidationError(_("This order is not open anymore."))
+            release_reservations(current.stock.simulation_id, [current])
+            for field, value in serializer.validated_data.items():
+                setattr(current, field, value)
+            current.reserved_quantity, current.reserved_amount = 0, 0
+            if not reserve_order(current):
+                raise serializers.ValidationError(NOT_ENOUGH_FUNDS)
+            # Saved through the locked row, a fill or a cancellation since the request was read is kept
+            serializer.instance = current
+            serializer.save()
 
 
 class OrderCreateView(SuccessMessageMixin, CreateView):
@@ -192,7 +280,11 @@ class OrderCreateView(SuccessMessageMixin, CreateView):
     def form_valid(self, form):
         team = self.request.user.get_team
         form.instance.team = team
-        return super(OrderCreateView, self).form_valid(form)
+        with transaction.atomic():
+            if not reserve_order(form.instance):
+                form.add_error(None, NOT_ENOUGH_FUNDS)
+                return self.form_invalid(form)
+            return super(OrderCreateView, self).form_valid(form)
 
     def get_success_url(self):
         return reverse('holdings-list-view')
@@ -218,7 +310,22 @@ class OrderUpdateView(SuccessMessageMixin, UpdateView):
         return context
 
     def form_valid(self, form):
-        return super(OrderUpdateView, self).form_valid(form)
+        with transaction.atomic():
+            current = Order.objects.select_for_update().get(pk=form.instance.pk)
+            if current.state not in (Order.SUBMITTED, Order.SCHEDULED):
+                form.add_error(None, _("This order is not open anymore."))
+                return self.form_invalid(form)
+            release_reservations(current.stock.simulation_id, [current])
+            # Saved through the locked row, a fill or a cancellation since the form was read is kept
+            for field in form.fields:
+                setattr(current, field, getattr(form.instance, field))
+            form.instance = current
+            form.instance.reserved_quantity, form.instance.reserved_amount = 0, 0
+            if not reserve_order(form.instance):
+                transaction.set_rollback(True)
+                form.add_error(None, NOT_ENOUGH_FUNDS)
+                return self.form_invalid(form)
+            return super(OrderUpdateView, self).form_valid(form)
 
     def get_success_url(self):
         return reverse('holdings-list-view')
@@ -261,25 +368,62 @@ class DividendsViewSet(viewsets.ViewSet):
         return response
 
 
+def order_book_rows(depth, current_price):
+    """
+    Merges the bids and asks of a depth snapshot by descending price and inserts the current price of the stock as a
+    MARKET row.
+    """
+    levels = [(price, quantity, orders, Order.ASK) for price, quantity, orders in depth['asks']]
+    levels += [(price, quantity, orders, Order.BID) for price, quantity, orders in depth['bids']]
+    levels.sort(key=lambda level: level[0], reverse=True)
+    order_book = []
+    last_order_price = None
+    for price, quantity, orders, order_type in levels:
+        if not last_order_price:
+            last_order_price = price
+            if current_price > last_order_price:
+                order_book.append({'price': current_price, 'quantity': 0, 'orders': 0, 'order_type': 'MARKET'})
+        if last_order_price > current_price > price:
+            order_book.append({'price': current_price, 'quantity': 0, 'orders': 0, 'order_type': 'MARKET'})
+        order_book.append({'price': price, 'quantity': quantity, 'orders': orders, 'order_type': order_type})
+        last_order_price = price
+    if not last_order_price:
+        order_book.append({'price': current_price, 'quantity': 0, 'orders': 0, 'order_type': 'MARKET'})
+    return order_book
+
+
 class OrderBookViewSet(viewsets.ViewSet):
+    """
+    Price levels of a stock, served from the shared order book (see :func:`stocks.engine.get_depth`).
+
+    ``?levels=N`` limits the number of levels on each side (N >= 1). ``?since=S`` returns only the changes made after
+    the sequence number ``S``, or a new snapshot if these changes are no longer available.
+    """
 
     def retrieve(self, request, pk=None):
         stock = get_object_or_404(Stock, pk=pk)
-        orders = Order.objects.filter(stock=stock, state=Order.SUBMITTED, price__gt=0).values('price',
-                                      'order_type').annotate(qty=Sum('quantity'), orders=Count('id')).order_by('-price')
-        current_price = stock.price
-        order_book = []
-        last_order_price = None
-        for order in orders:
-            if not last_order_price:
-                last_order_price = order['price']
-                if current_price > last_order_price:
-                    order_book.append({'price': current_price, 'quantity': 0, 'orders': 0, 'order_type': 'MARKET'})
-            if last_order_price > current_price > order['price']:
-                order_book.append({'price': current_price, 'quantity': 0, 'orders': 0, 'order_type': 'MARKET'})
-            order_book.append({'price': order['price'], 'quantity': order['qty'], 'orders': order['orders'], 'order_type': order['order_type']})
-            last_order_price = order['price']
-        if not last_order_price:
-            order_book.append({'price': current_price, 'quantity': 0, 'orders': 0, 'order_type': 'MARKET'})
+        levels = None
+        if 'levels' in request.query_params:
+            try:
+                levels = int(request.query_params['levels'])
+            except ValueError:
+                levels = 0
+            if levels < 1:
+                return Response({'detail': 'The levels must be a positive number.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+        book = get_depth(stock.id)
+        if 'since' in request.query_params:
+            try:
+                deltas = book.deltas_since(int(request.query_params['since']))
+            except ValueError:
+                deltas = None
+            if deltas is not None:
+                deltas = [{'sequence': sequence, 'order_type': order_type, 'price': price, 'quantity': quantity,
+                           'orders': orders} for sequence, order_type, price, quantity, orders in deltas]
+                return Response({'sequence': book.sequence, 'deltas': deltas}, status=status.HTTP_200_OK)
+            snapshot = order_book_rows(book.depth(levels), stock.price)
+            return Response({'sequence': book.sequence, 'snapshot': snapshot}, status=status.HTTP_200_OK)
+        order_book = order_book_rows(book.depth(levels), stock.price)
         response = Response(order_book, status=status.HTTP_200_OK)
-        return response
\ No newline at end of file
+        response['X-Book-Sequence'] = book.sequence
+        return response
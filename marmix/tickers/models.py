@@ -27,7 +27,6 @@ import re
 # Core Django imports
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
-from django.core.cache import cache
 from django.utils import timezone
 from django import forms
 
@@ -57,6 +56,7 @@ class Ticker(TimeStampedModel):
     interest_rate = models.DecimalField(verbose_name=_("interest rate"), max_digits=14, decimal_places=4,
                                         default='3.0000', help_text=_("Interest rate retributing portfolios. To disable retribution of cash, set to 0.00"))
     fixed_interest_rate = models.BooleanField(verbose_name=_("fixed interest rate"), default=False, help_text=_("If fixed, the interest rate will not vary accross time"))
+    seed = models.IntegerField(verbose_name=_("random seed"), null=True, blank=True, help_text=_("Seed of the simulated financials (drawn at initialization if empty)"))
     # TODO: Add fields needed for the live simulation
     host = models.CharField(verbose_name=_("ERPsim host"), max_length=60, null=True, blank=True,
                             help_text=_("For example: i02lp1.informatik.tu-muenchen.de"))
@@ -80,20 +80,10 @@ class Ticker(TimeStampedModel):
         ordering = ['simulation']
 
     def _last_tick(self):
-        tick = cache.get('tick-%s' % self.simulation_id)
-        if tick:
-            last_tick = tick
-        else:
-            try:
-                last_tick = self.ticks.all()[0]
-            except IndexError:
-                last_tick = None
-        return last_tick
+        return self.ticks.first()
     last_tick = property(_last_tick)
 
     def save(self, *args, **kwargs):
-        if self.simulation_id:
-            cache.delete('ticker-%s' % self.simulation_id)
         if not self.userkey:
             self.userkey = re.sub(r'\W+', '', '%s%s' % (self.simulation.customer.short_code.upper(), self.simulation_id))
         super(Ticker, self).save(*args, **kwargs)
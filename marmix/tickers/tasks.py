@@ -22,8 +22,9 @@
 
 # Stdlib imports
 from __future__ import absolute_import
+from contextlib import contextmanager
 import datetime
-from decimal import Decimal, getcontext
+from decimal import Decimal
 from random import randint
 import time
 import re
@@ -32,22 +33,31 @@ import xml.etree.ElementTree as ET
 # Core Django imports
 from django.core.cache import cache
 from django.utils import timezone
-from django.db.models import Sum
-from django.db import connection
+from django.db import connection, transaction
 from django.conf import settings
 
 # Third-party app imports
 import numpy as np
 import requests
+from celery.utils.log import get_task_logger
 from bs4 import BeautifulSoup
 import pymssql
 
 # MarMix imports
 from config.celery import app
-from simulations.models import Simulation, SimDay, Team, current_sim_day, current_shares
-from stocks.models import Stock, Order, TransactionLine, Transaction, process_order
+from simulations.models import Simulation, SimDay, current_sim_day
+from simulations import cache as simulation_cache
+from stocks.models import Stock, Order, TransactionLine, Settlement, Position, finalize_historical_prices, \
+    activate_scheduled_orders, expire_day_orders, pay_dividends, set_initial_prices, \
+    reprice_opening_transactions, set_stock_price
+from stocks.auction import order_priority, clearing_price, allocate
+from stocks.tasks import matching_queue
+from stocks.engine import get_book
 from tickers.models import Ticker, TickerCompany, CompanyFinancial, CompanyShare
-from .utils import geometric_brownian
+from .utils import geometric_brownian, company_financials
+
+# Get an instance of a logger
+logger = get_task_logger(__name__)
 
 
 def dictfetchall(cursor):
@@ -178,40 +188,100 @@ def update_mssql_time(simulation_id):
     conn.close()
 
 
+TICK_METRICS_KEY = 'tick-metrics'
+
+
+@contextmanager
+def tick_phase(metrics, phase):
+    """
+    Adds the duration of a phase of the tick (in milliseconds) to the metrics.
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        metrics['timings'][phase] = metrics['timings'].get(phase, 0) + (time.time() - started) * 1000
+
+
+def new_tick_metrics(now):
+    return {'timestamp': now, 'simulations': 0, 'rollovers': 0, 'scheduled': 0, 'activated': 0, 'timings': {}}
+
+
 @app.task
 def main_ticker_task():
-    # Called every X seconds by Celery-BEAT (value fixed in config/common.py)
-    running_simulations = Simulation.objects.all().filter(state=Simulation.RUNNING)
+    """
+    Called every X seconds by Celery-BEAT (value fixed in config/common.py).
+
+    All the running simulations are processed in this single task: the clocks are pushed, the orders of the liquidity
+    trader are created at once with their activation time and the scheduled orders that are due are submitted. The
+    timings of the tick are logged and kept in the cache (see :func:`last_tick_metrics`).
+
+    :return: The metrics of the tick.
+    """
+    started = time.time()
+    now = timezone.now()
+    metrics = new_tick_metrics(now)
+    running_simulations = Simulation.objects.select_related('ticker').filter(state=Simulation.RUNNING)
     for simulation in running_simulations:
-        next_tick(simulation.id)
-    print(running_simulations)
-    return 'Tick-tack'
+        tick_simulation(simulation, now, metrics)
+    with tick_phase(metrics, 'activation'):
+        metrics['activated'] = activate_scheduled_orders(now)
+    metrics['timings']['total'] = (time.time() - started) * 1000
+    cache.set(TICK_METRICS_KEY, metrics, None)
+    logger.info("Tick: %s simulations, %s rollovers, %s orders scheduled, %s activated in %.1f ms" %
+                (metrics['simulations'], metrics['rollovers'], metrics['scheduled'], metrics['activated'],
+                 metrics['timings']['total']))
+    return metrics
+
+
+def last_tick_metrics():
+    return cache.get(TICK_METRICS_KEY)
 
 
 @app.task
 def next_tick(simulation_id):
     simulation = Simulation.objects.select_related('ticker').get(pk=simulation_id)
-    last_clock = current_sim_day(simulation_id)
-    clock = True
-    # We have two sorts of clocks: internal or external
-    if simulation.simulation_type == Simulation.LIVE:
-        # The clock is external
-        current_round, current_day = clock_erpsim(simulation_id)
-        if not current_round or not current_day:
-            clock = False
-    else:
-        # The clock is internal
-        if last_clock['timestamp'] < timezone.now()-datetime.timedelta(seconds=simulation.ticker.day_duration):
-            current_round = last_clock['sim_round']
-            current_day = last_clock['sim_day']+1
+    now = timezone.now()
+    metrics = new_tick_metrics(now)
+    tick_simulation(simulation, now, metrics)
+    return metrics
+
+
+def tick_simulation(simulation, now, metrics):
+    """
+    Pushes the clock of a simulation and runs the end of day jobs when the day is over.
+
+    :param simulation: A simulation object (with its ticker).
+    :param now: The time of the tick.
+    :param metrics: The metrics of the tick, updated in place.
+    """
+    simulation_id = simulation.id
+    metrics['simulations'] += 1
+    with tick_phase(metrics, 'clock'):
+        last_clock = current_sim_day(simulation_id)
+        clock = True
+        # We have two sorts of clocks: internal or external
+        if simulation.simulation_type == Simulation.LIVE:
+            # The clock is external
+            current_round, current_day = clock_erpsim(simulation_id)
+            if not current_round or not current_day:
+                clock = False
         else:
-            current_round = last_clock['sim_round']
-            current_day = last_clock['sim_day']
+            # The clock is internal
+            if last_clock['timestamp'] < now-datetime.timedelta(seconds=simulation.ticker.day_duration):
+                current_round = last_clock['sim_round']
+                current_day = last_clock['sim_day']+1
+            else:
+                current_round = last_clock['sim_round']
+                current_day = last_clock['sim_day']
     if clock:
         if last_clock['sim_round'] != 0:
             # We push the clock
             if last_clock['sim_day'] != current_day:
-                cleanup_open_orders.apply_async(args=[simulation_id, last_clock['sim_round'], last_clock['sim_day']])
+                metrics['rollovers'] += 1
+                with tick_phase(metrics, 'cleanup'):
+                    cleanup_open_orders(simulation_id)
+                    finalize_historical_prices(simulation_id, last_clock['sim_round'], last_clock['sim_day'])
                 if last_clock['sim_day'] == simulation.ticker.nb_days:
                     if last_clock['sim_round'] == simulation.ticker.nb_rounds:
                         simulation.state = Simulation.FINISHED
@@ -229,10 +299,10 @@ def next_tick(simulation_id):
                 else:
                     sim_day = SimDay(simulation=simulation, sim_round=current_round, sim_day=current_day, state=simulation.state)
                     sim_day.save()
-                    stocks = Stock.objects.all().filter(simulation_id=simulation.id)
-                    for stock in stocks:
-                        liquidity_trader_order.apply_async(args=[simulation.id, stock.id])
-                    market_maker.apply_async(args=[simulation.id])
+                    with tick_phase(metrics, 'liquidity'):
+                        metrics['scheduled'] += schedule_liquidity_orders(simulation, now)
+                    with tick_phase(metrics, 'market_maker'):
+                        market_maker(simulation.id)
                 if simulation.simulation_type == Simulation.INDEXED:
                     update_mssql_time(simulation.id)
                 print("Next tick processed: SIM: %s - R%sD%s @ %s" %
@@ -241,117 +311,131 @@ def next_tick(simulation_id):
             # First start of the simulation
             sim_day = SimDay(simulation=simulation, sim_round=1, sim_day=1, state=simulation.state)
             sim_day.save()
-            stocks = Stock.objects.all().filter(simulation_id=simulation.id)
-            for stock in stocks:
-                liquidity_trader_order.apply_async(args=[simulation.id, stock.id])
+            with tick_phase(metrics, 'liquidity'):
+                metrics['scheduled'] += schedule_liquidity_orders(simulation, now)
 
 
 @app.task
-def create_company_live(simulation_id, stock_id):
-    simulation = Simulation.objects.get(pk=simulation_id)
-    stock = Stock.objects.get(pk=stock_id)
-    ticker = Ticker.objects.get(simulation=simulation)
-    company = TickerCompany(ticker=ticker, stock=stock, symbol=stock.symbol, name="Company %s" % stock.symbol)
-    company.save()
+def create_companies_live(simulation_id):
+    """
+    Creates the companies of all the stocks of a live (or indexed) simulation with a single insert.
+
+    :return: The number of companies created.
+    """
+    ticker = Ticker.objects.get(simulation_id=simulation_id)
+    stocks = Stock.objects.filter(simulation_id=simulation_id).order_by('id')
+    companies = [TickerCompany(ticker=ticker, stock=stock, symbol=stock.symbol, name="Company %s" % stock.symbol)
+                 for stock in stocks]
+    TickerCompany.objects.bulk_create(companies)
+    return len(companies)
 
 
 @app.task
-def create_company_simulation(simulation_id, stock_id):
-    getcontext().prec = 4
+def create_companies_simulation(simulation_id):
+    """
+    Creates the simulated companies of all the stocks of a simulation, with their daily financials and their shares.
+
+    The dividend paths of all the companies are drawn from the seed of the ticker (drawn and saved if not set), so
+    that the financials of a simulation can be generated again. The financials are computed at once by
+    :func:`tickers.utils.company_financials` and inserted with a few bulk queries.
+
+    :param simulation_id: The simulation id.
+    :return: The number of companies created.
+    """
     mu = 0.02
     sigma = 0.1
     simulation = Simulation.objects.get(pk=simulation_id)
-    stock = Stock.objects.get(pk=stock_id)
     ticker = Ticker.objects.get(simulation=simulation)
-    company = TickerCompany(ticker=ticker, stock=stock, symbol=stock.symbol, name="Company %s" % stock.symbol)
-    company.save()
-    rounds = ticker.nb_rounds + 1
-    brownian_motion = geometric_brownian(rounds, mu, sigma, ticker.initial_value, rounds/(ticker.nb_days*rounds), stock_id)
-    i = 0
-    simulation_dividends = []
-    simulation_net_income = []
-    for sim_round in range(0, rounds):
-        round_dividend = 0
-        round_net_income = 0
-        for sim_day in range(1, ticker.nb_days+1):
-            # We have each round/day and the corresponding dividend
-            daily_dividend = brownian_motion[i]
-            daily_net_income = brownian_motion[i] / float(ticker.dividend_payoff_rate) * 100 * stock.quantity
-            c = CompanyFinancial(company=company, daily_dividend=Decimal(daily_dividend), daily_net_income=Decimal(daily_net_income),
-                                 sim_round=sim_round, sim_day=sim_day, sim_date=sim_round*100+sim_day)
-            c.save()
-            round_dividend += daily_dividend
-            round_net_income += daily_net_income
-            i += 1
-        simulation_dividends.append(round_dividend)
-        simulation_net_income.append(round_net_income)
-
-    # Share price estimation
-    G = simulation_dividends[-1]/simulation_dividends[-2]-1
-    R = 0.15
-    g = R
-    drift = 0
-    simulation_stock_price = []
-    previous_company_income = None
-    for sim_round in range(0, rounds):
-        stock_price = np.npv(0.15, simulation_dividends[sim_round:rounds]) + (simulation_dividends[-1]*(1+g)/(R-G))/np.power(1+R, rounds-sim_round)
-        simulation_stock_price.append(stock_price)
-        if previous_company_income:
-            drift = simulation_net_income[sim_round] / float(previous_company_income.net_income) - 1
-            previous_company_income.drift = Decimal(drift)
-            previous_company_income.save()
-        company_share = CompanyShare(company=company, share_value=Decimal(stock_price), dividends=Decimal(simulation_dividends[sim_round]),
-                                     net_income=Decimal(simulation_net_income[sim_round]), drift=Decimal(drift), sim_round=sim_round)
-        company_share.save()
-        previous_company_income = company_share
-        if sim_round == 0:
-            stock.price = Decimal(stock_price)
-            stock.save()
-    return company.id
+    if ticker.seed is None:
+        ticker.seed = randint(0, 2**31-1)
+        ticker.save()
+    stocks = list(Stock.objects.filter(simulation_id=simulation.id).order_by('id'))
+    if not stocks:
+        return 0
+    TickerCompany.objects.bulk_create([TickerCompany(ticker=ticker, stock=stock, symbol=stock.symbol,
+                                                     name="Company %s" % stock.symbol) for stock in stocks])
+    companies = dict(TickerCompany.objects.filter(ticker=ticker).values_list('stock_id', 'id'))
 
+    rounds = ticker.nb_rounds + 1
+    random = np.random.RandomState(ticker.seed)
+    paths = geometric_brownian(len(stocks), rounds, mu, sigma, ticker.initial_value, 1/ticker.nb_days, random)
+    financials = company_financials(paths, ticker.nb_days, ticker.dividend_payoff_rate,
+                                    [stock.quantity for stock in stocks])
+
+    daily_financials = []
+    company_shares = []
+    for c, stock in enumerate(stocks):
+        company_id = companies[stock.id]
+        i = 0
+        for sim_round in range(0, rounds):
+            for sim_day in range(1, ticker.nb_days+1):
+                daily_financials.append(CompanyFinancial(
+                    company_id=company_id, daily_dividend=Decimal(float(paths[c, i])),
+                    daily_net_income=Decimal(float(financials['daily_net_income'][c, i])),
+                    sim_round=sim_round, sim_day=sim_day, sim_date=sim_round*100+sim_day))
+                i += 1
+            company_shares.append(CompanyShare(
+                company_id=company_id, share_value=Decimal(float(financials['share_value'][c, sim_round])),
+                dividends=Decimal(float(financials['dividends'][c, sim_round])),
+                net_income=Decimal(float(financials['net_income'][c, sim_round])),
+                drift=Decimal(float(financials['drift'][c, sim_round])), sim_round=sim_round))
+    CompanyFinancial.objects.bulk_create(daily_financials, batch_size=1000)
+    CompanyShare.objects.bulk_create(company_shares, batch_size=1000)
+    set_initial_prices(dict((stock.id, Decimal(float(financials['share_value'][c, 0])))
+                            for c, stock in enumerate(stocks)))
+    return len(stocks)
+
+
+def liquidity_orders(simulation, stock_id, team_id, shares, now):
+    """
+    The two market orders (a bid and an ask, in random order) placed by the liquidity trader on a stock during the
+    simulation day. Each order is activated at a random time of the first three quarters of the day.
 
-@app.task
-def liquidity_trader_order(simulation_id, stock_id):
-    simulation = Simulation.objects.get(pk=simulation_id)
-    stock = Stock.objects.get(pk=stock_id)
-    team = Team.objects.get(current_simulation_id=simulation_id, team_type=Team.LIQUIDITY_MANAGER)
-    shares = current_shares(team.id, stock.id)
+    :param shares: The number of shares of the stock held by the liquidity trader.
+    :return: A list of unsaved scheduled orders.
+    """
     day_duration = simulation.ticker.day_duration
+    clock = current_sim_day(simulation.id)
     first_order_type = [Order.BID, Order.ASK]
     second_order_type = first_order_type.pop(randint(0, 1))
     first_order_type = first_order_type[0]
     first_order_time = randint(0, int(day_duration/4*3/2))
     second_order_time = int(day_duration/4*3/2) - first_order_time + randint(0, int(day_duration/4*3/2))
 
-    #open_quantity = Order.objects.all().filter(stock_id=stock.id, order_type=second_order_type, price__isnull=False, quantity__lt=200).aggregate(Sum('quantity'))['quantity__sum']
-    #if open_quantity:
-    quantity = randint(0, int(shares*0.05))
-    if quantity > 0:
-        create_order.apply_async(args=[stock.id, team.id, first_order_type, quantity], countdown=first_order_time)
-    #open_quantity = Order.objects.all().filter(stock_id=stock.id, order_type=first_order_type, price__isnull=False, quantity__lt=200).aggregate(Sum('quantity'))['quantity__sum']
-    #if open_quantity:
-    quantity = randint(0, int(shares*0.05))
-    if quantity > 0:
-        create_order.apply_async(args=[stock.id, team.id, second_order_type, quantity], countdown=second_order_time)
+    orders = []
+    for order_type, countdown in ((first_order_type, first_order_time), (second_order_type, second_order_time)):
+        quantity = randint(0, int(shares*0.05))
+        if quantity > 0:
+            orders.append(Order(stock_id=stock_id, team_id=team_id, order_type=order_type, quantity=quantity,
+                                state=Order.SCHEDULED, activate_at=now+datetime.timedelta(seconds=countdown),
+                                time_in_force=Order.DAY,
+                                sim_round=clock['sim_round'], sim_day=clock['sim_day']))
+    return orders
 
 
-@app.task
-def create_order(stock_id, team_id, order_type, quantity):
-    stock = Stock.objects.get(pk=stock_id)
-    team = Team.objects.get(pk=team_id)
-    new_order = Order(stock=stock, team=team, order_type=order_type, quantity=quantity)
-    new_order.save()
-    print("New order created: %s %s %s" % (stock.symbol, order_type, quantity))
+def schedule_liquidity_orders(simulation, now):
+    """
+    Creates the orders of the liquidity trader for all the stocks of a simulation in one query.
+
+    :return: The number of orders scheduled.
+    """
+    team_id = simulation_cache.liquidity_manager.get(simulation.id)
+    if team_id is None:
+        return 0
+    shares = dict(Position.objects.filter(simulation_id=simulation.id, team_id=team_id,
+                                          asset_type=TransactionLine.STOCKS).values_list('stock_id', 'quantity'))
+    orders = []
+    for stock_id in Stock.objects.filter(simulation_id=simulation.id).values_list('id', flat=True):
+        orders += liquidity_orders(simulation, stock_id, team_id, shares.get(stock_id, 0), now)
+    Order.objects.bulk_create(orders)
+    return len(orders)
 
 
 @app.task
-def cleanup_open_orders(simulation_id, current_round, current_day):
-    team = Team.objects.get(current_simulation_id=simulation_id, team_type=Team.LIQUIDITY_MANAGER)
-    print("Time to cleanup old liquidity trader orders for trader %s" % team)
-    orders = Order.objects.filter(team_id=team.id, transaction__isnull=True, sim_round=current_round, sim_day=current_day)
-    for order in orders:
-        order.state = Order.FAILED
-        order.save()
+def cleanup_open_orders(simulation_id):
+    expired = expire_day_orders(simulation_id)
+    print("Time to cleanup the day orders: %s orders expired" % expired)
+    return expired
 
 
 def retrieve_erpsim_netincome_live(simulation_id):
@@ -385,39 +469,40 @@ def retrieve_erpsim_netincome_live(simulation_id):
 def prepare_dividends_payments(simulation_id, current_round):
     simulation = Simulation.objects.get(pk=simulation_id)
     if simulation.simulation_type == Simulation.INTRO or simulation.simulation_type == Simulation.ADVANCED or simulation.simulation_type == Simulation.INDEXED or simulation.simulation_type == Simulation.LIVE:
-        companies = TickerCompany.objects.filter(ticker__simulation_id=simulation.id)
-        for company in companies:
-            stock_id = company.stock_id
-            share = CompanyShare.objects.get(company_id=company.id, sim_round=current_round)
-            dividend = share.dividends
-            tl = TransactionLine.objects.filter(stock_id=stock_id).filter(asset_type=TransactionLine.STOCKS).filter(transaction__sim_round__lte=current_round).values('team').annotate(quantity=Sum('quantity')).order_by('team')
-            if tl:
-                execute_dividends_payments.apply_async(args=[simulation.id, stock_id, tl, dividend])
+        nb_lines = pay_dividends(simulation.id, current_round)
+        if nb_lines is None:
+            logger.info("Dividends of round %s already paid for simulation %s" % (current_round, simulation.id))
+        else:
+            logger.info("%s dividends paid for round %s of simulation %s" % (nb_lines, current_round, simulation.id))
     else:
         # TODO Calculate the dividends based on the MSSQL server data
         pass
 
 
-@app.task
-def execute_dividends_payments(simulation_id, stock_id, tl, dividend):
-    simulation = Simulation.objects.get(pk=simulation_id)
-    stock = Stock.objects.get(pk=stock_id)
-    transaction = Transaction(simulation=simulation, transaction_type=Transaction.EOR)
-    transaction.save()
-    for line in tl:
-        team = Team.objects.get(pk=line['team'])
-        transaction_line = TransactionLine(transaction=transaction, stock=stock, team=team, quantity=line['quantity'], price=dividend, amount=line['quantity']*dividend, asset_type=TransactionLine.DIVIDENDS)
-        transaction_line.save()
-
-
 @app.task
 def set_closing_price(simulation_id):
+    """
+    Sets the price of all the stocks of a simulation to the share value of the current round with a single UPDATE.
+    The stocks without an opening price take it as well and their opening transactions are repriced.
+
+    :return: The number of stocks priced.
+    """
     simulation = Simulation.objects.get(pk=simulation_id)
-    stocks = simulation.stocks.all()
-    for stock in stocks:
-        share = CompanyShare.objects.get(company__stock=stock, sim_round=simulation.get_sim_day['sim_round'])
-        stock.price = share.share_value
-        stock.save()
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute('UPDATE stocks_stock s SET price=cs.share_value, '
+                       'opening_price=CASE WHEN COALESCE(s.opening_price, 0)=0 AND cs.share_value<>0 '
+                       'THEN cs.share_value ELSE s.opening_price END '
+                       'FROM tickers_tickercompany c, tickers_companyshare cs '
+                       'WHERE c.stock_id=s.id AND cs.company_id=c.id AND cs.sim_round=%s AND s.simulation_id=%s '
+                       'RETURNING s.id, s.price',
+                       [simulation.get_sim_day['sim_round'], simulation.id])
+        prices = cursor.fetchall()
+        for stock_id, price in prices:
+            simulation_cache.stock_price.set_on_commit(stock_id, price)
+        simulation_cache.mark_ranking(simulation.id)
+        reprice_opening_transactions(simulation.id)
+    return len(prices)
 
 
 def retrieve_open_market_orders(simulation_id):
@@ -436,65 +521,75 @@ def retrieve_open_market_orders(simulation_id):
 
 @app.task
 def market_maker(simulation_id):
-    simulation = Simulation.objects.get(pk=simulation_id)
-    # We process all matching orders
-    # TODO We do not match market orders. We need to match NULL price on one side
-    cursor = connection.cursor()
-    cursor.execute('SELECT s.symbol as symbol, a.id as ask_id, b.id as bid_id, a.quantity as ask_qty, b.quantity as bid_qty '
-                   'FROM stocks_order a '
-                   'LEFT OUTER JOIN stocks_order b ON a.stock_id = b.stock_id AND round(a.price,2) = round(b.price,2) '
-                   'LEFT JOIN stocks_stock s ON a.stock_id = s.id '
-                   'WHERE a.order_type=%s AND b.order_type=%s AND a.state=%s AND b.state=%s AND a.team_id != b.team_id AND s.simulation_id=%s',
-                   [Order.ASK, Order.BID, Order.SUBMITTED, Order.SUBMITTED, simulation.id])
-    orders_list = dictfetchall(cursor)
-    for order in orders_list:
-        print("Matching order for stock %s" % order['symbol'])
-        if order['ask_qty'] > order['bid_qty']:
-            quantity = order['bid_qty']
-        elif order['ask_qty'] < order['bid_qty']:
-            quantity = order['ask_qty']
-        else:
-            quantity = order['bid_qty']
-        sell_order = Order.objects.get(pk=order['ask_id'])
-        buy_order = Order.objects.get(pk=order['bid_id'])
-        process_order(simulation, sell_order, buy_order, quantity, force=True)
-
-    # TODO Really?
-    stocks = simulation.stocks.all()
-    for stock in stocks:
-        # Make market liquid
-        try:
-            max_bid = Order.objects.filter(state=Order.SUBMITTED, stock=stock, order_type=Order.BID).order_by('-price')[0]
-            bid = max_bid.price
-        except IndexError:
-            bid = False
-        try:
-            min_ask = Order.objects.filter(state=Order.SUBMITTED, stock=stock, order_type=Order.ASK).order_by('price')[0]
-            ask = min_ask.price
-            # TODO Implement better check!
-            if ask:
-                if ask > Decimal(999):
-                    ask = False
-        except IndexError:
-            ask = False
-
-        if bid and ask:
-            nb_bid = Order.objects.filter(state=Order.SUBMITTED, stock=stock, order_type=Order.BID).count()
-            nb_ask = Order.objects.filter(state=Order.SUBMITTED, stock=stock, order_type=Order.ASK).count()
-            spread = ask - bid
-            best_price = bid + spread * Decimal(nb_ask / (nb_bid+nb_ask))
-            stock.price = best_price
-            stock.save()
-            print("New price for %s: %s" % (stock.symbol, best_price))
-        elif bid:
-            # We only have bid orders, so the market price is the max_bid
-            best_price = bid
-            stock.price = best_price
-            stock.save()
-            print("New price for %s [BID]: %s" % (stock.symbol, best_price))
-        elif ask:
-            # We only have bid orders, so the market price is the max_bid
-            best_price = ask
-            stock.price = best_price
-            stock.save()
-            print("New price for %s [ASK]: %s" % (stock.symbol, best_price))
+    """
+    Runs a call auction on every stock of the simulation (once per simulation day). Each auction is sent to the
+    matching queue of its stock (see :func:`call_auction`).
+
+    :param simulation_id: The simulation id
+    :return: None
+    """
+    for stock_id in Stock.objects.filter(simulation_id=simulation_id).values_list('id', flat=True):
+        call_auction.apply_async([stock_id], queue=matching_queue(stock_id))
+
+
+@app.task
+def call_auction(stock_id):
+    """
+    Runs the call auction of a stock.
+
+    The clearing price maximising the traded volume is computed from the aggregate supply and demand curves and the
+    volume is allocated by price and time priority. All the fills are settled in a single transaction.
+
+    The auction runs in the matching queue of the stock, one order at a time with the matching passes, on the order
+    book of the matching worker. The submitted orders are locked with ``FOR UPDATE SKIP LOCKED`` as well: an order
+    locked by another settlement is left out of the auction.
+
+    :param stock_id: The stock id
+    :return: None
+    """
+    stock = Stock.objects.select_related('simulation').get(pk=stock_id)
+    simulation = stock.simulation
+    with transaction.atomic():
+        orders = list(Order.objects.raw('SELECT * FROM stocks_order WHERE stock_id=%s AND state=%s '
+                                        'FOR UPDATE SKIP LOCKED', [stock.id, Order.SUBMITTED]))
+        bids = order_priority([o for o in orders if o.order_type == Order.BID], Order.BID)
+        asks = order_priority([o for o in orders if o.order_type == Order.ASK], Order.ASK)
+        price, volume = clearing_price(bids, asks, reference=stock.price or None)
+        if volume:
+            print("Call auction for stock %s: %s @ %s" % (stock.symbol, volume, price))
+            settlement = Settlement(simulation, stock, book=get_book(stock.id))
+            for sell_order, buy_order, quantity in allocate(bids, asks, price, volume):
+                if sell_order.state == Order.SUBMITTED and buy_order.state == Order.SUBMITTED:
+                    settlement.fill(sell_order, buy_order, quantity, price=price)
+            settlement.commit()
+            bids = [o for o in bids if o.state == Order.SUBMITTED] + \
+                [o for o in settlement.remainders if o.order_type == Order.BID]
+            asks = [o for o in asks if o.state == Order.SUBMITTED] + \
+                [o for o in settlement.remainders if o.order_type == Order.ASK]
+
+    # Make market liquid
+    bid_prices = [o.price for o in bids if o.price is not None]
+    ask_prices = [o.price for o in asks if o.price is not None]
+    bid = max(bid_prices) if bid_prices else False
+    ask = min(ask_prices) if ask_prices else False
+    # TODO Implement better check!
+    if ask and ask > Decimal(999):
+        ask = False
+
+    if bid and ask:
+        nb_bid = len(bids)
+        nb_ask = len(asks)
+        spread = ask - bid
+        best_price = bid + spread * Decimal(nb_ask / (nb_bid+nb_ask))
+        set_stock_price(stock.id, best_price)
+        print("New price for %s: %s" % (stock.symbol, best_price))
+    elif bid:
+        # We only have bid orders, so the market price is the max_bid
+        best_price = bid
+        set_stock_price(stock.id, best_price)
+        print("New price for %s [BID]: %s" % (stock.symbol, best_price))
+    elif ask:
+        # We only have ask orders, so the market price is the min_ask
+        best_price = ask
+        set_stock_price(stock.id, best_price)
+        print("New price for %s [ASK]: %s" % (stock.symbol, best_price))
@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+# tests.py
+#
+# Copyright (C) 2014 HES-SO//HEG Arc
+#
+# Author(s): Cédric Gaspoz <cedric.gaspoz@he-arc.ch>
+#
+# This file is part of MarMix.
+#
+# MarMix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MarMix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MarMix. If not, see <http://www.gnu.org/licenses/>.
+
+# Stdlib imports
+
+# Core Django imports
+from django.test import SimpleTestCase
+
+# Third-party app imports
+import numpy as np
+
+# MarMix imports
+from .utils import geometric_brownian, company_financials
+
+
+class GeometricBrownianTest(SimpleTestCase):
+
+    def setUp(self):
+        self.nb_days = 10
+        self.max_growth = 0.09
+
+    def paths(self, seed):
+        return geometric_brownian(50, 5, 0.02, 0.1, 1, 1/self.nb_days, np.random.RandomState(seed),
+                                  max_growth=self.max_growth)
+
+    def test_growth_of_last_period_is_bounded(self):
+        for seed in (1, 42, 2014):
+            paths = self.paths(seed)
+            growth = paths[:, -self.nb_days:].sum(axis=1)/paths[:, -2*self.nb_days:-self.nb_days].sum(axis=1)-1
+            self.assertTrue((growth <= self.max_growth + 1e-9).all())
+
+    def test_same_seed_same_paths(self):
+        np.testing.assert_array_equal(self.paths(42), self.paths(42))
+
+    def test_drift_of_last_round_is_bounded(self):
+        financials = company_financials(self.paths(42), self.nb_days, 30, [1000]*50)
+        self.assertTrue((financials['drift'][:, -1] <= self.max_growth + 1e-9).all())
+        self.assertTrue((financials['share_value'] > 0).all())
@@ -30,23 +30,70 @@ import numpy as np
 # MarMix imports
 
 
-def geometric_brownian(T, mu, sigma, s0, dt, random=None):
+def geometric_brownian(nb_paths, T, mu, sigma, s0, dt, random=None, max_growth=0.09):
     """
-    Geometric brownian distribution.
+    Geometric brownian distribution, drawn for several paths at once.
 
-    :param T: Number of steps
+    The growth G between the sums of the last two periods of a path is bounded by construction: when it exceeds
+    max_growth, the last period is scaled down so that G = max_growth (the dividends of the last round are used as the
+    perpetual growth of the share value, see :func:`company_financials`).
+
+    :param nb_paths: Number of paths
+    :param T: Number of periods
     :param mu: The percentage drift
     :param sigma: The percentage volatility
     :param s0: The initial value
-    :param dt: The time step (float).
-    :return: An array of simulated values, where G < 0.09
+    :param dt: The time step (float), 1/dt steps make a period.
+    :param random: The numpy RandomState (or Generator) drawing the paths (the global one if not set).
+    :param max_growth: The highest growth of the last period.
+    :return: An array of simulated values of shape (nb_paths, T/dt), where G <= max_growth
     """
-    s = np.linspace(1, int(T/dt), int(T/dt))
-    while np.sum(s[int((T-1)/dt):int(T/dt)])/np.sum(s[int((T-2)/dt):int((T-1)/dt)])-1 > 0.09:
-        n = int(T/dt)
-        t = np.linspace(0, T, n)
-        w = np.random.standard_normal(size=n)
-        w = np.cumsum(w)*np.sqrt(dt)
-        x = (mu-0.5*sigma**2)*t + sigma*w
-        s = s0*np.exp(x)
-    return s
\ No newline at end of file
+    random = random or np.random
+    n = int(round(T / dt))
+    period = int(round(1 / dt))
+    t = np.linspace(0, T, n)
+    w = np.cumsum(random.standard_normal(size=(nb_paths, n)), axis=1) * np.sqrt(dt)
+    x = (mu - 0.5 * sigma ** 2) * t + sigma * w
+    s = s0 * np.exp(x)
+    growth = s[:, n - period:].sum(axis=1) / s[:, n - 2 * period:n - period].sum(axis=1)
+    s[:, n - period:] *= np.minimum(1, (1 + max_growth) / growth)[:, np.newaxis]
+    return s
+
+
+def company_financials(paths, nb_days, dividend_payoff_rate, quantities, discount_rate=0.15):
+    """
+    Financials of the simulated companies, computed for all the companies at once.
+
+    The share value of a round is the present value of the dividends of the remaining rounds plus the terminal value
+    of the last dividend (Gordon growth model). The drift of a round is the growth of the net income in the next round
+    (in the last round, the growth of the net income in this round).
+
+    :param paths: The daily dividends, an array of shape (companies, rounds*nb_days).
+    :param nb_days: The number of days per round.
+    :param dividend_payoff_rate: The part of the net income paid as dividends (in percent).
+    :param quantities: The number of shares of each company.
+    :param discount_rate: The rate of return required by the investors.
+    :return: A dict of arrays: daily_net_income (companies, rounds*nb_days), dividends, net_income, share_value and
+             drift (companies, rounds).
+    """
+    nb_companies, nb_steps = paths.shape
+    rounds = nb_steps // nb_days
+    daily_net_income = paths / float(dividend_payoff_rate) * 100 * np.asarray(quantities, dtype=float)[:, np.newaxis]
+    dividends = paths.reshape(nb_companies, rounds, nb_days).sum(axis=2)
+    net_income = daily_net_income.reshape(nb_companies, rounds, nb_days).sum(axis=2)
+
+    steps = np.arange(rounds)
+    # discount[r, k] discounts the dividend of round k to round r (dividends of past rounds are ignored)
+    offsets = (steps[np.newaxis, :] - steps[:, np.newaxis]).astype(float)
+    discount = np.where(offsets >= 0, np.power(1 + discount_rate, -offsets), 0)
+    growth = dividends[:, -1] / dividends[:, -2] - 1
+    terminal_value = dividends[:, -1] * (1 + discount_rate) / (discount_rate - growth)
+    share_value = dividends.dot(discount.T) + \
+        terminal_value[:, np.newaxis] / np.power(1 + discount_rate, rounds - steps)
+
+    income_growth = net_income[:, 1:] / net_income[:, :-1] - 1
+    drift = np.empty_like(net_income)
+    drift[:, :-1] = income_growth
+    drift[:, -1] = income_growth[:, -1]
+    return {'daily_net_income': daily_net_income, 'dividends': dividends, 'net_income': net_income,
+            'share_value': share_value, 'drift': drift}
@@ -32,11 +32,12 @@ from django.shortcuts import redirect
 
 # Third-party app imports
 from rest_framework import permissions, viewsets
+from rest_framework.response import Response
 
 # MarMix imports
 from .models import TickerCompany, CompanyShare, CompanyShareForm
 from .serializers import CompaniesSerializer
-from .tasks import prepare_dividends_payments, set_closing_price
+from .tasks import prepare_dividends_payments, set_closing_price, last_tick_metrics
 from simulations.models import Simulation
 
 
@@ -68,6 +69,16 @@ class CompaniesViewSet(viewsets.ModelViewSet):
         return TickerCompany.objects.filter(ticker__simulation_id=self.request.user.get_team.current_simulation_id)
 
 
+class TickMetricsViewSet(viewsets.ViewSet):
+    """
+    Timings of the last tick of the ticker (see :func:`tickers.tasks.main_ticker_task`).
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def list(self, request):
+        return Response(last_tick_metrics() or {})
+
+
 def CompanyShareCreateView(request, simulation_id, sim_round):
     simulation = Simulation.objects.get(pk=simulation_id)
     sim_round = int(sim_round)
@@ -60,7 +60,7 @@ from django.conf.urls import url, include
 from simulations.views import SimulationViewSet, CurrencyViewSet, TeamViewSet, ClockViewSet
 from stocks.views import StockViewSet, QuoteViewSet, OrderViewSet, HoldingsViewSet, CreateOrderViewSet, DividendsViewSet, MarketViewSet, OrderBookViewSet
 from users.views import UserViewSet, LoginView, current_user
-from tickers.views import CompaniesViewSet
+from tickers.views import CompaniesViewSet, TickMetricsViewSet
 from rest_framework.routers import DefaultRouter
 
 
@@ -80,6 +80,7 @@ router.register(r'tickers', CompaniesViewSet, base_name='ticker')
 router.register(r'dividends', DividendsViewSet, base_name='dividend')
 router.register(r'market', MarketViewSet, base_name='market')
 router.register(r'book', OrderBookViewSet, base_name='book')
+router.register(r'tick-metrics', TickMetricsViewSet, base_name='tick-metrics')
 
 # The API URLs are now determined automatically by the router.
 # Additionally, we include the login URLs for the browsable API.
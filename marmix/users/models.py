@@ -21,8 +21,11 @@ class User(AbstractUser):
     is_poweruser = property(_is_poweruser)
 
     def _get_team(self):
-        from simulations.models import Simulation, Team
-        return Team.objects.filter(simulations__state__gte=Simulation.READY, simulations__state__lte=Simulation.FINISHED).filter(users__username=self.username).first()
+        # Resolved once per request (user instance), then shared for a minute (see simulations.cache)
+        if not hasattr(self, '_team'):
+            from simulations.cache import user_team
+            self._team = user_team.get(self.id) or None
+        return self._team
     get_team = property(_get_team)
 
     def __unicode__(self):